@@ -1,35 +1,35 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from jose.exceptions import JWTClaimsError, JWTError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import jwt
 from fastapi import Body
 from app.schemas.token import Token
 from app.core.config import settings
-from app.db.session import get_db
+from app.db.session import get_async_db
 from app.schemas.user import UserLogin, UserRead, UserCreate
-from app.services.user_service import create_user, authenticate_user
+from app.services.user_service import (
+    REFRESH_COLUMNS, authenticate_user, create_user, email_exists, get_user_by_email, set_refresh_token,
+)
 from app.core.security import create_access_token, create_refresh_token
-from app.models.user import User 
 
 router = APIRouter()
 
 @router.post("/register", response_model=UserRead)
-async def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register_user(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Register a new user"""
     # Check if user already exists
-    existing = db.query(User).filter(User.email == user_data.email).first()
-    if existing:
+    if await email_exists(db, user_data.email):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User with this email already exists"
         )
-    new_user = create_user(db, user_data)
+    new_user = await create_user(db, user_data)
     return new_user
 
 @router.post("/login", response_model=Token)
-async def login(user: UserLogin, db: Session = Depends(get_db)):
+async def login(user: UserLogin, db: AsyncSession = Depends(get_async_db)):
     """Login and return JWT token"""
-    authenticated = authenticate_user(db, user.email, user.password)
+    authenticated = await authenticate_user(db, user.email, user.password)
     if not authenticated:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -40,8 +40,7 @@ async def login(user: UserLogin, db: Session = Depends(get_db)):
     refresh_token = create_refresh_token(data={"sub": authenticated.email})
     
     # Store refresh token in database
-    authenticated.refresh_token = refresh_token
-    db.commit()
+    await set_refresh_token(db, authenticated.id, refresh_token)
     
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer", "user_profile": authenticated.user_profile}
 
@@ -53,14 +52,14 @@ async def logout():
 
 
 @router.post("/refresh", response_model=Token)
-async def refresh_token(refresh_token: str = Body(...), db: Session = Depends(get_db)):
+async def refresh_token(refresh_token: str = Body(...), db: AsyncSession = Depends(get_async_db)):
     """Refresh the access token"""
     try:
         payload = jwt.decode(refresh_token, settings.REFRESH_SECRET_KEY, algorithms=[settings.ALGORITHM])
         email = payload.get("sub")
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_by_email(db, email, REFRESH_COLUMNS)
     if not user or user.refresh_token != refresh_token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
     
@@ -68,9 +67,9 @@ async def refresh_token(refresh_token: str = Body(...), db: Session = Depends(ge
     access_token = create_access_token(data={"sub": user.email})
     new_refresh_token = create_refresh_token(data={"sub": user.email})
 
-    #Update refresh token in database
-    user.refresh_token = new_refresh_token
-    db.commit()
+    #Update refresh token in database (fails if a concurrent refresh already rotated it)
+    if not await set_refresh_token(db, user.id, new_refresh_token, expected_token=refresh_token):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
     return {"access_token": access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
 
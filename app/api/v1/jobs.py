@@ -1,12 +1,59 @@
 from fastapi import APIRouter, Depends
-from app.services import job_service
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app.services import admission, batch_service, job_service
 from app.core.security import get_current_user
+from app.models.user import User
+from app.schemas.batch import BatchJob, BatchRequest
 
 
 router = APIRouter()
 
 @router.post("/start-job", summary="Start a long running background job")
-def start_background_job(current_user: dict = Depends(get_current_user)):
+async def start_background_job(current_user: dict = Depends(get_current_user)):
     """Triggers an asynchronous background job."""
-    result = job_service.start_job()
+    lease = await admission.admit(current_user.id, "job")
+    try:
+        result = job_service.start_job()
+    finally:
+        if lease:
+            lease.release()
     return {"message": "Job started", "result": result}
+
+
+@router.post("/batch", response_model=BatchJob, status_code=202, summary="Queue a batch of prompts for offline generation")
+async def create_batch_job(request: BatchRequest, current_user: User = Depends(get_current_user)):
+    """Answers every item independently on a background worker; poll the job for progress."""
+    lease = await admission.admit(current_user.id, "batch")
+    try:
+        # Writes the input file (thousands of lines) off the event loop
+        return await run_in_threadpool(
+            batch_service.create_job,
+            current_user.id,
+            [item.model_dump(exclude_none=True) for item in request.items],
+            request.system_instruction,
+        )
+    finally:
+        if lease:
+            lease.release()
+
+
+@router.get("/batch/{job_id}", response_model=BatchJob, summary="Progress of a batch job")
+async def get_batch_job(job_id: str, current_user: User = Depends(get_current_user)):
+    return batch_service.get_job(current_user.id, job_id)
+
+
+@router.post("/batch/{job_id}/cancel", response_model=BatchJob, summary="Stop a batch job")
+async def cancel_batch_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """Stops dispatching new items. Items already sent upstream are finished and kept in the results."""
+    return batch_service.cancel_job(current_user.id, job_id)
+
+
+@router.get("/batch/{job_id}/results", summary="Download a batch job's results (JSONL)")
+async def get_batch_results(job_id: str, current_user: User = Depends(get_current_user)):
+    """One JSON object per line, in completion order. While the job runs, holds the results so far."""
+    return StreamingResponse(
+        batch_service.read_results(current_user.id, job_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="batch-{job_id}.jsonl"'},
+    )
@@ -1,14 +1,22 @@
 # This endpoint will handle the request and use a StreamingResponse.
-from fastapi import APIRouter, File, UploadFile, Depends, Query
-from fastapi.responses import StreamingResponse
-from app.services.llm_service import stream_chat_response, stream_chat_response_with_history
-from app.schemas.chat import ChatRequest
+from typing import Optional
+from fastapi import APIRouter, File, UploadFile, Depends, Query, Header, WebSocket
+from app.services.llm_service import stream_chat_response_with_history
+from app.services.llm_router import get_llm_router
+from app.services.stream_encoder import event_stream_response
+from app.services import admission, chat_history, response_stream, single_flight, ws_chat
+from app.core.config import settings
+from app.schemas.chat import ChatRequest, HistoryPage
 from app.core.security import get_current_user
+from app.core.logging_config import bind_log_context
+from app.core.metrics import timed
+from app.db.database import AsyncSessionLocal
+from app.services.user_service import get_user_profile
 
 from app.models.user import User
 from fastapi import Depends, HTTPException, status
+from starlette.concurrency import run_in_threadpool
 
-from app.workers.tasks import index_document_task
 import shutil
 import os
 
@@ -21,6 +29,13 @@ async def chat(
     enable_tools: bool = Query(
         True, 
         description="Enable Function Calling (True) for tool use, or use pure streaming (False) for speed."
+    ),
+    accept: Optional[str] = Header(None, description="text/event-stream for SSE, otherwise NDJSON"),
+    idempotency_key: Optional[str] = Header(
+        None,
+        alias="Idempotency-Key",
+        max_length=255,
+        description="Retries with the same key replay the original answer instead of generating a new one",
     )):
 
     # Ensure a session_id is provided for multi-turn chat
@@ -30,16 +45,134 @@ async def chat(
             detail="session_id is required for multi-turn chat."
         )
 
-    # Get the generator from the service layer, passing user ID and session ID
-    generator = stream_chat_response_with_history(
-        user_id=current_user.id, 
-        session_id=request.session_id,
-        user_message=request.message,
-        enable_tools=enable_tools,
-        use_rag=request.use_rag
+    bind_log_context(session_id=request.session_id, user_id=current_user.id)
+
+    # Rate limits and concurrency slots; raises 429 with Retry-After when saturated
+    lease = await admission.admit(current_user.id, "chat")
+    release_lease = lease.release if lease else (lambda: None)
+
+    # Until the generator or on_finish owns the lease, a failure here must release it
+    try:
+        # Only the profile column, on the async engine
+        with timed("profile_query"):
+            async with AsyncSessionLocal() as db:
+                user_profile = await get_user_profile(db, current_user.id)
+
+        # Get the generator from the service layer, passing user ID and session ID
+        def make_generator():
+            return stream_chat_response_with_history(
+                user_id=current_user.id, 
+                session_id=request.session_id,
+                user_message=request.message,
+                enable_tools=enable_tools,
+                use_rag=request.use_rag,
+                user_profile=user_profile,
+            )
+
+        if not (settings.RESUMABLE_STREAMS_ENABLED and response_stream.is_available()):
+            return event_stream_response(admission.release_after(make_generator(), lease), accept)
+
+        headers = {}
+        if settings.SINGLE_FLIGHT_ENABLED:
+            # An identical request already in flight: read its answer instead of generating again
+            key = single_flight.request_key(
+                current_user.id, request.session_id, request.message, enable_tools, request.use_rag, idempotency_key
+            )
+            # Redis round trips in the threadpool, off the event loop
+            response_id, is_leader = await run_in_threadpool(
+                single_flight.claim_response, key, current_user.id, request.session_id
+            )
+            if is_leader:
+                def on_finish(outcome):
+                    release_lease()
+                    single_flight.release_response(key, response_id, outcome, keep=idempotency_key is not None)
+
+                try:
+                    response_stream.start_chat_generation(
+                        current_user.id, request.session_id, make_generator, response_id=response_id,
+                        on_finish=on_finish,
+                    )
+                except Exception:
+                    # Duplicates must not wait on a response that will never be written
+                    await run_in_threadpool(single_flight.release_response, key, response_id, "failed")
+                    raise
+            else:
+                # Nothing is generated for this request, so it does not hold a slot
+                release_lease()
+                headers["X-Single-Flight"] = "joined"
+        else:
+            # Generate in the background into a Redis Stream; the client reads (and can resume) from it
+            response_id = await run_in_threadpool(
+                response_stream.create_response_stream, current_user.id, request.session_id
+            )
+            response_stream.start_chat_generation(
+                current_user.id, request.session_id, make_generator, response_id=response_id,
+                on_finish=lambda outcome: release_lease(),
+            )
+    except BaseException:
+        # Not handed over yet (release() is idempotent)
+        release_lease()
+        raise
+
+    return event_stream_response(
+        response_stream.read_response_events(response_id),
+        accept,
+        headers={"X-Response-ID": response_id, **headers},
+        with_ids=True,
     )
-    
-    return StreamingResponse(generator, media_type="text/event-stream")
+
+
+@router.websocket("/ws")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Chat over one WebSocket: authenticate once (first frame), then run many turns
+    across sessions, with cancellation. Protocol in app/services/ws_chat.py.
+    """
+    await ws_chat.serve(websocket)
+
+
+@router.get("/chat/{response_id}/stream", summary="Resume a chat response stream after a disconnect")
+async def resume_chat(
+    response_id: str,
+    current_user: User = Depends(get_current_user),
+    last_event_id: Optional[str] = Query(None, description="Resume after this event id (alternative to the header)"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+    accept: Optional[str] = Header(None, description="text/event-stream for SSE, otherwise NDJSON")):
+
+    if not response_stream.is_available():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Resumable streams are unavailable.")
+
+    meta = response_stream.get_response_meta(response_id)
+    # Someone else's response is reported as missing, not forbidden
+    if not meta or meta["user_id"] != str(current_user.id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Response not found or expired.")
+
+    resume_from = last_event_id or last_event_id_header
+    if resume_from and not response_stream.is_valid_event_id(resume_from):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Last-Event-ID.")
+
+    return event_stream_response(
+        response_stream.read_response_events(response_id, resume_from),
+        accept,
+        headers={"X-Response-ID": response_id},
+        with_ids=True,
+    )
+
+@router.get("/sessions/{session_id}/history", response_model=HistoryPage,
+            summary="Page through a chat session's full history, newest page first")
+async def session_history(
+    session_id: str,
+    before: Optional[int] = Query(None, description="Return messages older than this `seq` (from `next_before`)"),
+    limit: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_user),
+):
+    """Recent messages come from the Redis hot cache; older pages from the archive table."""
+    return await chat_history.get_history_page(current_user.id, session_id, before=before, limit=limit)
+
+
+@router.get("/router-stats", summary="Hedging, fallback and circuit-breaker counters of the LLM router")
+async def router_stats(current_user: User = Depends(get_current_user)):
+    return get_llm_router().stats()
 
 """
 This part is for the RAG Document Upload
@@ -47,6 +180,14 @@ This part is for the RAG Document Upload
 DOCUMENTS_DIR = os.path.join(os.getcwd(), "documents")
 os.makedirs(DOCUMENTS_DIR, exist_ok=True) # Create the directory if it doesn't exist
 
+def _store_and_enqueue(source, file_path: str, user_id):
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(source, buffer)
+    # Trigger the background indexing task (Step 2); the task module is imported on first use
+    from app.workers.tasks import index_document_task
+    index_document_task.delay(file_path, user_id)
+
+
 @router.post("/upload-document", summary="Upload a document for RAG indexing")
 async def upload_document(
     file: UploadFile = File(...),
@@ -58,20 +199,25 @@ async def upload_document(
             detail="Unsupported file format. Only PDF files are allowed."
         )
     
+    # Background work: waits behind interactive chat when the service is saturated.
+    # The lease covers intake (storing the file and queueing the task); the indexing
+    # itself is paced by the Celery queues and the LLM limiter.
+    lease = await admission.admit(current_user.id, "upload")
+
     # Save the file to the documents directory
     file_path = os.path.join(DOCUMENTS_DIR, file.filename)
     
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Off the event loop: the copy and the broker publish both block
+        await run_in_threadpool(_store_and_enqueue, file.file, file_path, current_user.id)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to upload document: {str(e)}"
         )
-
-    # Trigger the background indexing task (Step 2)
-    index_document_task.delay(file_path, current_user.id)
+    finally:
+        if lease:
+            lease.release()
     
     return {
         "filename": file.filename,
@@ -0,0 +1,34 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from app.core.config import settings
+from app.core.security import get_current_user
+from app.models.user import User
+from app.schemas.usage import UsageReport
+from app.services import usage
+
+router = APIRouter()
+
+DAYS = Query(30, ge=1, le=366, description="Days to report, today included")
+
+
+def require_usage_admin(current_user: User = Depends(get_current_user)) -> User:
+    if current_user.email not in settings.USAGE_ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to read other users' usage.")
+    return current_user
+
+
+@router.get("/me", response_model=UsageReport, summary="Your LLM usage per day and feature, and your quota")
+async def my_usage(days: int = DAYS, current_user: User = Depends(get_current_user)):
+    """Written in bulk from Redis, so it can lag by USAGE_FLUSH_INTERVAL_S. The quota counters do not."""
+    report = await usage.usage_report(days, user_id=current_user.id)
+    return {**report, "quota": usage.quota_status(current_user.id)}
+
+
+@router.get("/features", response_model=UsageReport, summary="Service-wide LLM usage per day and feature (admins)")
+async def feature_usage(days: int = DAYS, admin: User = Depends(require_usage_admin)):
+    return await usage.usage_report(days)
+
+
+@router.get("/users/{user_id}", response_model=UsageReport, summary="One user's LLM usage and quota (admins)")
+async def user_usage(user_id: int, days: int = DAYS, admin: User = Depends(require_usage_admin)):
+    report = await usage.usage_report(days, user_id=user_id)
+    return {**report, "quota": usage.quota_status(user_id)}
@@ -1,6 +1,6 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import model_validator
-from typing import Optional
+from typing import Dict, List, Optional
 
 # Use pydantic_settings for modern Pydantic versions
 class Settings(BaseSettings):
@@ -16,15 +16,161 @@ class Settings(BaseSettings):
     # Celery
     CELERY_BROKER_URL: Optional[str] = None
     CELERY_RESULT_BACKEND: Optional[str] = None
+    CELERY_TASK_ALWAYS_EAGER: bool = False # Run tasks inline, without a broker (local dev, benchmarks)
+    CELERY_IO_CONCURRENCY: int = 16           # Threads per "io" worker (profile updates, embeddings)
+    CELERY_CPU_CONCURRENCY: Optional[int] = None  # Processes per "cpu" worker (ingestion); None = one per core
+    CELERY_LONG_CONCURRENCY: int = 4          # Threads per "long" worker
+    CELERY_PROFILE_TIME_LIMIT_S: int = 900    # Hard limits; the soft limit is 90% of these
+    CELERY_EMBEDDING_TIME_LIMIT_S: int = 900  # (include the wait for an LLM limiter slot)
+    CELERY_INGESTION_TIME_LIMIT_S: int = 300
+    CELERY_LONG_TIME_LIMIT_S: int = 3600
+    CELERY_VISIBILITY_TIMEOUT_S: int = 7200   # Unacked tasks are redelivered after this; keep above every time limit
+    INGESTION_EMBED_BATCH_SIZE: int = 64      # Chunks per embedding task
+    INGESTION_EMBED_MAX_RETRIES: int = 5      # Failed embedding batches are retried with exponential backoff
+    INGESTION_CHUNKS_TTL_S: int = 24 * 3600   # Chunk text waiting in Redis for its embedding task
     # Database
-    DATABASE_URL: str = "sqlite:///./llm.db"
+    DATABASE_URL: str = "sqlite:///./llm.db"  # Sync URL; the async engine swaps in asyncpg / aiosqlite
+    DB_POOL_SIZE: int = 10          # Persistent connections per engine (per process)
+    DB_MAX_OVERFLOW: int = 20       # Extra connections allowed under bursts
+    DB_POOL_TIMEOUT_S: float = 30.0 # Wait this long for a free connection
+    DB_POOL_PRE_PING: bool = True   # Check connections before use (survives DB restarts)
+    DB_POOL_RECYCLE_S: int = 1800   # Reopen connections older than this
 
     # LLM Service
-    OPENAI_API_KEY: str = ""
-    LLM_MODEL: str = "gpt-4o-mini"
+    # Which backend serves chat, generation and embeddings: "gemini" or "stub" (local, offline)
+    LLM_PROVIDER: str = "gemini"
     GOOGLE_API_KEY: str = ""
     GOOGLE_LLM_MODEL: str =  "gemini-2.5-flash"
 
+    # Stub LLM provider (deterministic, no network; used for offline development and load tests)
+    STUB_LLM_MODEL: str = "stub-model"
+    STUB_TTFT_MS: float = 200.0          # Delay before the first chunk
+    STUB_TOKENS_PER_SEC: float = 50.0    # Streaming speed after the first chunk
+    STUB_RESPONSE_TOKENS: int = 64       # Length of every generated answer
+    STUB_CHUNK_TOKENS: int = 4           # Tokens per streamed chunk
+    STUB_FUNCTION_CALL_RATE: float = 0.0 # Probability of requesting a tool call when tools are enabled
+    STUB_ERROR_RATE: float = 0.0         # Probability of an injected upstream failure
+    STUB_THROTTLE_RATE: float = 0.0      # Probability of an injected 429 (quota exhausted)
+    STUB_PREFILL_MS_PER_1K_TOKENS: float = 0.0  # Extra time to first token per 1000 uncached input tokens
+    STUB_SEED: int = 0
+
+    # LLM Routing (hedged requests and circuit breaking around the chat stream)
+    LLM_HEDGE_DELAY_MS: float = 3000.0       # Issue a second request if no first chunk by then (0 disables)
+    LLM_FALLBACK_MODEL: Optional[str] = None # Model for hedge/fallback requests (defaults to the primary model)
+    LLM_CIRCUIT_WINDOW: int = 20             # Number of recent calls considered per model
+    LLM_CIRCUIT_MIN_SAMPLES: int = 5
+    LLM_CIRCUIT_ERROR_RATE: float = 0.5      # Open the circuit at this error rate...
+    LLM_CIRCUIT_TTFT_MS: float = 10000.0     # ...or when the median time-to-first-token exceeds this
+    LLM_CIRCUIT_COOLDOWN_S: float = 30.0
+
+    # Adaptive upstream concurrency (AIMD, shared by API and Celery workers through Redis)
+    LLM_LIMITER_ENABLED: bool = True
+    LLM_LIMITER_INITIAL: float = 8.0           # Allowed in-flight upstream calls before any feedback
+    LLM_LIMITER_MIN: float = 2.0
+    LLM_LIMITER_MAX: float = 64.0
+    LLM_LIMITER_DECREASE_FACTOR: float = 0.7   # Multiplicative decrease on throttling
+    LLM_LIMITER_DECREASE_COOLDOWN_MS: float = 1000.0  # At most one decrease per window
+    LLM_LIMITER_LATENCY_TARGET_MS: float = 5000.0     # Slower calls (time to first token) do not grow the limit
+    LLM_LIMITER_INTERACTIVE_RESERVE: float = 0.25     # Share of the limit background work can never take
+    LLM_LIMITER_WAIT_TIMEOUT_S: float = 30.0          # Max wait for a slot (interactive)
+    LLM_LIMITER_BACKGROUND_WAIT_TIMEOUT_S: float = 600.0  # Max wait for a slot (Celery tasks)
+    LLM_LIMITER_LEASE_TTL_S: float = 600.0     # Slots of crashed processes are reclaimed after this
+
+    # Chat stream encoding (see app/services/stream_encoder.py)
+    STREAM_COALESCE_MAX_BYTES: int = 512  # Flush buffered text deltas at this size...
+    STREAM_COALESCE_MAX_MS: float = 40.0  # ...or after this long, whichever comes first
+    STREAM_HEARTBEAT_S: float = 15.0      # Idle keep-alive interval (0 disables)
+
+    # WebSocket chat (see app/services/ws_chat.py)
+    WS_AUTH_TIMEOUT_S: float = 10.0       # The first frame must authenticate within this
+    WS_MAX_CONCURRENT_TURNS: int = 4      # In-flight turns per connection
+    WS_SEND_QUEUE_SIZE: int = 64          # Frames queued for a slow client before text deltas are merged instead
+    WS_MAX_BUFFERED_BYTES: int = 65536    # Past this much merged text a turn waits for the client
+    WS_TURN_READ_AHEAD: int = 64          # Events read ahead from the generator per turn
+
+    # Resumable chat responses (Redis Streams, see app/services/response_stream.py)
+    RESUMABLE_STREAMS_ENABLED: bool = True
+    RESPONSE_STREAM_TTL_S: int = 600            # Keep finished responses this long for reconnects
+    RESPONSE_STREAM_MAXLEN: int = 10000         # Upper bound on events per response
+    RESPONSE_STREAM_IDLE_TIMEOUT_S: float = 120 # Readers give up if generation stops writing
+    RESPONSE_GENERATION_THREADS: int = 64       # Concurrent background generations per process
+    SINGLE_FLIGHT_ENABLED: bool = True          # Identical in-flight /chat requests share one generation
+    SINGLE_FLIGHT_IDEMPOTENCY_TTL_S: int = 600  # Replay window for retries that send an Idempotency-Key
+
+    # Chat history tiers (Redis hot cache, Postgres archive; see app/services/chat_history.py)
+    HISTORY_CONTEXT_MESSAGES: int = 10        # Messages sent to the LLM as conversation context
+    HISTORY_HOT_MAX_MESSAGES: int = 100       # Newest messages kept in Redis per session
+    HISTORY_HOT_TTL_S: int = 7 * 24 * 3600    # Idle sessions leave Redis after this (still in the archive)
+    CHAT_ARCHIVE_ENABLED: bool = True         # Write-behind every message to the chat_messages table
+    CHAT_ARCHIVE_BATCH_SIZE: int = 500        # Rows per bulk insert
+    CHAT_ARCHIVE_FLUSH_INTERVAL_S: float = 2.0  # Flush at least this often (sooner when a batch is full)
+    CHAT_ARCHIVE_OUTBOX_MAXLEN: int = 1000000 # Cap on unflushed messages in Redis (oldest are dropped)
+    CHAT_ARCHIVE_CLAIM_IDLE_S: float = 60.0   # Take over batches a dead process read but never wrote
+
+    # Prompt-prefix caching (upstream cached contents; see app/services/prompt_cache.py)
+    PROMPT_CACHE_ENABLED: bool = True
+    PROMPT_CACHE_TTL_S: int = 3600            # Lifetime of a cached prefix, extended while the session is active
+    PROMPT_CACHE_MIN_TOKENS: int = 1024       # Shorter prefixes are not cached (Gemini's minimum for Flash models)
+    PROMPT_CACHE_REFRESH_TOKENS: int = 1024   # Cache the prefix again once this many tokens follow the cached part
+    PROMPT_CACHE_WINDOW_SLACK: int = 10       # History messages the context window grows by before it moves on
+    PROMPT_CACHE_UPDATE_THREADS: int = 2      # Threads per process for after-turn handle updates (upstream calls)
+
+    # RAG retrieval (see app/services/retrieval.py)
+    RAG_TOP_K: int = 4                        # Chunks put into the prompt
+    RAG_FETCH_K: int = 20                     # Candidates fetched from the vector store for MMR
+    RAG_WORKING_SET_SIZE: int = 8             # Chunks MMR keeps per search; follow-ups choose among them
+    RAG_MMR_LAMBDA: float = 0.5               # 1 ranks by relevance only, 0 by diversity only
+    RAG_RERANK: str = "lexical"               # "lexical" (BM25), "cross_encoder" (needs sentence-transformers) or "none"
+    RAG_RERANK_MODEL: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    RAG_FOLLOWUP_SIMILARITY: float = 0.85     # Queries this close (cosine) to the last search reuse its working set
+    RAG_WORKING_SET_TTL_S: int = 1800
+
+    # Usage accounting and quotas (see app/services/usage.py)
+    USAGE_ENABLED: bool = True
+    USAGE_FLUSH_INTERVAL_S: float = 5.0       # Redis counters are written to the llm_usage table this often
+    USAGE_FLUSH_BATCH: int = 1000             # (user, feature, day) buckets per bulk upsert
+    USAGE_DAILY_TOKEN_QUOTA: int = 0          # LLM + embedding tokens per user per UTC day (0: unlimited)
+    USAGE_MONTHLY_TOKEN_QUOTA: int = 0        # Same, per calendar month
+    USAGE_ADMIN_EMAILS: List[str] = []        # Users who may read everyone's usage (JSON list)
+
+    # Batch generation jobs (see app/services/batch_service.py)
+    BATCH_DIR: str = "batches"                # Inputs and JSONL results, one directory per job; shared by API and workers
+    BATCH_MAX_ITEMS: int = 10000              # Prompts per job
+    BATCH_MAX_ACTIVE_JOBS_PER_USER: int = 2   # Queued or running jobs per user
+    BATCH_CONCURRENCY: int = 8                # Upstream calls in flight per job (also bound by the LLM limiter)
+    BATCH_MICRO_BATCH_SIZE: int = 50          # Results appended to the artifact, and progress reported, per write
+    BATCH_FLUSH_INTERVAL_S: float = 2.0       # Write at least this often when results come in slowly
+    BATCH_MAX_ATTEMPTS: int = 3               # Per prompt, with exponential backoff between attempts
+    BATCH_SLICE_S: float = 1800.0             # A task stops dispatching after this long and requeues the rest
+    BATCH_RETENTION_S: int = 7 * 24 * 3600    # Jobs and their results are kept this long
+
+    # Admission control and rate limiting (see app/services/admission.py)
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_USER_CONCURRENCY: int = 4       # In-flight chats/uploads/jobs per user
+    ADMISSION_GLOBAL_CONCURRENCY: int = 64    # In-flight requests across all workers
+    ADMISSION_QUEUE_MAX: int = 128            # Requests waiting for a global slot (background may use half)
+    ADMISSION_QUEUE_TIMEOUT_S: float = 10.0   # Give up waiting after this long
+    ADMISSION_LEASE_TTL_S: float = 600.0      # Slots held longer than this are reclaimed
+    ADMISSION_RETRY_AFTER_S: float = 1.0      # Retry-After for concurrency and queue rejections
+    RATE_LIMIT_REQUESTS_PER_MIN: float = 60.0 # Per-user request rate (0 disables)
+    RATE_LIMIT_REQUESTS_BURST: int = 20
+    RATE_LIMIT_LLM_TOKENS_PER_MIN: float = 100000.0 # Per-user LLM token rate (0 disables)
+    RATE_LIMIT_LLM_TOKENS_BURST: int = 200000
+
+    # Startup (see app/core/startup.py and gunicorn.conf.py)
+    WARM_IMPORTS_ON_STARTUP: bool = True  # Import Celery/LangChain modules in the background once serving
+    IMPORT_TIME_BUDGET_MS: float = 1500.0 # verify_imports.py fails if importing app.main takes longer
+
+    # Logging
+    LOG_LEVEL: str = "INFO"
+    LOG_LEVELS: Dict[str, str] = {}       # Per-module overrides, e.g. {"app.services.llm_service": "DEBUG"}
+    LOG_FORMAT: str = "json"              # "json" or "text"
+    LOG_DEBUG_SAMPLE_RATE: float = 0.1    # Fraction of DEBUG records that are kept
+
+    # Observability
+    METRICS_ENABLED: bool = True  # Serve Prometheus metrics on /metrics
+    OTEL_ENABLED: bool = False    # Also emit per-stage OpenTelemetry spans (needs opentelemetry-api)
+
     # Background Queue
     REDIS_URL: Optional[str] = None
     
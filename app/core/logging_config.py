@@ -0,0 +1,179 @@
+# app/core/logging_config.py
+
+"""
+Structured, non-blocking logging.
+
+- Request threads only put records on an in-memory queue (QueueHandler); a
+  background QueueListener thread formats them and does the actual stdout I/O.
+- Lines are JSON (orjson) with the request id, session id and user id of the
+  request that emitted them, so interleaved output from several gunicorn
+  workers stays readable. LOG_FORMAT=text gives plain lines for local use.
+- Levels: LOG_LEVEL for everything, LOG_LEVELS for per-module overrides, e.g.
+  LOG_LEVELS='{"app.services.llm_service": "DEBUG"}'.
+- DEBUG records are sampled at LOG_DEBUG_SAMPLE_RATE before they are queued, so
+  per-chunk debug events can stay on under load.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+import orjson
+
+from app.core.config import settings
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+session_id_var: ContextVar[Optional[str]] = ContextVar("session_id", default=None)
+user_id_var: ContextVar[Optional[str]] = ContextVar("user_id", default=None)
+
+# `extra=` attributes that are written out. Anything else stays off the log line: Celery's
+# trace, for one, passes the task's full args and return value as `data`.
+_EXTRA_ATTRS = {"duration_ms", "status_code"}
+# The parts of Celery's `data` extra worth keeping
+_CELERY_DATA_KEYS = ("id", "name", "runtime")
+
+
+def bind_log_context(session_id=None, user_id=None):
+    """Attaches ids to every log line emitted by the current request (or task)."""
+    if session_id is not None:
+        session_id_var.set(str(session_id))
+    if user_id is not None:
+        user_id_var.set(str(user_id))
+
+
+def clear_log_context():
+    """Forgets the ids bound so far. Celery reuses threads across tasks, so it is called around each task."""
+    request_id_var.set(None)
+    session_id_var.set(None)
+    user_id_var.set(None)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the request context onto the record. Runs in the emitting thread, before queueing."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.session_id = session_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Keeps only a fraction of DEBUG records (records with extra={"sampled": False} are always kept)."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1 or not getattr(record, "sampled", True):
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        for key in ("request_id", "session_id", "user_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        for key in _EXTRA_ATTRS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        data = getattr(record, "data", None)
+        if isinstance(data, dict):
+            entry["task"] = {key: data[key] for key in _CELERY_DATA_KEYS if key in data}
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] [req=%(request_id)s] %(message)s")
+
+
+_listener: Optional[QueueListener] = None
+_configured_pid: Optional[int] = None
+
+
+def setup_logging():
+    """Configures the root logger for this process. Safe to call again after a fork."""
+    global _listener, _configured_pid
+    if _configured_pid == os.getpid():
+        return
+    # A listener inherited through fork has no thread in this process; start a fresh one
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if settings.LOG_FORMAT == "json" else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(DebugSamplingFilter(settings.LOG_DEBUG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(settings.LOG_LEVEL.upper())
+    for name, level in settings.LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    _configured_pid = os.getpid()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flushes queued records. Called at exit."""
+    global _listener
+    if _listener is not None and _configured_pid == os.getpid():
+        _listener.stop()
+        _listener = None
+
+
+class RequestContextMiddleware:
+    """Pure ASGI middleware: assigns a request id (or honours X-Request-ID) and echoes it back."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
@@ -0,0 +1,324 @@
+# app/core/metrics.py
+
+"""
+Low-overhead, in-process metrics with Prometheus text exposition.
+
+Counters and histograms are plain dicts guarded by a lock, so recording a sample
+costs a few hundred nanoseconds and the instrumentation can stay on in
+production. `timed(stage)` records a per-stage latency and, when OTEL_ENABLED is
+set and opentelemetry is installed, also opens a trace span of the same name.
+
+Each API process exposes its own samples on /metrics. Celery task durations are
+recorded by the workers into Redis (see app/workers/worker.py) and rendered here
+too, together with the depth of every Celery queue read from the broker, so one
+scrape sees both.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+from app.core.config import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames: Iterable[str], values: Iterable[str], extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return "\n".join(lines)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # key -> [bucket counts..., +Inf count, sum]
+        self.values: Dict[Tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(key, list(series)) for key, series in self.values.items()]
+        for key, series in items:
+            lines.extend(render_histogram_series(self.name, self.labelnames, key, self.buckets, series))
+        return "\n".join(lines)
+
+
+def render_histogram_series(name, labelnames, key, buckets, series):
+    """Renders one histogram series stored as [bucket counts..., +Inf count, sum]."""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets + (float("inf"),), series[:-1]):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{name}_bucket{_format_labels(labelnames, key, {'le': le})} {cumulative}")
+    lines.append(f"{name}_sum{_format_labels(labelnames, key)} {series[-1]}")
+    lines.append(f"{name}_count{_format_labels(labelnames, key)} {cumulative}")
+    return lines
+
+
+stage_duration = Histogram(
+    "llm_stage_duration_seconds",
+    "Time spent in each stage of a request (auth, history_read, profile_query, embedding, "
+    "vector_search, first_token, tool_call, history_write).",
+    labelnames=("stage",),
+)
+tool_call_duration = Histogram(
+    "llm_tool_call_duration_seconds", "Duration of each agent tool execution.", labelnames=("tool",)
+)
+tokens_total = Counter(
+    "llm_tokens_total",
+    "LLM tokens processed, by direction (input/output; cached_input is the part of input served from a prompt cache).",
+    labelnames=("direction",),
+)
+cache_requests_total = Counter(
+    "cache_requests_total", "Cache lookups by cache name and result (hit/miss).", labelnames=("cache", "result")
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request duration until the last response byte (including streams).",
+    labelnames=("method", "route", "status"),
+)
+
+REGISTRY = [stage_duration, tool_call_duration, tokens_total, cache_requests_total, http_request_duration]
+
+
+def _get_tracer():
+    if not settings.OTEL_ENABLED:
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace.get_tracer("fastapi-llm-microservice")
+
+
+_tracer = _get_tracer()
+
+
+@contextmanager
+def timed(stage: str):
+    """Times the block as `stage` (and traces it when OpenTelemetry is enabled)."""
+    started = time.perf_counter()
+    if _tracer is None:
+        try:
+            yield
+        finally:
+            stage_duration.observe(time.perf_counter() - started, stage=stage)
+        return
+    with _tracer.start_as_current_span(stage):
+        try:
+            yield
+        finally:
+            stage_duration.observe(time.perf_counter() - started, stage=stage)
+
+
+def record_cache(cache: str, hit: bool):
+    cache_requests_total.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_tokens(input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0):
+    if input_tokens:
+        tokens_total.inc(input_tokens, direction="input")
+    if output_tokens:
+        tokens_total.inc(output_tokens, direction="output")
+    if cached_tokens:
+        tokens_total.inc(cached_tokens, direction="cached_input")
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: times every HTTP request until its last body chunk is sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                route = scope.get("route")
+                http_request_duration.observe(
+                    time.perf_counter() - started,
+                    method=scope["method"],
+                    # Route templates keep the label cardinality bounded
+                    route=getattr(route, "path", "unmatched"),
+                    status=status["code"],
+                )
+
+        await self.app(scope, receive, send_wrapper)
+
+
+CELERY_METRICS_KEY = "metrics:celery_task_duration_seconds"
+CELERY_METRIC_NAME = "celery_task_duration_seconds"
+
+
+def record_celery_task_duration(task: str, state: str, seconds: float):
+    """Called by Celery workers; aggregates task durations in Redis so the API can expose them."""
+    from app.db.redis_client import get_redis
+    redis_client = get_redis()
+    if not redis_client:
+        return
+    index = bisect_left(DEFAULT_BUCKETS, seconds)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hincrby(CELERY_METRICS_KEY, f"{task}|{state}|{index}", 1)
+    pipe.hincrbyfloat(CELERY_METRICS_KEY, f"{task}|{state}|sum", seconds)
+    try:
+        pipe.execute()
+    except Exception:
+        # Metrics must never fail a task
+        pass
+
+
+def render_celery_metrics() -> str:
+    from app.db.redis_client import get_redis
+    redis_client = get_redis()
+    if not redis_client:
+        return ""
+    try:
+        fields = redis_client.hgetall(CELERY_METRICS_KEY)
+    except Exception:
+        return ""
+    series: Dict[Tuple[str, str], list] = {}
+    for field, value in fields.items():
+        task, state, slot = field.rsplit("|", 2)
+        values = series.setdefault((task, state), [0] * (len(DEFAULT_BUCKETS) + 2))
+        if slot == "sum":
+            values[-1] = float(value)
+        else:
+            values[int(slot)] = int(value)
+    lines = [
+        f"# HELP {CELERY_METRIC_NAME} Celery task duration, aggregated across all workers.",
+        f"# TYPE {CELERY_METRIC_NAME} histogram",
+    ]
+    for key, values in sorted(series.items()):
+        lines.extend(render_histogram_series(CELERY_METRIC_NAME, ("task", "state"), key, DEFAULT_BUCKETS, values))
+    return "\n".join(lines)
+
+
+CELERY_UNACKED_KEY = "unacked"  # kombu's Redis transport: delivered but not yet acknowledged messages
+
+
+def _broker_redis():
+    """Redis client for the Celery broker: the shared client when the broker lives on the same Redis (the default)."""
+    from app.db.redis_client import get_redis
+    if settings.CELERY_BROKER_URL == f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/0":
+        return get_redis()
+    if not settings.CELERY_BROKER_URL.startswith(("redis://", "rediss://")):
+        return None
+    return _separate_broker_redis()
+
+
+@lru_cache(maxsize=1)
+def _separate_broker_redis():
+    import redis
+    return redis.Redis.from_url(settings.CELERY_BROKER_URL, decode_responses=True)
+
+
+def render_celery_queue_metrics() -> str:
+    """
+    Queue depth per Celery queue (all priority levels), read straight from the
+    broker. Meant for autoscaling the worker profiles in app/workers/queues.py.
+    """
+    from app.workers.queues import QUEUES, priority_lists
+    client = _broker_redis()
+    if not client:
+        return ""
+    try:
+        pipe = client.pipeline(transaction=False)
+        for queue in QUEUES:
+            for name in priority_lists(queue):
+                pipe.llen(name)
+        pipe.hlen(CELERY_UNACKED_KEY)
+        results = pipe.execute()
+    except Exception:
+        return ""
+    lines = [
+        "# HELP celery_queue_length Tasks waiting in each Celery queue.",
+        "# TYPE celery_queue_length gauge",
+    ]
+    per_queue = len(results[:-1]) // len(QUEUES)
+    for index, queue in enumerate(QUEUES):
+        lines.append(f'celery_queue_length{{queue="{queue}"}} {sum(results[index * per_queue:(index + 1) * per_queue])}')
+    lines += [
+        "# HELP celery_tasks_unacked Tasks delivered to a worker and not yet acknowledged (running or prefetched).",
+        "# TYPE celery_tasks_unacked gauge",
+        f"celery_tasks_unacked {results[-1]}",
+    ]
+    return "\n".join(lines)
+
+
+def render_metrics(extra_sections: Iterable[str] = ()) -> str:
+    sections = [metric.render() for metric in REGISTRY]
+    sections.extend(section for section in extra_sections if section)
+    return "\n".join(sections) + "\n"
+
+
+def render_process_info() -> str:
+    return "\n".join([
+        "# HELP process_info Identifies the worker process that served this scrape.",
+        "# TYPE process_info gauge",
+        f'process_info{{pid="{os.getpid()}"}} 1',
+    ])
+
+
+def render_router_metrics(stats: Dict) -> str:
+    """Renders the LLM router counters (hedges, fallbacks, circuit breaker) as Prometheus counters."""
+    lines = []
+    for name in ("requests", "hedged", "hedge_wins", "fallbacks", "failures", "circuit_opened"):
+        metric = f"llm_router_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {stats.get(name, 0)}")
+    lines.append("# TYPE llm_router_open_circuits gauge")
+    lines.append(f"llm_router_open_circuits {len(stats.get('open_circuits', []))}")
+    return "\n".join(lines)
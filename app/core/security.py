@@ -1,14 +1,20 @@
 import bcrypt
+import logging
 from passlib.context import CryptContext
 from app.core.config import settings
+from app.core.metrics import timed
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer, OAuth2PasswordBearer
 from fastapi import Depends, HTTPException, status
 from typing import Optional
-from app.db.session import get_db 
+from app.db.session import get_async_db
 from app.models.user import User
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
+
+logger = logging.getLogger(__name__)
 
 
 # Define the OAuth2 scheme (where FastAPI looks for the token: Authorization: Bearer <token>)
@@ -17,6 +23,10 @@ oauth2_scheme = HTTPBearer()
 # Keep passlib context for backward compatibility with existing hashes
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Columns loaded for the current user on every authenticated request.
+# hashed_password, refresh_token and user_profile are never read there.
+AUTH_COLUMNS = (User.id, User.email, User.full_name, User.is_active, User.created_at)
+
 
 def hash_password(password: str) -> str:
     """
@@ -109,13 +119,8 @@ def decode_access_token(token: str) -> Optional[str]:
         )
         # 2. Extract the subject (email)
         email: str = payload.get("sub")
-        # --- TEMPORARY LOGGING ---
-        print(f"DEBUG: Token decoded successfully. Email found: {email}")
-        # --- END TEMPORARY LOGGING ---
         if not email:
-            # --- TEMPORARY LOGGING ---
-            print("DEBUG: Token decoded, but 'sub' (email) claim is missing.")
-            # --- END TEMPORARY LOGGING ---
+            logger.debug("Token decoded, but 'sub' (email) claim is missing.")
             return None
         
         # 3. Check token expiration (optional, JOSE handles this by default but good for clarity)
@@ -127,15 +132,26 @@ def decode_access_token(token: str) -> Optional[str]:
         
     except JWTError as e:
         # Handle all other JWT errors (invalid signature, claims, etc.)
-        # print(f"JWT Decode Error: {e}") # For debugging
-        # --- TEMPORARY LOGGING ---
-        print(f"DEBUG: JWT Decode FAILED! Error: {e}") 
-        # --- END TEMPORARY LOGGING ---
+        logger.debug("JWT decode failed: %s", e)
         return None # Return None on failure
 
 
+async def authenticate_token(db: AsyncSession, token_str: str) -> Optional[User]:
+    """Returns the user an access token belongs to, or None (bad token, unknown user)."""
+    with timed("auth"):
+        # Use the utility to get the user email
+        email = decode_access_token(token_str)
+        
+        if email is None:
+            return None
+        
+        # Look up the user in the database (identity columns only)
+        result = await db.execute(select(User).options(load_only(*AUTH_COLUMNS)).where(User.email == email))
+        return result.scalars().first()
+
+
 async def get_current_user(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     #token: str = Depends(oauth2_scheme)
     token: HTTPAuthorizationCredentials = Depends(oauth2_scheme)
 ):
@@ -153,15 +169,7 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    # Use the utility to get the user email
-    email = decode_access_token(token_str)
-    
-    if email is None:
-        raise credentials_exception
-    
-    # Look up the user in the database
-    user = db.query(User).filter(User.email == email).first()
-    
+    user = await authenticate_token(db, token_str)
     if user is None:
         raise credentials_exception
         
@@ -0,0 +1,58 @@
+# app/core/startup.py
+
+"""
+Process startup helpers.
+
+Importing `app.main` only loads what is needed to accept requests. The rest is
+in DEFERRED_MODULES: Celery and its task module, and LangChain's vector stores.
+These are imported where they are used. Two things load them ahead of the first
+request that needs them:
+
+- `warm_deferred_modules()`: the FastAPI lifespan runs it in a background
+  thread once the worker is serving (WARM_IMPORTS_ON_STARTUP).
+- gunicorn --preload (see gunicorn.conf.py): the master imports the app and the
+  deferred modules once. It then calls `freeze_for_fork()`, so the workers it
+  forks share those pages copy-on-write instead of each importing them again.
+
+Network clients (Redis, database connections) are never created at import. The
+lifespan creates them in each worker, after the fork.
+"""
+
+import gc
+import importlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFERRED_MODULES = (
+    "app.workers.tasks",
+    "app.services.retrieval",
+    "langchain_core.vectorstores",
+)
+
+
+def import_deferred_modules():
+    started = time.perf_counter()
+    for name in DEFERRED_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            logger.exception("Could not pre-import %s", name)
+    logger.info("Deferred modules imported in %.0f ms", (time.perf_counter() - started) * 1000)
+
+
+def warm_deferred_modules():
+    """Imports DEFERRED_MODULES on a daemon thread, so startup does not wait for them."""
+    threading.Thread(target=import_deferred_modules, name="warm-imports", daemon=True).start()
+
+
+def freeze_for_fork():
+    """
+    Moves everything allocated so far into the permanent GC generation. Garbage
+    collections in the workers skip those objects and never write to their
+    pages, so fewer of the pages inherited from the master get copied.
+    """
+    gc.collect()
+    gc.freeze()
@@ -1,13 +1,42 @@
 # app/db/database.py
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.core.config import settings
 
+IS_SQLITE = settings.DATABASE_URL.startswith("sqlite")
+
 # For SQLite in local dev we must pass connect_args for threading
 connect_args = {}
-if settings.DATABASE_URL.startswith("sqlite"):
+if IS_SQLITE:
     connect_args = {"check_same_thread": False}
 
-engine = create_engine(settings.DATABASE_URL, connect_args=connect_args)
+# Shared by the sync engine (Celery tasks, table creation) and the async engine (API handlers)
+pool_options = {
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_timeout": settings.DB_POOL_TIMEOUT_S,
+    "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    "pool_recycle": settings.DB_POOL_RECYCLE_S,
+}
+
+
+def to_async_url(url: str) -> str:
+    """Maps a sync DATABASE_URL to its async driver: asyncpg for PostgreSQL, aiosqlite for SQLite."""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+engine = create_engine(settings.DATABASE_URL, connect_args=connect_args, **pool_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+
+# Connections are opened lazily, on the first query
+async_engine = create_async_engine(to_async_url(settings.DATABASE_URL), **pool_options)
+# Objects stay readable after commit, once the session is gone
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
@@ -1,17 +1,122 @@
+# app/db/redis_client.py
+
+"""
+Shared Redis client.
+
+Nothing connects at import time. The client is created on first use by
+`get_redis()`, and the connection is checked once at that point. The FastAPI
+lifespan calls `init_redis()` in every worker to do this eagerly. If Redis is
+unreachable, `get_redis()` returns None and the Redis-backed features switch
+off, the same as before.
+
+`get_script()` registers Lua scripts against the shared client and caches them.
+
+`get_async_redis()` returns an asyncio client for reads that block for long
+(XREAD on response streams). On the event loop they hold no thread, whereas the
+sync client would hold one of AnyIO's 40 threadpool slots for the whole stream.
+Async handlers also use it (and `get_async_script()`) for calls they repeat,
+such as admission polling, so the loop never waits on a sync round trip.
+"""
+
+import logging
+import os
+from typing import Dict, Optional
+
 import redis
+import redis.asyncio
+from redis.commands.core import AsyncScript, Script
+
 from app.core.config import settings
 
-# Initialize Redis client using the URL from the config
-try:
-    redis_client = redis.Redis(
+logger = logging.getLogger(__name__)
+
+_client: Optional[redis.Redis] = None
+_checked_pid: Optional[int] = None
+_scripts: Dict[str, Script] = {}
+_async_client: Optional[redis.asyncio.Redis] = None
+_async_pid: Optional[int] = None
+_async_scripts: Dict[str, AsyncScript] = {}
+
+
+def init_redis() -> Optional[redis.Redis]:
+    """Creates the client for this process and checks the connection."""
+    global _client, _checked_pid
+    client = redis.Redis(
         host=settings.REDIS_HOST,
         port=int(settings.REDIS_PORT),
         db=0,
         decode_responses=True,
     )
-    # Test the connection
-    redis_client.ping()
-    print("Redis connection successful")
-except Exception as e:
-    print(f"Redis connection failed: {e}")
-    redis_client = None
+    try:
+        # Test the connection
+        client.ping()
+        logger.info("Redis connection successful")
+        _client = client
+    except Exception as e:
+        logger.error("Redis connection failed: %s", e)
+        _client = None
+    _checked_pid = os.getpid()
+    _scripts.clear()
+    return _client
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """Returns the process-wide client, or None if Redis is unavailable."""
+    # A client inherited through fork (gunicorn --preload) is replaced in the child
+    if _checked_pid != os.getpid():
+        init_redis()
+    return _client
+
+
+def get_async_redis() -> Optional[redis.asyncio.Redis]:
+    """Returns the process-wide asyncio client, or None if Redis is unavailable. Use it from the event loop only."""
+    global _async_client, _async_pid
+    if get_redis() is None:
+        return None
+    if _async_pid != os.getpid():
+        _async_client = redis.asyncio.Redis(
+            host=settings.REDIS_HOST,
+            port=int(settings.REDIS_PORT),
+            db=0,
+            decode_responses=True,
+        )
+        _async_pid = os.getpid()
+        _async_scripts.clear()
+    return _async_client
+
+
+def get_script(source: str) -> Script:
+    """Returns `source` registered as a Lua script on the shared client. Redis must be available."""
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = get_redis().register_script(source)
+    return script
+
+
+def get_async_script(source: str) -> AsyncScript:
+    """Like get_script(), on the asyncio client: `await get_async_script(source)(keys=..., args=...)`."""
+    client = get_async_redis()
+    script = _async_scripts.get(source)
+    if script is None:
+        script = _async_scripts[source] = client.register_script(source)
+    return script
+
+
+def close_redis():
+    """Closes pooled connections (lifespan shutdown)."""
+    global _client, _checked_pid
+    if _client is not None:
+        _client.close()
+    _client = None
+    _checked_pid = None
+    _scripts.clear()
+
+
+async def close_async_redis():
+    """Closes the asyncio client's connections (lifespan shutdown)."""
+    global _async_client, _async_pid
+    if _async_client is not None and _async_pid == os.getpid():
+        await _async_client.aclose()
+    _async_client = None
+    _async_pid = None
+    _async_scripts.clear()
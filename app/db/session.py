@@ -1,9 +1,14 @@
-from typing import Generator
-from app.db.database import SessionLocal
+from typing import AsyncGenerator, Generator
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.database import AsyncSessionLocal, SessionLocal
 
 def get_db() -> Generator:
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,25 +1,73 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from app.core.config import settings
+from app.core.logging_config import setup_logging, RequestContextMiddleware
+from app.core.startup import warm_deferred_modules
+from app.core.metrics import MetricsMiddleware, render_metrics, render_celery_metrics, render_celery_queue_metrics, render_process_info, render_router_metrics
 from app.db import models
-from app.db.database import engine
-from app.api.v1 import auth, users, llm, jobs
+from app.db.database import async_engine, engine
+from app.db.redis_client import close_async_redis, close_redis, init_redis
+from app.services import chat_archive, usage
+from app.api.v1 import auth, users, llm, jobs, usage as usage_api
 from sqlalchemy.exc import OperationalError, IntegrityError
 
-app = FastAPI(title="FastAPI LLM Microservice", version="0.1.0")
-
-@app.on_event("startup")
-async def startup_event():
-    """Create database tables on startup if they don't exist."""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Per-worker startup and shutdown. Runs after the fork under gunicorn --preload,
+    so every worker gets its own logging thread, Redis pool and DB connections.
+    """
+    setup_logging()
+    init_redis()
     try:
         models.Base.metadata.create_all(bind=engine, checkfirst=True)
     except (OperationalError, IntegrityError):
         # Tables might already exist or another worker is creating them, which is fine
         pass
+    if settings.CHAT_ARCHIVE_ENABLED:
+        chat_archive.start_archiver()
+    if settings.USAGE_ENABLED:
+        usage.start_usage_flusher()
+    if settings.WARM_IMPORTS_ON_STARTUP:
+        warm_deferred_modules()
+    yield
+    # Flush what is still in the archive outbox, then close pooled connections
+    chat_archive.stop_archiver()
+    usage.stop_usage_flusher()
+    await async_engine.dispose()
+    await close_async_redis()
+    close_redis()
+
+app = FastAPI(title="FastAPI LLM Microservice", version="0.1.0", lifespan=lifespan)
+
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestContextMiddleware)
 
 app.include_router(auth.router, prefix="/api/v1/auth", tags=["auth"])
 app.include_router(users.router, prefix="/api/v1/users", tags=["users"])
 app.include_router(llm.router, prefix="/api/v1/llm", tags=["llm"])
 app.include_router(jobs.router, prefix="/api/v1/jobs", tags=["jobs"])
+app.include_router(usage_api.router, prefix="/api/v1/usage", tags=["usage"])
+
+
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape endpoint (per-process API metrics plus cluster-wide Celery task durations and queue depth)."""
+    if not settings.METRICS_ENABLED:
+        return PlainTextResponse("Metrics are disabled.\n", status_code=404)
+    from app.services.llm_router import get_llm_router
+    from app.services.llm_limiter import render_limiter_metrics
+    sections = [
+        render_process_info(),
+        render_router_metrics(get_llm_router().stats()),
+        render_limiter_metrics(),
+        render_celery_metrics(),
+        render_celery_queue_metrics(),
+    ]
+    return PlainTextResponse(render_metrics(sections), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/")
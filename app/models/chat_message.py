@@ -0,0 +1,20 @@
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Text
+from app.db.models import Base
+
+
+class ChatMessage(Base):
+    """
+    Archived chat messages (cold tier). On PostgreSQL the table is partitioned by
+    month of `created_at` and `content` is compressed (see app/services/chat_archive.py).
+    `seq` orders messages within a session and is unique per session.
+    """
+    __tablename__ = "chat_messages"
+    # A partitioned table's primary key must include the partition column
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
+
+    user_id = Column(Integer, primary_key=True)
+    session_id = Column(String, primary_key=True)
+    seq = Column(BigInteger, primary_key=True)
+    created_at = Column(DateTime, primary_key=True)
+    role = Column(String, nullable=False)
+    content = Column(Text, nullable=False)
@@ -0,0 +1,29 @@
+from datetime import datetime
+from sqlalchemy import BigInteger, Column, Date, DateTime, Integer, String
+from app.db.models import Base
+
+
+class UsageRecord(Base):
+    """
+    LLM usage per user, feature and day (UTC). Rows are only ever incremented, in
+    bulk, by the usage flusher (see app/services/usage.py).
+    """
+    __tablename__ = "llm_usage"
+
+    user_id = Column(Integer, primary_key=True)
+    feature = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    requests = Column(BigInteger, nullable=False, default=0)
+    input_tokens = Column(BigInteger, nullable=False, default=0)
+    output_tokens = Column(BigInteger, nullable=False, default=0)
+    cached_tokens = Column(BigInteger, nullable=False, default=0)
+    tool_rounds = Column(BigInteger, nullable=False, default=0)
+    embedding_tokens = Column(BigInteger, nullable=False, default=0)
+
+
+class UsageFlush(Base):
+    """Flush batches already added to llm_usage, so a retried batch is not counted twice."""
+    __tablename__ = "llm_usage_flushes"
+
+    batch_id = Column(String, primary_key=True)
+    flushed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
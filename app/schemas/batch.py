@@ -0,0 +1,43 @@
+# app/schemas/batch.py
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field, model_validator
+
+
+class BatchMessage(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str
+
+
+class BatchItem(BaseModel):
+    custom_id: Optional[str] = Field(None, max_length=128, description="Echoed on the item's result line")
+    prompt: Optional[str] = Field(None, description="A single user message")
+    messages: Optional[List[BatchMessage]] = Field(None, description="A conversation, instead of `prompt`")
+
+    @model_validator(mode="after")
+    def one_input(self):
+        if (self.prompt is None) == (not self.messages):
+            raise ValueError("Give exactly one of `prompt` and `messages`.")
+        return self
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem] = Field(..., min_length=1, description="Answered independently, without chat history")
+    system_instruction: Optional[str] = Field(None, description="Shared by every item")
+
+
+class BatchJob(BaseModel):
+    job_id: str
+    status: str = Field(..., description="queued, running, completed, cancelled or failed")
+    total: int
+    succeeded: int
+    failed: int = Field(..., description="Items that failed after every retry")
+    pending: int
+    input_tokens: int
+    output_tokens: int
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    items_per_s: Optional[float] = None
+    eta_s: Optional[float] = Field(None, description="Estimated seconds left, at the rate so far")
+    error: Optional[str] = Field(None, description="Why a failed job stopped early")
+    results_url: str = Field(..., description="JSONL results, downloadable while the job runs")
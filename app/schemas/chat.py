@@ -1,7 +1,26 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
 
 class ChatRequest(BaseModel):
     message: str = Field(..., description="The users message to the assistant")
     session_id: Optional[str] = Field(None, description="The id for the chat session")
-    use_rag: Optional[bool] = Field(True, description="Whether to use RAG for this request")
\ No newline at end of file
+    use_rag: Optional[bool] = Field(True, description="Whether to use RAG for this request")
+
+class ChatTurn(BaseModel):
+    """A "chat" frame on the WebSocket (see app/services/ws_chat.py)."""
+    turn_id: str = Field(..., min_length=1, max_length=64, description="Client-chosen id, echoed on every event of the turn")
+    session_id: str = Field(..., min_length=1, description="The id for the chat session")
+    message: str = Field(..., description="The users message to the assistant")
+    use_rag: bool = Field(True, description="Whether to use RAG for this request")
+    enable_tools: bool = Field(True, description="Enable Function Calling for tool use")
+
+
+class HistoryMessage(BaseModel):
+    role: str
+    content: str
+    seq: int = Field(..., description="Position in the session; pass as `before` to page backwards")
+
+
+class HistoryPage(BaseModel):
+    messages: List[HistoryMessage] = Field(..., description="Oldest first")
+    next_before: Optional[int] = Field(None, description="Cursor for the next, older page (None at the start)")
@@ -0,0 +1,32 @@
+# app/schemas/usage.py
+from datetime import date, datetime
+from typing import Dict, List, Optional
+from pydantic import BaseModel, Field
+
+
+class UsageCounts(BaseModel):
+    requests: int = 0
+    input_tokens: int = Field(0, description="Prompt tokens, cached ones included")
+    output_tokens: int = 0
+    cached_tokens: int = Field(0, description="Prompt tokens served from a prompt cache")
+    tool_rounds: int = 0
+    embedding_tokens: int = Field(0, description="Estimated (4 characters per token)")
+
+
+class DailyUsage(UsageCounts):
+    day: date
+    feature: str
+    users: Optional[int] = Field(None, description="Distinct users (service-wide reports only)")
+
+
+class QuotaStatus(BaseModel):
+    used: int
+    limit: int = Field(..., description="0 means unlimited")
+    resets_at: datetime
+
+
+class UsageReport(BaseModel):
+    since: date
+    daily: List[DailyUsage]
+    by_feature: Dict[str, UsageCounts]
+    quota: Optional[Dict[str, QuotaStatus]] = Field(None, description="Per-user reports: daily and monthly quota")
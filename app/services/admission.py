@@ -0,0 +1,297 @@
+# app/services/admission.py
+
+"""
+Admission control for expensive endpoints (chat, uploads, jobs, batches).
+
+All state lives in Redis and every decision is a single Lua script, so the
+limits hold across all gunicorn workers without races:
+
+- Rate limits: per-user token buckets counted in requests and in LLM tokens.
+  The request bucket is charged on admission; the LLM token bucket must have a
+  positive balance to start, and is charged with the actual usage afterwards
+  (`charge_llm_tokens`), so one long answer can put a user into debt.
+- Quotas: chat, uploads and batches are refused while the user is over a daily or
+  monthly token quota (usage.py), until the period ends.
+- Concurrency: at most ADMISSION_USER_CONCURRENCY in-flight requests per user
+  and ADMISSION_GLOBAL_CONCURRENCY in total. Slots are leases with an expiry,
+  so a crashed worker cannot leak them.
+- Waiting: when the global limit is reached, requests wait in a bounded queue
+  ordered by priority (interactive chat before background work), then arrival.
+  Background work may only fill half of the queue.
+
+Anything that cannot be admitted fails fast with 429 and a Retry-After header.
+Without Redis admission control is disabled. `admit()` runs on the event loop,
+so it polls with the asyncio client and does the rate limit checks in the
+threadpool; a saturated service must not also stall the loop.
+"""
+
+import asyncio
+import logging
+import math
+import time
+import uuid
+from typing import Iterable, Iterator, Optional
+
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.core.metrics import Counter, REGISTRY, timed
+from app.db.redis_client import get_async_redis, get_async_script, get_redis, get_script
+from app.services import usage
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+KIND_PRIORITY = {
+    "chat": PRIORITY_INTERACTIVE,
+    "upload": PRIORITY_BACKGROUND,
+    "job": PRIORITY_BACKGROUND,
+    "batch": PRIORITY_BACKGROUND,
+}
+
+USER_INFLIGHT_KEY = "admission:inflight:user:{user_id}"
+GLOBAL_INFLIGHT_KEY = "admission:inflight:global"
+QUEUE_KEY = "admission:queue"
+QUEUE_DEADLINE_KEY = "admission:queue_deadline"
+REQUEST_BUCKET_KEY = "admission:bucket:requests:{user_id}"
+TOKEN_BUCKET_KEY = "admission:bucket:llm_tokens:{user_id}"
+
+# Waiters poll at this interval; a waiter that misses a few polls is dropped from the queue
+POLL_INTERVAL_S = 0.05
+WAITER_GRACE_MS = 2000
+
+# KEYS: user inflight, global inflight, queue, queue deadlines
+# ARGV: lease id, now ms, lease ttl ms, user limit, global limit, queue max, priority, waiter grace ms
+# Returns {1} admitted, {0, reason} rejected, {-1, position} waiting.
+_ACQUIRE_SCRIPT = """
+local lease, now = ARGV[1], tonumber(ARGV[2])
+local priority = tonumber(ARGV[7])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+for _, stale in ipairs(redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now)) do
+    redis.call('ZREM', KEYS[3], stale)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', now)
+
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    redis.call('ZREM', KEYS[3], lease)
+    redis.call('ZREM', KEYS[4], lease)
+    return {0, 'user_concurrency'}
+end
+
+if not redis.call('ZSCORE', KEYS[3], lease) then
+    local queued = redis.call('ZCARD', KEYS[3])
+    local room = tonumber(ARGV[6])
+    if priority > 0 then room = math.floor(room / 2) end
+    if queued >= room then
+        return {0, 'queue_full'}
+    end
+    -- Ordered by priority, then arrival
+    redis.call('ZADD', KEYS[3], priority * 1e13 + now, lease)
+end
+
+local free = tonumber(ARGV[5]) - redis.call('ZCARD', KEYS[2])
+local position = redis.call('ZRANK', KEYS[3], lease)
+if position < free then
+    redis.call('ZREM', KEYS[3], lease)
+    redis.call('ZREM', KEYS[4], lease)
+    local expires = now + tonumber(ARGV[3])
+    redis.call('ZADD', KEYS[1], expires, lease)
+    redis.call('ZADD', KEYS[2], expires, lease)
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+    return {1}
+end
+redis.call('ZADD', KEYS[4], now + tonumber(ARGV[8]), lease)
+return {-1, position}
+"""
+
+# KEYS: bucket hash
+# ARGV: capacity, refill per ms, cost, now ms, key ttl ms, mode
+#   "take": needs `cost` available and removes it; "check": needs it but removes nothing;
+#   "debit": always removes it, the balance may go negative
+# Returns {allowed, wait ms} as strings (Lua numbers would be truncated to integers).
+_TOKEN_BUCKET_SCRIPT = """
+local capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local cost, now = tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local mode = ARGV[6]
+local allowed, wait = 1, 0
+if mode ~= 'debit' and tokens < cost then
+    allowed = 0
+    wait = (cost - tokens) / rate
+elseif mode ~= 'check' then
+    tokens = tokens - cost
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', ARGV[4])
+redis.call('PEXPIRE', KEYS[1], ARGV[5])
+return {tostring(allowed), tostring(wait)}
+"""
+
+admission_decisions_total = Counter(
+    "admission_decisions_total",
+    "Admission control decisions by request kind and result.",
+    labelnames=("kind", "result"),
+)
+REGISTRY.append(admission_decisions_total)
+
+
+class AdmissionRejected(HTTPException):
+    """429 with a Retry-After header; raised when a request cannot be admitted."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many requests ({reason}). Retry later.",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+        self.reason = reason
+
+
+class Lease:
+    """A held concurrency slot. `release()` is idempotent."""
+
+    def __init__(self, user_id, lease_id: str):
+        self.user_id = user_id
+        self.lease_id = lease_id
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.zrem(USER_INFLIGHT_KEY.format(user_id=self.user_id), self.lease_id)
+        pipe.zrem(GLOBAL_INFLIGHT_KEY, self.lease_id)
+        try:
+            pipe.execute()
+        except Exception:
+            # The lease expires on its own
+            logger.exception("Could not release admission lease %s", self.lease_id)
+
+
+def is_enabled() -> bool:
+    return settings.ADMISSION_ENABLED and get_redis() is not None
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _take_from_bucket(key: str, capacity: float, per_min: float, cost: float, mode: str = "take") -> float:
+    """Runs the token bucket script; returns 0 if allowed, else the seconds until it would be."""
+    rate_per_ms = per_min / 60000
+    # An idle bucket refills within capacity / rate (twice that leaves room for token debt)
+    ttl_ms = int(2 * capacity / rate_per_ms) + 1000
+    allowed, wait_ms = get_script(_TOKEN_BUCKET_SCRIPT)(
+        keys=[key], args=[capacity, rate_per_ms, cost, _now_ms(), ttl_ms, mode]
+    )
+    return 0.0 if allowed == "1" else float(wait_ms) / 1000
+
+
+def _check_rate_limits(user_id, kind: str):
+    if kind in ("chat", "upload", "batch"):
+        exceeded = usage.quota_exceeded(user_id)
+        if exceeded:
+            period, retry_after = exceeded
+            admission_decisions_total.inc(kind=kind, result="rejected_quota")
+            raise AdmissionRejected(f"{period} token quota exceeded", retry_after)
+
+    if settings.RATE_LIMIT_REQUESTS_PER_MIN > 0:
+        wait = _take_from_bucket(
+            REQUEST_BUCKET_KEY.format(user_id=user_id),
+            settings.RATE_LIMIT_REQUESTS_BURST,
+            settings.RATE_LIMIT_REQUESTS_PER_MIN,
+            cost=1,
+        )
+        if wait:
+            admission_decisions_total.inc(kind=kind, result="rejected_request_rate")
+            raise AdmissionRejected("request rate limit", wait)
+
+    if kind == "chat" and settings.RATE_LIMIT_LLM_TOKENS_PER_MIN > 0:
+        # The answer's size is unknown yet: only require that the user is not in token debt
+        wait = _take_from_bucket(
+            TOKEN_BUCKET_KEY.format(user_id=user_id),
+            settings.RATE_LIMIT_LLM_TOKENS_BURST,
+            settings.RATE_LIMIT_LLM_TOKENS_PER_MIN,
+            cost=1,
+            mode="check",
+        )
+        if wait:
+            admission_decisions_total.inc(kind=kind, result="rejected_token_rate")
+            raise AdmissionRejected("LLM token rate limit", wait)
+
+
+def charge_llm_tokens(user_id, tokens: int):
+    """Charges actual LLM usage to the user's token bucket once it is known."""
+    if not tokens or not is_enabled() or settings.RATE_LIMIT_LLM_TOKENS_PER_MIN <= 0:
+        return
+    try:
+        _take_from_bucket(
+            TOKEN_BUCKET_KEY.format(user_id=user_id),
+            settings.RATE_LIMIT_LLM_TOKENS_BURST,
+            settings.RATE_LIMIT_LLM_TOKENS_PER_MIN,
+            cost=tokens,
+            mode="debit",
+        )
+    except Exception:
+        logger.exception("Could not charge %s LLM tokens to user %s", tokens, user_id)
+
+
+async def admit(user_id, kind: str) -> Optional[Lease]:
+    """
+    Admits a request of `kind` ("chat", "upload", "job", "batch") for `user_id`, waiting in
+    the priority queue if the service is saturated. Returns the Lease to release
+    when the work is done (None when admission control is disabled), or raises
+    AdmissionRejected.
+    """
+    if not is_enabled():
+        return None
+
+    with timed("admission"):
+        # Quota and bucket checks are several sync calls; made once per request
+        await run_in_threadpool(_check_rate_limits, user_id, kind)
+
+        lease_id = uuid.uuid4().hex
+        keys = [USER_INFLIGHT_KEY.format(user_id=user_id), GLOBAL_INFLIGHT_KEY, QUEUE_KEY, QUEUE_DEADLINE_KEY]
+        deadline = time.monotonic() + settings.ADMISSION_QUEUE_TIMEOUT_S
+        waited = False
+        while True:
+            result = await get_async_script(_ACQUIRE_SCRIPT)(keys=keys, args=[
+                lease_id,
+                _now_ms(),
+                int(settings.ADMISSION_LEASE_TTL_S * 1000),
+                settings.ADMISSION_USER_CONCURRENCY,
+                settings.ADMISSION_GLOBAL_CONCURRENCY,
+                settings.ADMISSION_QUEUE_MAX,
+                KIND_PRIORITY.get(kind, PRIORITY_BACKGROUND),
+                WAITER_GRACE_MS,
+            ])
+            outcome = int(result[0])
+            if outcome == 1:
+                admission_decisions_total.inc(kind=kind, result="queued" if waited else "admitted")
+                return Lease(user_id, lease_id)
+            if outcome == 0:
+                admission_decisions_total.inc(kind=kind, result=f"rejected_{result[1]}")
+                raise AdmissionRejected(result[1].replace("_", " "), settings.ADMISSION_RETRY_AFTER_S)
+            if time.monotonic() >= deadline:
+                await get_async_redis().zrem(QUEUE_KEY, lease_id)
+                admission_decisions_total.inc(kind=kind, result="rejected_queue_timeout")
+                raise AdmissionRejected("queue timeout", settings.ADMISSION_RETRY_AFTER_S)
+            waited = True
+            await asyncio.sleep(POLL_INTERVAL_S)
+
+
+def release_after(events: Iterable, lease: Optional[Lease]) -> Iterator:
+    """Passes `events` through and releases `lease` once the stream ends or is closed."""
+    try:
+        yield from events
+    finally:
+        if lease is not None:
+            lease.release()
@@ -0,0 +1,433 @@
+# app/services/batch_service.py
+
+"""
+Batch generation jobs: thousands of independent prompts, answered offline.
+
+A job skips everything the interactive path does per turn: no history, no
+profile lookup, no profile update, no RAG. The API writes the prompts to
+`BATCH_DIR/<job_id>/input.jsonl` and queues one `batch_generate` task on the
+`long` queue. Job state and progress are kept in a Redis hash,
+`batch_job:<job_id>`.
+
+The task keeps BATCH_CONCURRENCY upstream calls in flight and reads the input
+lazily to refill them. Every call runs at background priority, so it takes a
+slot from the shared LLM limiter that interactive chat can never be starved of.
+The limiter's limit adapts to upstream throttling, which keeps the job at the
+highest rate the quota sustains. A failed call is retried up to
+BATCH_MAX_ATTEMPTS times with exponential backoff. After that it is recorded as
+failed and the job goes on.
+
+Results are written in micro-batches. Every BATCH_MICRO_BATCH_SIZE results, or
+every BATCH_FLUSH_INTERVAL_S, they are appended to `results.jsonl` in one write.
+The progress counters are then updated in one Redis round trip. Result lines
+come in completion order and carry the prompt's `index` and `custom_id`. While
+the job runs, the results are downloadable up to the last complete line.
+
+The artifact doubles as the checkpoint. A task that was redelivered, or that
+requeued itself after BATCH_SLICE_S (under the Celery time limit), skips every
+index already in it. A job is stopped between micro-batches when it is
+cancelled, or when its user goes over a token quota. Any other error fails the
+job (with `error` set) and frees its slot among the user's
+BATCH_MAX_ACTIVE_JOBS_PER_USER; only Redis errors are left to the task to retry.
+"""
+
+import logging
+import os
+import random
+import shutil
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import orjson
+from fastapi import HTTPException, status
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.logging_config import bind_log_context
+from app.core.metrics import Counter, REGISTRY
+from app.db.redis_client import get_redis, get_script
+from app.services import usage
+from app.services.llm_limiter import background_priority, get_llm_limiter
+from app.services.llm_provider import get_llm_provider
+from app.services.prompt_cache import format_for_gemini
+
+logger = logging.getLogger(__name__)
+
+JOB_KEY = "batch_job:{job_id}"
+ACTIVE_JOBS_KEY = "batch_jobs:active:{user_id}"
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+CANCELLED = "cancelled"
+FAILED = "failed"
+FINISHED = (COMPLETED, CANCELLED, FAILED)
+
+INPUT_FILE = "input.jsonl"
+RESULTS_FILE = "results.jsonl"
+READ_CHUNK_BYTES = 64 * 1024
+
+# Takes one of the user's active-job slots, if one is free
+# KEYS: active jobs set; ARGV: job id, max active jobs. Returns 1 if taken, else 0
+_RESERVE_SCRIPT = """
+if redis.call('SCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+return 1
+"""
+
+batch_items_total = Counter(
+    "batch_items_total",
+    "Batch generation prompts by result (succeeded/failed/retried).",
+    ("result",),
+)
+REGISTRY.append(batch_items_total)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _job_dir(job_id: str) -> str:
+    return os.path.join(os.path.abspath(settings.BATCH_DIR), job_id)
+
+
+def results_path(job_id: str) -> str:
+    return os.path.join(_job_dir(job_id), RESULTS_FILE)
+
+
+def _require_redis():
+    redis_client = get_redis()
+    if not redis_client:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Batch jobs are unavailable.")
+    return redis_client
+
+
+"""
+API side
+"""
+
+
+def create_job(user_id, items: List[Dict], system_instruction: Optional[str] = None) -> Dict:
+    """Writes the job's input, records it as queued and enqueues the task. Returns the job's status."""
+    redis_client = _require_redis()
+    if len(items) > settings.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"A batch holds at most {settings.BATCH_MAX_ITEMS} prompts.")
+    active_key = ACTIVE_JOBS_KEY.format(user_id=user_id)
+    _forget_finished(redis_client, active_key)
+    _prune_expired(redis_client)
+
+    job_id = uuid.uuid4().hex
+    key = JOB_KEY.format(job_id=job_id)
+    # Recorded before it takes a slot, so a concurrent _forget_finished does not drop it
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping={
+        "user_id": str(user_id),
+        "status": QUEUED,
+        "total": len(items),
+        "succeeded": 0,
+        "failed": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "system_instruction": system_instruction or "",
+        "created_at": _now(),
+    })
+    pipe.expire(key, settings.BATCH_RETENTION_S)
+    pipe.execute()
+    if not int(get_script(_RESERVE_SCRIPT)(keys=[active_key], args=[job_id, settings.BATCH_MAX_ACTIVE_JOBS_PER_USER])):
+        redis_client.delete(key)
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many batch jobs in progress; wait for one to finish.")
+
+    try:
+        os.makedirs(_job_dir(job_id))
+        with open(os.path.join(_job_dir(job_id), INPUT_FILE), "wb") as f:
+            f.write(b"".join(
+                orjson.dumps({"index": index, **item}) + b"\n" for index, item in enumerate(items)
+            ))
+        open(results_path(job_id), "wb").close()
+
+        # The task module (and Celery) is imported on first use
+        from app.workers.tasks import batch_generate_task
+        batch_generate_task.delay(job_id)
+    except Exception as e:
+        BatchRunner(job_id).fail(f"Could not queue the job: {type(e).__name__}: {e}", user_id)
+        raise
+    return get_job(user_id, job_id)
+
+
+def _forget_finished(redis_client, active_key: str):
+    """Drops jobs that finished or expired without leaving the active set (a worker died at the wrong time)."""
+    for job_id in redis_client.smembers(active_key):
+        if redis_client.hget(JOB_KEY.format(job_id=job_id), "status") in (None, *FINISHED):
+            redis_client.srem(active_key, job_id)
+
+
+def _prune_expired(redis_client):
+    """Removes the files of jobs whose Redis record has expired."""
+    root = os.path.abspath(settings.BATCH_DIR)
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - settings.BATCH_RETENTION_S
+    for job_id in os.listdir(root):
+        path = os.path.join(root, job_id)
+        if os.path.getmtime(path) < cutoff and not redis_client.exists(JOB_KEY.format(job_id=job_id)):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _load_job(user_id, job_id: str) -> Dict[str, str]:
+    job = _require_redis().hgetall(JOB_KEY.format(job_id=job_id))
+    # Someone else's job is reported as missing, like one that never existed
+    if not job or job.get("user_id") != str(user_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Batch job not found.")
+    return job
+
+
+def get_job(user_id, job_id: str) -> Dict:
+    """The job's status and progress, with a throughput-based estimate of the time left."""
+    job = _load_job(user_id, job_id)
+    total, succeeded, failed = int(job["total"]), int(job["succeeded"]), int(job["failed"])
+    done = succeeded + failed
+    items_per_s = eta_s = None
+    if job.get("started_at") and done:
+        finished_at = datetime.fromisoformat(job["finished_at"]) if job.get("finished_at") else datetime.now(timezone.utc)
+        elapsed = (finished_at - datetime.fromisoformat(job["started_at"])).total_seconds()
+        if elapsed > 0:
+            items_per_s = round(done / elapsed, 2)
+            if job["status"] not in FINISHED:
+                eta_s = round((total - done) * elapsed / done, 1)
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "total": total,
+        "succeeded": succeeded,
+        "failed": failed,
+        "pending": total - done,
+        "input_tokens": int(job["input_tokens"]),
+        "output_tokens": int(job["output_tokens"]),
+        "created_at": job["created_at"],
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+        "items_per_s": items_per_s,
+        "eta_s": eta_s,
+        "error": job.get("error"),
+        "results_url": f"/api/v1/jobs/batch/{job_id}/results",
+    }
+
+
+def cancel_job(user_id, job_id: str) -> Dict:
+    """Asks the job to stop. Calls in flight finish and their results are kept."""
+    job = _load_job(user_id, job_id)
+    if job["status"] not in FINISHED:
+        _require_redis().hset(JOB_KEY.format(job_id=job_id), "cancel_requested", 1)
+    return get_job(user_id, job_id)
+
+
+def read_results(user_id, job_id: str) -> Iterator[bytes]:
+    """The job's results so far, up to the last complete line. Checks access before the first chunk."""
+    _load_job(user_id, job_id)
+    path = results_path(job_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Batch results are no longer available.")
+    return _complete_lines(path, os.path.getsize(path))
+
+
+def _complete_lines(path: str, size: int) -> Iterator[bytes]:
+    carry = b""
+    with open(path, "rb") as f:
+        while size > 0:
+            data = f.read(min(READ_CHUNK_BYTES, size))
+            if not data:
+                break
+            size -= len(data)
+            chunk = carry + data
+            end = chunk.rfind(b"\n") + 1
+            carry = chunk[end:]
+            if end:
+                yield chunk[:end]
+    # A trailing partial line is still being written
+
+
+"""
+Worker side
+"""
+
+
+def _contents(item: Dict) -> List[Dict]:
+    if item.get("messages"):
+        return [format_for_gemini(message) for message in item["messages"]]
+    return [format_for_gemini({"role": "user", "content": item["prompt"]})]
+
+
+def _generate(item: Dict, system_instruction: Optional[str], user_id: str) -> Dict:
+    """Answers one prompt, retrying with backoff. Runs on a pool thread; never raises."""
+    result = {"index": item["index"], "custom_id": item.get("custom_id")}
+    for attempt in range(1, settings.BATCH_MAX_ATTEMPTS + 1):
+        try:
+            # Pool threads start with an empty context: set the priority here
+            with background_priority(), get_llm_limiter().acquire():
+                text, call_usage = get_llm_provider().generate_with_usage(_contents(item), system_instruction)
+        except Exception as e:
+            if attempt < settings.BATCH_MAX_ATTEMPTS:
+                batch_items_total.inc(result="retried")
+                time.sleep(min(30.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+                continue
+            batch_items_total.inc(result="failed")
+            return {**result, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+        usage.record_usage(
+            user_id, usage.FEATURE_BATCH,
+            requests=1,
+            input_tokens=call_usage.get("input_tokens", 0),
+            output_tokens=call_usage.get("output_tokens", 0),
+            cached_tokens=call_usage.get("cached_tokens", 0),
+        )
+        batch_items_total.inc(result="succeeded")
+        return {**result, "status": "succeeded", "response": text, "usage": call_usage}
+
+
+def _checkpoint(path: str) -> Tuple[Set[int], Dict[str, int]]:
+    """Indexes already in the artifact, and the counters they add up to. Drops a torn last line."""
+    done: Set[int] = set()
+    totals = {"succeeded": 0, "failed": 0, "input_tokens": 0, "output_tokens": 0}
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        result = orjson.loads(line)
+        done.add(result["index"])
+        totals[result["status"]] += 1
+        totals["input_tokens"] += (result.get("usage") or {}).get("input_tokens", 0)
+        totals["output_tokens"] += (result.get("usage") or {}).get("output_tokens", 0)
+    return done, totals
+
+
+def _pending_items(job_id: str, done: Set[int]) -> Iterator[Dict]:
+    with open(os.path.join(_job_dir(job_id), INPUT_FILE), "rb") as f:
+        for line in f:
+            item = orjson.loads(line)
+            if item["index"] not in done:
+                yield item
+
+
+class BatchRunner:
+    """Runs one slice of a job inside the batch_generate task."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.key = JOB_KEY.format(job_id=job_id)
+        self.redis = get_redis()
+
+    def run(self) -> bool:
+        """Works on the job for up to BATCH_SLICE_S. Returns True if it should be requeued to continue."""
+        job = self.redis.hgetall(self.key)
+        if not job or job["status"] in FINISHED:
+            return False  # Expired, or a duplicate delivery of a finished job
+        user_id = job["user_id"]
+        bind_log_context(user_id=user_id)
+        if job.get("cancel_requested"):
+            self._finish(user_id, CANCELLED)
+            return False
+
+        try:
+            done, totals = _checkpoint(results_path(self.job_id))
+            # Recounted from the artifact, so a redelivered task does not count anything twice
+            self.redis.hset(self.key, mapping={**totals, "status": RUNNING, "started_at": job.get("started_at") or _now()})
+            stop_reason = self._dispatch(user_id, job.get("system_instruction") or None, done)
+        except RedisError:
+            raise  # Transient: the task retries, and resumes from the artifact
+        except Exception as e:
+            # Missing files, a malformed input line...: retrying would fail the same way
+            logger.exception("Batch job %s failed", self.job_id)
+            self._finish(user_id, FAILED, error=f"{type(e).__name__}: {e}")
+            return False
+
+        if stop_reason == "slice":
+            return True
+        if stop_reason == "cancelled":
+            self._finish(user_id, CANCELLED)
+        elif stop_reason:
+            self._finish(user_id, FAILED, error=stop_reason)
+        else:
+            self._finish(user_id, COMPLETED)
+        return False
+
+    def _dispatch(self, user_id: str, system_instruction: Optional[str], done: Set[int]) -> Optional[str]:
+        """Keeps BATCH_CONCURRENCY calls in flight until the input runs out. Returns why it stopped early, if it did."""
+        items = _pending_items(self.job_id, done)
+        deadline = time.monotonic() + settings.BATCH_SLICE_S
+        buffered: List[Dict] = []
+        last_flush = time.monotonic()
+        stop_reason = None
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=settings.BATCH_CONCURRENCY, thread_name_prefix="batch") as pool, \
+                open(results_path(self.job_id), "ab") as out:
+            while True:
+                while stop_reason is None and len(in_flight) < settings.BATCH_CONCURRENCY:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    in_flight.add(pool.submit(_generate, item, system_instruction, user_id))
+                if not in_flight:
+                    break
+                finished, in_flight = wait(in_flight, timeout=settings.BATCH_FLUSH_INTERVAL_S,
+                                           return_when=FIRST_COMPLETED)
+                buffered.extend(future.result() for future in finished)
+                if (len(buffered) >= settings.BATCH_MICRO_BATCH_SIZE
+                        or time.monotonic() - last_flush >= settings.BATCH_FLUSH_INTERVAL_S):
+                    self._flush(out, buffered)
+                    buffered, last_flush = [], time.monotonic()
+                    # Checked between micro-batches; calls in flight are finished and kept
+                    stop_reason = stop_reason or self._should_stop(user_id, deadline)
+            self._flush(out, buffered)
+        return stop_reason
+
+    def _flush(self, out, results: List[Dict]):
+        if not results:
+            return
+        out.write(b"".join(orjson.dumps(result) + b"\n" for result in results))
+        out.flush()
+        os.fsync(out.fileno())
+        pipe = self.redis.pipeline()
+        for result_status in ("succeeded", "failed"):
+            count = sum(1 for result in results if result["status"] == result_status)
+            if count:
+                pipe.hincrby(self.key, result_status, count)
+        for field in ("input_tokens", "output_tokens"):
+            pipe.hincrby(self.key, field, sum((result.get("usage") or {}).get(field, 0) for result in results))
+        pipe.execute()
+
+    def _should_stop(self, user_id: str, deadline: float) -> Optional[str]:
+        if self.redis.hget(self.key, "cancel_requested"):
+            return "cancelled"
+        exceeded = usage.quota_exceeded(user_id)
+        if exceeded:
+            return f"{exceeded[0]} token quota exceeded"
+        if time.monotonic() >= deadline:
+            return "slice"
+        return None
+
+    def fail(self, error: str, user_id=None):
+        """Marks the job failed and frees its active slot. Best effort: logs instead of raising."""
+        try:
+            user_id = user_id if user_id is not None else self.redis.hget(self.key, "user_id")
+            self._finish(str(user_id), FAILED, error=error)
+        except Exception:
+            logger.exception("Could not mark batch job %s as failed", self.job_id)
+
+    def _finish(self, user_id: str, final_status: str, error: Optional[str] = None):
+        mapping = {"status": final_status, "finished_at": _now()}
+        if error:
+            mapping["error"] = error
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key, mapping=mapping)
+        pipe.expire(self.key, settings.BATCH_RETENTION_S)
+        pipe.srem(ACTIVE_JOBS_KEY.format(user_id=user_id), self.job_id)
+        pipe.execute()
+        logger.info("Batch job %s %s", self.job_id, final_status)
@@ -0,0 +1,235 @@
+# app/services/chat_archive.py
+
+"""
+Cold tier of the chat history: the `chat_messages` table.
+
+Write-behind: add_message_to_history() only appends to a Redis Stream outbox
+(same script as the hot list, so one round trip). A background thread in every
+API process reads the outbox through a consumer group. It writes up to
+CHAT_ARCHIVE_BATCH_SIZE messages per bulk INSERT, once per
+CHAT_ARCHIVE_FLUSH_INTERVAL_S, or right away while full batches are waiting.
+Entries are acknowledged only after the insert commits. Entries left
+unacknowledged by a process that died (or whose insert failed) are claimed
+again after CHAT_ARCHIVE_CLAIM_IDLE_S. The insert ignores rows that already
+exist, so a redelivered batch is harmless.
+
+On PostgreSQL the table is partitioned by month, so old months can be detached
+or dropped cheaply. `content` is compressed with lz4 (PostgreSQL 14+), and
+toast_tuple_target is lowered so that ordinary-sized messages are compressed
+too, not only those above the ~2 kB default.
+"""
+
+import logging
+import os
+import socket
+import threading
+from datetime import date
+from typing import Dict, List, Optional
+
+from redis.exceptions import ResponseError
+from sqlalchemy import select, text
+from sqlalchemy.exc import DBAPIError
+
+from app.core.config import settings
+from app.core.metrics import Counter, REGISTRY, timed
+from app.db.database import IS_SQLITE, AsyncSessionLocal, SessionLocal, engine
+from app.db.redis_client import get_redis
+from app.models.chat_message import ChatMessage
+from app.services.chat_history import ARCHIVE_OUTBOX_KEY, message_seq, seq_time
+
+if IS_SQLITE:
+    from sqlalchemy.dialects.sqlite import insert
+else:
+    from sqlalchemy.dialects.postgresql import insert
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_GROUP = "chat_archivers"
+# Partitions are created this many months ahead of the current one
+PARTITION_MONTHS_AHEAD = 2
+# Rows of at least this many bytes are compressed (PostgreSQL's default is ~2 kB)
+TOAST_TUPLE_TARGET = 256
+
+ARCHIVED_MESSAGES = Counter(
+    "chat_archive_messages_total",
+    "Chat messages written to the archive table, by result.",
+    ("result",),
+)
+REGISTRY.append(ARCHIVED_MESSAGES)
+
+
+def _add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _ensure_partition(month: date):
+    name = f"{ChatMessage.__tablename__}_y{month.year}m{month.month:02d}"
+    statements = [
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {ChatMessage.__tablename__} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}') "
+        f"WITH (toast_tuple_target = {TOAST_TUPLE_TARGET})",
+        f"ALTER TABLE {name} ALTER COLUMN content SET COMPRESSION lz4",
+    ]
+    for statement in statements:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(statement))
+        except DBAPIError as e:
+            # Another process created it first, or lz4 is unavailable (pglz compression still applies)
+            logger.warning("Archive partition DDL skipped (%s): %s", name, e.orig)
+
+
+class ChatArchiver:
+    """Drains the outbox into the archive table on a daemon thread."""
+
+    def __init__(self):
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._group_ready = False
+        self._partitions = set()
+
+    def ensure_partitions(self, months=()):
+        """Creates the monthly partitions for `months` and the next few months (PostgreSQL only)."""
+        if IS_SQLITE:
+            return
+        current = date.today().replace(day=1)
+        wanted = {_add_months(current, offset) for offset in range(PARTITION_MONTHS_AHEAD + 1)} | set(months)
+        for month in sorted(wanted - self._partitions):
+            _ensure_partition(month)
+            self._partitions.add(month)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="chat-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stops the thread after a last flush, so a clean shutdown loses nothing."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        delay = settings.CHAT_ARCHIVE_FLUSH_INTERVAL_S
+        while not self._stop.wait(delay):
+            flushed = self._safe_flush()
+            # Keep going without waiting while full batches are queued
+            delay = 0 if flushed >= settings.CHAT_ARCHIVE_BATCH_SIZE else settings.CHAT_ARCHIVE_FLUSH_INTERVAL_S
+        self._safe_flush()
+
+    def _safe_flush(self) -> int:
+        try:
+            return self.flush_once()
+        except Exception:
+            logger.exception("Chat archive flush failed; the batch will be retried")
+            return 0
+
+    def _ensure_group(self, redis_client):
+        if self._group_ready:
+            return
+        try:
+            # From the start of the stream: messages queued before the first archiver started count too
+            redis_client.xgroup_create(ARCHIVE_OUTBOX_KEY, CONSUMER_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def flush_once(self) -> int:
+        """Archives one batch from the outbox. Returns the number of outbox entries handled."""
+        redis_client = get_redis()
+        if not redis_client:
+            return 0
+        self._ensure_group(redis_client)
+
+        batch = settings.CHAT_ARCHIVE_BATCH_SIZE
+        # First, entries some consumer read but never acknowledged
+        claimed = redis_client.xautoclaim(
+            ARCHIVE_OUTBOX_KEY, CONSUMER_GROUP, self.consumer,
+            min_idle_time=int(settings.CHAT_ARCHIVE_CLAIM_IDLE_S * 1000), start_id="0-0", count=batch,
+        )
+        entries = claimed[1]
+        if not entries:
+            response = redis_client.xreadgroup(CONSUMER_GROUP, self.consumer, {ARCHIVE_OUTBOX_KEY: ">"}, count=batch)
+            entries = response[0][1] if response else []
+        if not entries:
+            return 0
+
+        rows = []
+        for entry_id, fields in entries:
+            if not fields:
+                continue  # Trimmed from the outbox (CHAT_ARCHIVE_OUTBOX_MAXLEN) before it was archived
+            seq = message_seq(entry_id)
+            rows.append({
+                "user_id": int(fields["user_id"]),
+                "session_id": fields["session_id"],
+                "seq": seq,
+                "created_at": seq_time(seq),
+                "role": fields["role"],
+                "content": fields["content"],
+            })
+
+        if rows:
+            self.ensure_partitions({row["created_at"].date().replace(day=1) for row in rows})
+            try:
+                with timed("history_archive"), engine.begin() as conn:
+                    # One multi-row INSERT per batch; rows archived by an earlier delivery are skipped
+                    conn.execute(insert(ChatMessage).on_conflict_do_nothing(), rows)
+            except Exception:
+                ARCHIVED_MESSAGES.inc(len(rows), result="failed")
+                raise
+            ARCHIVED_MESSAGES.inc(len(rows), result="archived")
+
+        ids = [entry_id for entry_id, _ in entries]
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.xack(ARCHIVE_OUTBOX_KEY, CONSUMER_GROUP, *ids)
+        pipe.xdel(ARCHIVE_OUTBOX_KEY, *ids)
+        pipe.execute()
+        return len(entries)
+
+
+_archiver: Optional[ChatArchiver] = None
+
+
+def start_archiver():
+    """Lifespan startup: creates the partitions and starts this process's archiver thread."""
+    global _archiver
+    _archiver = ChatArchiver()
+    _archiver.ensure_partitions()
+    _archiver.start()
+
+
+def stop_archiver():
+    global _archiver
+    if _archiver is not None:
+        _archiver.stop()
+        _archiver = None
+
+
+def _archive_query(user_id, session_id: str, before: Optional[int], limit: int):
+    query = select(ChatMessage.seq, ChatMessage.role, ChatMessage.content).where(
+        ChatMessage.user_id == int(user_id), ChatMessage.session_id == session_id,
+    )
+    if before is not None:
+        # The time bound lets PostgreSQL skip the partitions of later months
+        query = query.where(ChatMessage.seq < before, ChatMessage.created_at <= seq_time(before))
+    return query.order_by(ChatMessage.seq.desc()).limit(limit)
+
+
+def _to_messages(rows) -> List[Dict]:
+    return [{"role": row.role, "content": row.content, "seq": row.seq} for row in reversed(rows)]
+
+
+def read_archived_messages(user_id, session_id: str, before: Optional[int] = None, limit: int = 50) -> List[Dict]:
+    """The `limit` newest archived messages older than `before`, oldest first (sync engine)."""
+    with timed("history_archive_read"), SessionLocal() as db:
+        return _to_messages(db.execute(_archive_query(user_id, session_id, before, limit)).all())
+
+
+async def read_archived_messages_async(user_id, session_id: str, before: Optional[int] = None,
+                                       limit: int = 50) -> List[Dict]:
+    """Same as read_archived_messages, on the async engine (API handlers)."""
+    with timed("history_archive_read"):
+        async with AsyncSessionLocal() as db:
+            return _to_messages((await db.execute(_archive_query(user_id, session_id, before, limit))).all())
@@ -1,28 +1,158 @@
+"""
+Chat history in two tiers.
+
+- Hot: the newest HISTORY_HOT_MAX_MESSAGES of each session, in a Redis list that
+  expires after HISTORY_HOT_TTL_S of inactivity. The chat path reads its context
+  window (HISTORY_CONTEXT_MESSAGES) from here.
+- Cold: every message, in the `chat_messages` table. Messages are not written
+  there on the chat path. Appending to the hot list also adds the message to a
+  Redis Stream outbox, in the same script, and chat_archive.py bulk-inserts
+  the outbox in the background.
+
+Each message gets the outbox entry id ("<ms>-<n>") as its id. It is unique and
+increases over time, so it doubles as the message's `seq` in the archive and as
+the pagination cursor of `get_history_page`.
+
+Entries written before ids existed ({"role", "content"} only) may still be in a
+hot list. They get their position in the list as seq. That is smaller than any
+real seq, so they sort first and page correctly, and they are never archived.
+"""
+
 import json
-from app.db.redis_client import redis_client
-from typing import List, Dict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+from app.db.redis_client import get_redis, get_script
 
 # Key template for storing history:
 HISTORY_KEY = "chat_history:{user_id}:{session_id}"
-MAX_HISTORY_LENGTH = 10 # Keep the last 10 messages (5 user, 5 assistant)
+ARCHIVE_OUTBOX_KEY = "chat_archive:outbox"
+
+# KEYS: history list, outbox stream
+# ARGV: user id, session id, role, content, hot max, hot ttl, outbox maxlen (0: archive disabled)
+_APPEND_SCRIPT = """
+local id
+if tonumber(ARGV[7]) > 0 then
+    id = redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[7], '*',
+        'user_id', ARGV[1], 'session_id', ARGV[2], 'role', ARGV[3], 'content', ARGV[4])
+else
+    local now = redis.call('TIME')
+    id = string.format('%d-%d', tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000), tonumber(now[2]) % 1000)
+end
+redis.call('RPUSH', KEYS[1], cjson.encode({id = id, role = ARGV[3], content = ARGV[4]}))
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[5]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return id
+"""
+
+# Refills an expired hot list from the archive, unless something was appended meanwhile
+_WARM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def message_seq(message_id: str) -> int:
+    """Archive sequence number of a message id ("<ms>-<n>"): ordered like the ids."""
+    ms, n = message_id.split("-")
+    return (int(ms) << 16) + int(n)
+
+
+def seq_time(seq: int) -> datetime:
+    """When the message with archive sequence `seq` was written (UTC, naive like the table column)."""
+    return datetime.fromtimestamp((seq >> 16) / 1000, tz=timezone.utc).replace(tzinfo=None)
 
-def get_session_history(user_id: str, session_id: str) -> List[Dict[str, str]]:
-    """Retrieves the chat history for a given user and session from Redis"""
+
+def _to_message(entry: str, position: int) -> Dict[str, str]:
+    """A hot-list entry as a message. `position` is its index in the list, the seq of legacy entries without id."""
+    message = json.loads(entry)
+    message_id = message.pop("id", None)
+    message["seq"] = message_seq(message_id) if message_id else position
+    return message
+
+
+def get_session_history(user_id: str, session_id: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
+    """
+    Retrieves the chat history for a given user and session from Redis: the last
+    `limit` messages (HISTORY_CONTEXT_MESSAGES by default).
+    """
+    redis_client = get_redis()
     if not redis_client:
         return []
 
+    limit = limit or settings.HISTORY_CONTEXT_MESSAGES
     key = HISTORY_KEY.format(user_id=user_id, session_id=session_id)
-    # LTRIM keeps the history size bounded (short-term memory window)
-    history_json = redis_client.lrange(key, -MAX_HISTORY_LENGTH, -1)
+    # Only the context window; older messages stay in the hot list for paging
+    pipe = redis_client.pipeline()
+    pipe.llen(key)
+    pipe.lrange(key, -limit, -1)
+    length, history_json = pipe.execute()
+    if not history_json and settings.CHAT_ARCHIVE_ENABLED:
+        return _warm_from_archive(key, user_id, session_id, limit)
+
+    first = length - len(history_json)
+    return [_to_message(msg, first + index) for index, msg in enumerate(history_json)]
+
 
-    return [json.loads(msg) for msg in history_json]
+def _warm_from_archive(key: str, user_id: str, session_id: str, limit: int) -> List[Dict[str, str]]:
+    """Cache miss (new or expired session): one archive query, then the hot list is refilled."""
+    from app.services.chat_archive import read_archived_messages
+    messages = read_archived_messages(user_id, session_id, limit=limit)
+    if messages:
+        entries = [
+            json.dumps({"id": f"{message['seq'] >> 16}-{message['seq'] & 0xFFFF}",
+                        "role": message["role"], "content": message["content"]})
+            for message in messages
+        ]
+        get_script(_WARM_SCRIPT)(keys=[key], args=[settings.HISTORY_HOT_TTL_S, *entries])
+    return messages
 
-def add_message_to_history(user_id: str, session_id: str, message: Dict[str, str]):
-    """Adds a message to the chat history for a given user and session in Redis"""
+
+def add_message_to_history(user_id: str, session_id: str, message: Dict[str, str]) -> Optional[str]:
+    """
+    Adds a message to the chat history for a given user and session in Redis and
+    queues it for the archive, in one round trip. Returns the message id.
+    """
+    redis_client = get_redis()
     if not redis_client:
-        return
+        return None
     key = HISTORY_KEY.format(user_id=user_id, session_id=session_id)
-    # LPUSH adds to the left (head). LTRIM can then easily keep the length bounded.
-    redis_client.rpush(key, json.dumps(message))
-    # Keep the list size bounded
-    redis_client.ltrim(key, -MAX_HISTORY_LENGTH, -1)
+    outbox_maxlen = settings.CHAT_ARCHIVE_OUTBOX_MAXLEN if settings.CHAT_ARCHIVE_ENABLED else 0
+    return get_script(_APPEND_SCRIPT)(
+        keys=[key, ARCHIVE_OUTBOX_KEY],
+        args=[user_id, session_id, message["role"], message["content"],
+              settings.HISTORY_HOT_MAX_MESSAGES, settings.HISTORY_HOT_TTL_S, outbox_maxlen],
+    )
+
+
+async def get_history_page(user_id: int, session_id: str, before: Optional[int] = None, limit: int = 50) -> Dict:
+    """
+    One page of a session's history, oldest first, ending just before message
+    `before` (the newest page if None). Served from the hot list and, for
+    anything older than it, from the archive.
+    """
+    hot = []
+    redis_client = get_redis()
+    if redis_client:
+        key = HISTORY_KEY.format(user_id=user_id, session_id=session_id)
+        hot = [_to_message(entry, index) for index, entry in enumerate(redis_client.lrange(key, 0, -1))]
+
+    page = [message for message in hot if before is None or message["seq"] < before][-limit:]
+    if len(page) < limit and settings.CHAT_ARCHIVE_ENABLED:
+        # The archive also holds the hot messages; only ask for what is older than all of them
+        boundary = before
+        if hot:
+            boundary = hot[0]["seq"] if before is None else min(before, hot[0]["seq"])
+        from app.services.chat_archive import read_archived_messages_async
+        page = await read_archived_messages_async(user_id, session_id, before=boundary, limit=limit - len(page)) + page
+
+    return {
+        "messages": page,
+        # Cursor for the next (older) page; None once the start of the session is reached
+        "next_before": page[0]["seq"] if len(page) == limit else None,
+    }
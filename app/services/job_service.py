@@ -1,9 +1,10 @@
 # app/services/job_service.py
-from app.workers.tasks import run_long_task
 import uuid
 
 def start_job():
     """Start a new job"""
+    # Imported on first use so the API boots without the Celery task module
+    from app.workers.tasks import run_long_task
     task_id = str(uuid.uuid4())
     # .delay() is a Celery method that schedules the task to run asynchronously
     task = run_long_task.delay(task_id)
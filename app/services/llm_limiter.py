@@ -0,0 +1,329 @@
+# app/services/llm_limiter.py
+
+"""
+Cluster-wide adaptive concurrency limit for upstream LLM calls.
+
+API workers (chat streams, hedges, RAG query embeddings) and Celery workers
+(profile updates, document embeddings) share one LLM quota. Every upstream call
+holds a slot from this limiter; the slots and the current limit live in Redis,
+so all processes see the same numbers.
+
+The limit follows AIMD:
+- additive increase: each healthy call (no error, time to first token under
+  LLM_LIMITER_LATENCY_TARGET_MS) adds 1/limit, i.e. +1 per `limit` healthy calls,
+  but only while at least half of the limit is actually in use;
+- multiplicative decrease: a throttled call (429 / RESOURCE_EXHAUSTED) multiplies
+  the limit by LLM_LIMITER_DECREASE_FACTOR, at most once per cooldown window so
+  one burst of 429s counts once.
+Slow calls and other errors hold the limit where it is.
+
+Background work (anything run inside `background_priority()`) may only use
+(1 - LLM_LIMITER_INTERACTIVE_RESERVE) of the limit, so /chat always has room.
+"""
+
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Dict, Optional
+
+from app.core.config import settings
+from app.core.metrics import Counter, REGISTRY
+from app.db.redis_client import get_redis, get_script
+from app.services.llm_provider import LLMProviderError, LLMThrottledError
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+STATE_KEY = "llm_limiter:state"
+INFLIGHT_KEY = "llm_limiter:inflight"
+BACKGROUND_INFLIGHT_KEY = "llm_limiter:inflight:background"
+
+_priority_var: ContextVar[str] = ContextVar("llm_priority", default=INTERACTIVE)
+
+# KEYS: state, inflight, background inflight
+# ARGV: lease id, now ms, lease ttl ms, is background (0/1), interactive reserve, initial limit
+# Returns {1 granted / 0 full, limit as string}
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+local limit = tonumber(redis.call('HGET', KEYS[1], 'limit') or ARGV[6])
+if redis.call('ZCARD', KEYS[2]) >= math.floor(limit) then
+    return {0, tostring(limit)}
+end
+local background = ARGV[4] == '1'
+if background and redis.call('ZCARD', KEYS[3]) >= math.floor(limit * (1 - tonumber(ARGV[5]))) then
+    return {0, tostring(limit)}
+end
+local expires = now + tonumber(ARGV[3])
+redis.call('ZADD', KEYS[2], expires, ARGV[1])
+if background then
+    redis.call('ZADD', KEYS[3], expires, ARGV[1])
+end
+return {1, tostring(limit)}
+"""
+
+# KEYS: state, inflight, background inflight
+# ARGV: lease id, now ms, outcome (ok/hold/throttled), initial, min, max, decrease factor, cooldown ms
+# Returns the new limit as a string
+_RELEASE_SCRIPT = """
+local now = tonumber(ARGV[2])
+local inflight = redis.call('ZCARD', KEYS[2])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+local limit = tonumber(redis.call('HGET', KEYS[1], 'limit') or ARGV[4])
+local outcome = ARGV[3]
+if outcome == 'ok' then
+    -- Only probe for more capacity while the current limit is actually being used
+    if inflight * 2 >= limit then
+        limit = math.min(tonumber(ARGV[6]), limit + 1 / limit)
+    end
+elseif outcome == 'throttled' then
+    local decreased_at = tonumber(redis.call('HGET', KEYS[1], 'decreased_at') or 0)
+    if now - decreased_at >= tonumber(ARGV[8]) then
+        limit = math.max(tonumber(ARGV[5]), limit * tonumber(ARGV[7]))
+        redis.call('HSET', KEYS[1], 'decreased_at', ARGV[2])
+    end
+end
+redis.call('HSET', KEYS[1], 'limit', tostring(limit))
+return tostring(limit)
+"""
+
+limiter_calls_total = Counter(
+    "llm_limiter_calls_total",
+    "Upstream LLM calls through the adaptive limiter, by priority and outcome (ok/hold/throttled).",
+    labelnames=("priority", "outcome"),
+)
+limiter_waits_total = Counter(
+    "llm_limiter_waits_total",
+    "Upstream LLM calls that had to wait for a slot, by priority and result (acquired/timeout/skipped).",
+    labelnames=("priority", "result"),
+)
+REGISTRY.extend([limiter_calls_total, limiter_waits_total])
+
+
+class LLMCapacityError(LLMProviderError):
+    """Raised when no upstream slot became free within the wait timeout."""
+
+
+def is_throttling_error(exc: BaseException) -> bool:
+    """True for quota/rate rejections (our own error type, or an SDK error carrying HTTP 429)."""
+    if isinstance(exc, LLMThrottledError):
+        return True
+    code = getattr(exc, "code", None) or getattr(exc, "status_code", None)
+    return code == 429 or "RESOURCE_EXHAUSTED" in str(exc)
+
+
+@contextmanager
+def background_priority():
+    """Upstream calls made inside this block count as background work."""
+    token = _priority_var.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority_var.reset(token)
+
+
+def current_priority() -> str:
+    return _priority_var.get()
+
+
+class Slot:
+    """
+    One held upstream slot; use as a context manager around the call. The outcome
+    fed back to the limiter is derived from the exception (if any) and the latency:
+    time to first token when `mark_first_token()` was called, otherwise the whole call.
+    """
+
+    def __init__(self, limiter: Optional["AdaptiveLimiter"], lease_id: Optional[str], priority: str):
+        self.limiter = limiter
+        self.lease_id = lease_id
+        self.priority = priority
+        self.started = time.monotonic()
+        self.first_token_s: Optional[float] = None
+        self.released = False
+
+    def discard(self):
+        """Gives the slot back without feedback (the call was never made)."""
+        if self.released or self.limiter is None:
+            return
+        self.released = True
+        self.limiter.release(self, "hold")
+
+    def mark_first_token(self):
+        if self.first_token_s is None:
+            self.first_token_s = time.monotonic() - self.started
+
+    def release(self, exc: Optional[BaseException] = None):
+        if self.released or self.limiter is None:
+            return
+        self.released = True
+        if exc is not None and not isinstance(exc, GeneratorExit):
+            outcome = "throttled" if is_throttling_error(exc) else "hold"
+        else:
+            latency = self.first_token_s if self.first_token_s is not None else time.monotonic() - self.started
+            outcome = "ok" if latency * 1000 <= self.limiter.latency_target_ms else "hold"
+        self.limiter.release(self, outcome)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release(exc)
+        return False
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        initial: float,
+        minimum: float,
+        maximum: float,
+        decrease_factor: float,
+        decrease_cooldown_ms: float,
+        latency_target_ms: float,
+        interactive_reserve: float,
+        wait_timeout_s: float,
+        background_wait_timeout_s: float,
+        lease_ttl_s: float,
+    ):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown_ms = decrease_cooldown_ms
+        self.latency_target_ms = latency_target_ms
+        self.interactive_reserve = interactive_reserve
+        self.wait_timeout_s = wait_timeout_s
+        self.background_wait_timeout_s = background_wait_timeout_s
+        self.lease_ttl_ms = int(lease_ttl_s * 1000)
+
+    def try_acquire(self, priority: Optional[str] = None) -> Optional[Slot]:
+        """Takes a slot if one is free right now, without waiting."""
+        priority = priority or current_priority()
+        lease_id = uuid.uuid4().hex
+        granted, _ = get_script(_ACQUIRE_SCRIPT)(
+            keys=[STATE_KEY, INFLIGHT_KEY, BACKGROUND_INFLIGHT_KEY],
+            args=[
+                lease_id,
+                int(time.time() * 1000),
+                self.lease_ttl_ms,
+                1 if priority == BACKGROUND else 0,
+                self.interactive_reserve,
+                self.initial,
+            ],
+        )
+        return Slot(self, lease_id, priority) if int(granted) else None
+
+    def acquire(self, priority: Optional[str] = None) -> Slot:
+        """Waits for a slot (polling with backoff); raises LLMCapacityError on timeout."""
+        priority = priority or current_priority()
+        slot = self.try_acquire(priority)
+        if slot is not None:
+            return slot
+
+        timeout = self.background_wait_timeout_s if priority == BACKGROUND else self.wait_timeout_s
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while time.monotonic() < deadline:
+            # Interactive callers poll faster, so they win freed slots more often
+            time.sleep(delay if priority == INTERACTIVE else delay * 2)
+            delay = min(delay * 2, 0.2)
+            slot = self.try_acquire(priority)
+            if slot is not None:
+                limiter_waits_total.inc(priority=priority, result="acquired")
+                return slot
+        limiter_waits_total.inc(priority=priority, result="timeout")
+        raise LLMCapacityError(f"No upstream LLM capacity within {timeout:.0f}s")
+
+    def release(self, slot: Slot, outcome: str):
+        limiter_calls_total.inc(priority=slot.priority, outcome=outcome)
+        try:
+            limit = get_script(_RELEASE_SCRIPT)(
+                keys=[STATE_KEY, INFLIGHT_KEY, BACKGROUND_INFLIGHT_KEY],
+                args=[
+                    slot.lease_id,
+                    int(time.time() * 1000),
+                    outcome,
+                    self.initial,
+                    self.minimum,
+                    self.maximum,
+                    self.decrease_factor,
+                    self.decrease_cooldown_ms,
+                ],
+            )
+        except Exception:
+            # The lease expires on its own
+            logger.exception("Could not release LLM limiter slot %s", slot.lease_id)
+            return
+        if outcome == "throttled":
+            logger.warning("Upstream throttled; LLM concurrency limit is now %.1f", float(limit))
+
+    def stats(self) -> Dict:
+        now = int(time.time() * 1000)
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hget(STATE_KEY, "limit")
+        pipe.zcount(INFLIGHT_KEY, now, "+inf")
+        pipe.zcount(BACKGROUND_INFLIGHT_KEY, now, "+inf")
+        limit, inflight, background = pipe.execute()
+        return {
+            "limit": float(limit) if limit else self.initial,
+            "inflight": inflight,
+            "inflight_background": background,
+        }
+
+
+class _NoopLimiter:
+    """Used when the limiter is disabled or Redis is unavailable."""
+
+    def try_acquire(self, priority: Optional[str] = None) -> Slot:
+        return Slot(None, None, priority or current_priority())
+
+    def acquire(self, priority: Optional[str] = None) -> Slot:
+        return self.try_acquire(priority)
+
+    def stats(self) -> Dict:
+        return {}
+
+
+@lru_cache(maxsize=None)
+def get_llm_limiter():
+    """Returns the process-wide limiter (a no-op without Redis or when LLM_LIMITER_ENABLED is off)."""
+    if not settings.LLM_LIMITER_ENABLED or get_redis() is None:
+        return _NoopLimiter()
+    return AdaptiveLimiter(
+        initial=settings.LLM_LIMITER_INITIAL,
+        minimum=settings.LLM_LIMITER_MIN,
+        maximum=settings.LLM_LIMITER_MAX,
+        decrease_factor=settings.LLM_LIMITER_DECREASE_FACTOR,
+        decrease_cooldown_ms=settings.LLM_LIMITER_DECREASE_COOLDOWN_MS,
+        latency_target_ms=settings.LLM_LIMITER_LATENCY_TARGET_MS,
+        interactive_reserve=settings.LLM_LIMITER_INTERACTIVE_RESERVE,
+        wait_timeout_s=settings.LLM_LIMITER_WAIT_TIMEOUT_S,
+        background_wait_timeout_s=settings.LLM_LIMITER_BACKGROUND_WAIT_TIMEOUT_S,
+        lease_ttl_s=settings.LLM_LIMITER_LEASE_TTL_S,
+    )
+
+
+def render_limiter_metrics() -> str:
+    """Cluster-wide limiter state as Prometheus gauges."""
+    try:
+        stats = get_llm_limiter().stats()
+    except Exception:
+        return ""
+    if not stats:
+        return ""
+    lines = []
+    for name, key in (
+        ("llm_limiter_limit", "limit"),
+        ("llm_limiter_inflight", "inflight"),
+        ("llm_limiter_inflight_background", "inflight_background"),
+    ):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {stats[key]}")
+    return "\n".join(lines)
@@ -0,0 +1,522 @@
+# app/services/llm_provider.py
+
+"""
+Pluggable LLM provider layer.
+
+Every code path that talks to a model (chat streaming, sync generation,
+profile updates, embeddings) goes through `get_llm_provider()`. The concrete
+backend is chosen with the LLM_PROVIDER setting:
+
+- "gemini": Google Gemini via the google-genai SDK (default).
+- "stub":   a local, deterministic backend with configurable latency, function
+            calls and error injection. No network access is needed, which makes
+            it the provider to use for offline development and load tests.
+
+Contents are passed around in the Gemini "Content" dict shape
+({"role": ..., "parts": [{"text": ...}]}) which both providers understand.
+
+Both providers can also cache a prompt prefix upstream (system instruction,
+tools and the first contents) and reference it by name on later calls; see
+app/services/prompt_cache.py. Callers always pass the full prompt, so a cache
+handle that expired or was evicted upstream only costs its savings.
+"""
+
+import hashlib
+import inspect
+import json
+import logging
+import random
+import threading
+import time
+import typing
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+Contents = Union[str, List[Any]]
+
+
+@dataclass
+class FunctionCall:
+    """A tool invocation requested by the model."""
+    name: str
+    args: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class StreamChunk:
+    """Provider-neutral streaming chunk: some text, some function calls, or both."""
+    text: str = ""
+    function_calls: List[FunctionCall] = field(default_factory=list)
+    # Token usage so far ({"input_tokens": ..., "output_tokens": ..., "cached_tokens": ...}), when reported.
+    # input_tokens includes the cached ones.
+    usage: Optional[Dict[str, int]] = None
+
+
+@dataclass
+class CachedContent:
+    """Handle to a prompt prefix cached upstream: system instruction, tools and the first `prefix_len` contents."""
+    name: str
+    model: str
+    prefix_len: int
+    expires_at: float
+    tokens: int = 0
+    # Set by the provider when the handle was gone upstream and the full prompt was sent instead
+    missed: bool = False
+
+
+class LLMProviderError(Exception):
+    """Raised when the upstream model call fails."""
+
+
+class LLMThrottledError(LLMProviderError):
+    """Raised when the upstream rejects a call for quota or rate reasons (HTTP 429)."""
+
+
+class LLMProvider(ABC):
+    """Base class for LLM backends. Subclasses must implement every abstract method to be instantiated."""
+
+    name = "base"
+
+    def __init__(self, default_model: str):
+        self.default_model = default_model
+
+    @abstractmethod
+    def stream_generate(
+        self,
+        contents: Contents,
+        system_instruction: Optional[str] = None,
+        tools: Optional[List[Callable]] = None,
+        model: Optional[str] = None,
+        cached_content: Optional[CachedContent] = None,
+    ) -> Iterator[StreamChunk]:
+        """
+        Streams the model answer as `StreamChunk`s. Automatic function calling is never performed.
+        With `cached_content` (created for this model), only the contents after its prefix are sent.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def generate(
+        self,
+        contents: Contents,
+        system_instruction: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> str:
+        """Returns the complete text answer for `contents`."""
+        raise NotImplementedError
+
+    def generate_with_usage(
+        self,
+        contents: Contents,
+        system_instruction: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> Tuple[str, Dict[str, int]]:
+        """Like `generate`, also returning the token usage the model reported (empty if none)."""
+        parts, usage = [], {}
+        for chunk in self.stream_generate(contents, system_instruction, model=model):
+            parts.append(chunk.text)
+            usage = chunk.usage or usage
+        return "".join(parts).strip(), usage
+
+    @abstractmethod
+    def get_embeddings(self):
+        """Returns a LangChain `Embeddings` implementation for the vector store."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_cached_content(
+        self,
+        model: str,
+        contents: List[Any],
+        system_instruction: Optional[str] = None,
+        tools: Optional[List[Callable]] = None,
+        ttl_s: float = 3600,
+    ) -> CachedContent:
+        """Caches a prompt prefix upstream for `ttl_s` seconds."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def extend_cached_content(self, cached: CachedContent, ttl_s: float) -> float:
+        """Resets the handle's lifetime to `ttl_s` from now. Returns the new expiry time."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_cached_content(self, name: str):
+        """Deletes the cached prefix upstream."""
+        raise NotImplementedError
+
+
+class GeminiProvider(LLMProvider):
+    """Google Gemini backend. The SDK client is created on first use, not at import."""
+
+    name = "gemini"
+
+    def __init__(self, api_key: str, default_model: str):
+        super().__init__(default_model)
+        self.api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=self.api_key)
+        return self._client
+
+    def stream_generate(self, contents, system_instruction=None, tools=None, model=None, cached_content=None):
+        from google.genai import errors, types
+
+        # Disabled so the caller can intercept tool calls and emit "Thought" events
+        no_afc = types.AutomaticFunctionCallingConfig(disable=True)
+        if cached_content is not None:
+            # System instruction and tools live in the cache and must not be sent again
+            chunks = self._stream(
+                model, contents[cached_content.prefix_len:],
+                types.GenerateContentConfig(cached_content=cached_content.name, automatic_function_calling=no_afc),
+            )
+            try:
+                first = next(chunks)
+            except StopIteration:
+                return
+            except errors.ClientError as e:
+                if e.code not in (403, 404):
+                    raise
+                # Expired or deleted upstream: send the whole prompt instead
+                logger.info("Cached content %s is gone (%s); sending the full prompt", cached_content.name, e.code)
+                cached_content.missed = True
+            else:
+                yield first
+                yield from chunks
+                return
+
+        yield from self._stream(
+            model, contents,
+            types.GenerateContentConfig(
+                system_instruction=system_instruction, tools=tools or None, automatic_function_calling=no_afc,
+            ),
+        )
+
+    def _stream(self, model, contents, config):
+        stream = self.client.models.generate_content_stream(
+            model=model or self.default_model,
+            contents=contents,
+            config=config,
+        )
+        for chunk in stream:
+            yield self._to_stream_chunk(chunk)
+
+    def generate(self, contents, system_instruction=None, model=None):
+        from google.genai import types
+
+        config = None
+        if system_instruction:
+            config = types.GenerateContentConfig(system_instruction=system_instruction)
+        response = self.client.models.generate_content(
+            model=model or self.default_model,
+            contents=contents,
+            config=config,
+        )
+        return response.text or ""
+
+    def get_embeddings(self):
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+        return GoogleGenerativeAIEmbeddings(
+            model="models/embedding-001",
+            google_api_key=self.api_key,
+        )
+
+    def create_cached_content(self, model, contents, system_instruction=None, tools=None, ttl_s=3600):
+        from google.genai import types
+
+        tool_list = None
+        if tools:
+            # Unlike generate_content, caches.create does not accept plain callables
+            tool_list = [types.Tool(function_declarations=[
+                types.FunctionDeclaration.from_callable(client=self.client._api_client, callable=tool)
+                for tool in tools
+            ])]
+        cache = self.client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                tools=tool_list,
+                contents=contents or None,
+                ttl=f"{int(ttl_s)}s",
+            ),
+        )
+        usage = cache.usage_metadata
+        return CachedContent(
+            name=cache.name,
+            model=model,
+            prefix_len=len(contents),
+            expires_at=time.time() + ttl_s,
+            tokens=(usage.total_token_count or 0) if usage else 0,
+        )
+
+    def extend_cached_content(self, cached, ttl_s):
+        from google.genai import types
+        self.client.caches.update(name=cached.name, config=types.UpdateCachedContentConfig(ttl=f"{int(ttl_s)}s"))
+        return time.time() + ttl_s
+
+    def delete_cached_content(self, name):
+        self.client.caches.delete(name=name)
+
+    @staticmethod
+    def _to_stream_chunk(chunk) -> StreamChunk:
+        result = StreamChunk()
+
+        # Function calls live in candidates -> content -> parts -> function_call
+        for candidate in chunk.candidates or []:
+            if candidate.content and candidate.content.parts:
+                for part in candidate.content.parts:
+                    if part.function_call:
+                        fc = part.function_call
+                        result.function_calls.append(FunctionCall(name=fc.name, args=dict(fc.args or {})))
+
+        # chunk.text aggregates the text parts of the first candidate
+        try:
+            result.text = chunk.text or ""
+        except Exception:
+            # chunk.text might raise if no text is present (e.g. only function call)
+            pass
+
+        usage = chunk.usage_metadata
+        if usage:
+            result.usage = {
+                "input_tokens": usage.prompt_token_count or 0,
+                "output_tokens": usage.candidates_token_count or 0,
+                # Explicit cache hits, and Gemini's implicit prefix caching
+                "cached_tokens": usage.cached_content_token_count or 0,
+            }
+        return result
+
+
+STUB_VOCABULARY = (
+    "the", "model", "stub", "answer", "is", "a", "deterministic", "response", "for",
+    "local", "load", "testing", "of", "our", "own", "service", "overhead", "and",
+    "latency", "with", "no", "network", "access", "required",
+)
+
+
+class StubProvider(LLMProvider):
+    """
+    Local deterministic backend.
+
+    The same contents always produce the same answer (seeded from STUB_SEED and a
+    hash of the request), so benchmark runs are comparable between commits.
+
+    Cached contents are emulated: the prefix is stored in Redis (shared by all
+    processes, expiring like an upstream handle) or, without Redis, in this
+    process. A call that references one is answered from the stored prefix plus
+    the new contents, and `prefill_ms_per_1k_tokens` is only charged for the
+    tokens that were not cached.
+    """
+
+    CACHE_KEY = "stub_llm:cached_content:{name}"
+
+    name = "stub"
+
+    def __init__(
+        self,
+        default_model: str,
+        ttft_ms: float = 200.0,
+        tokens_per_sec: float = 50.0,
+        response_tokens: int = 64,
+        chunk_tokens: int = 4,
+        function_call_rate: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        prefill_ms_per_1k_tokens: float = 0.0,
+        seed: int = 0,
+    ):
+        super().__init__(default_model)
+        self.ttft_ms = ttft_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.response_tokens = response_tokens
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.function_call_rate = function_call_rate
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.prefill_ms_per_1k_tokens = prefill_ms_per_1k_tokens
+        self.seed = seed
+        self._caches: Dict[str, Any] = {}
+        self._caches_lock = threading.Lock()
+
+    def stream_generate(self, contents, system_instruction=None, tools=None, model=None, cached_content=None):
+        cached_tokens = None
+        if cached_content is not None:
+            entry = self._load_cache(cached_content.name)
+            if entry is None:
+                cached_content.missed = True
+                cached_tokens = 0
+            else:
+                # Like the real API: the stored prefix is used, whatever the caller sends in its place
+                contents = entry["contents"] + list(contents[cached_content.prefix_len:])
+                system_instruction = entry["system_instruction"]
+                cached_tokens = self._count_tokens(entry["contents"], system_instruction)
+
+        rng = self._rng(contents, system_instruction, model)
+        input_tokens = self._count_tokens(contents, system_instruction)
+        prefill_ms = (input_tokens - (cached_tokens or 0)) * self.prefill_ms_per_1k_tokens / 1000
+        time.sleep((self.ttft_ms + prefill_ms) / 1000)
+
+        if rng.random() < self.error_rate:
+            raise LLMProviderError("Stub provider injected failure")
+        # Not seeded: a throttled request must be able to succeed on retry
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            raise LLMThrottledError("Stub provider injected 429 RESOURCE_EXHAUSTED")
+
+        usage = {"input_tokens": input_tokens}
+        if cached_tokens is not None:
+            usage["cached_tokens"] = cached_tokens
+
+        if tools and not self._is_after_tool_response(contents) and rng.random() < self.function_call_rate:
+            tool = rng.choice(tools)
+            yield StreamChunk(
+                function_calls=[FunctionCall(name=tool.__name__, args=self._stub_args(tool))],
+                usage={**usage, "output_tokens": 1},
+            )
+            return
+
+        words = [rng.choice(STUB_VOCABULARY) for _ in range(self.response_tokens)]
+        delay = self.chunk_tokens / self.tokens_per_sec if self.tokens_per_sec > 0 else 0
+        for start in range(0, len(words), self.chunk_tokens):
+            if start:
+                time.sleep(delay)
+            end = min(start + self.chunk_tokens, len(words))
+            yield StreamChunk(
+                text=" ".join(words[start:end]) + " ",
+                usage={**usage, "output_tokens": end},
+            )
+
+    def generate(self, contents, system_instruction=None, model=None):
+        return "".join(chunk.text for chunk in self.stream_generate(contents, system_instruction, model=model)).strip()
+
+    def get_embeddings(self):
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        return DeterministicFakeEmbedding(size=768)
+
+    def create_cached_content(self, model, contents, system_instruction=None, tools=None, ttl_s=3600):
+        entry = {"contents": list(contents), "system_instruction": system_instruction}
+        payload = json.dumps([entry, model, [tool.__name__ for tool in tools or ()]], sort_keys=True, default=str)
+        name = f"cachedContents/stub-{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]}-{int(time.time() * 1000)}"
+        self._store_cache(name, entry, ttl_s)
+        return CachedContent(
+            name=name,
+            model=model,
+            prefix_len=len(contents),
+            expires_at=time.time() + ttl_s,
+            tokens=self._count_tokens(contents, system_instruction),
+        )
+
+    def extend_cached_content(self, cached, ttl_s):
+        entry = self._load_cache(cached.name)
+        if entry is not None:
+            self._store_cache(cached.name, entry, ttl_s)
+        return time.time() + ttl_s
+
+    def delete_cached_content(self, name):
+        redis_client = self._cache_redis()
+        if redis_client:
+            redis_client.delete(self.CACHE_KEY.format(name=name))
+        with self._caches_lock:
+            self._caches.pop(name, None)
+
+    @staticmethod
+    def _cache_redis():
+        from app.db.redis_client import get_redis
+        return get_redis()
+
+    def _store_cache(self, name: str, entry: Dict, ttl_s: float):
+        redis_client = self._cache_redis()
+        if redis_client:
+            redis_client.set(self.CACHE_KEY.format(name=name), json.dumps(entry, default=str), ex=max(1, int(ttl_s)))
+            return
+        with self._caches_lock:
+            self._caches[name] = (entry, time.time() + ttl_s)
+
+    def _load_cache(self, name: str) -> Optional[Dict]:
+        redis_client = self._cache_redis()
+        if redis_client:
+            payload = redis_client.get(self.CACHE_KEY.format(name=name))
+            return json.loads(payload) if payload else None
+        with self._caches_lock:
+            entry, expires_at = self._caches.get(name, (None, 0))
+        return entry if expires_at > time.time() else None
+
+    def _rng(self, contents, system_instruction, model) -> random.Random:
+        payload = json.dumps([contents, system_instruction, model or self.default_model], sort_keys=True, default=str)
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        return random.Random(f"{self.seed}:{digest}")
+
+    @staticmethod
+    def _count_tokens(contents, system_instruction) -> int:
+        """Rough whitespace token count, good enough for usage accounting in tests."""
+        text = json.dumps(contents, default=str) + (system_instruction or "")
+        return len(text.split())
+
+    @staticmethod
+    def _is_after_tool_response(contents) -> bool:
+        """True if the last turn carries tool results, so the model must answer in text."""
+        if not isinstance(contents, list) or not contents:
+            return False
+        last = contents[-1]
+        parts = last.get("parts", []) if isinstance(last, dict) else []
+        return any(isinstance(part, dict) and "function_response" in part for part in parts)
+
+    @staticmethod
+    def _stub_args(tool: Callable) -> Dict[str, Any]:
+        """Builds plausible arguments for `tool` from its type hints."""
+        args = {}
+        for name, annotation in typing.get_type_hints(tool).items():
+            if name == "return":
+                continue
+            origin = typing.get_origin(annotation)
+            if origin is typing.Literal:
+                args[name] = typing.get_args(annotation)[0]
+            elif origin is list:
+                args[name] = ["stub"]
+            elif annotation in (int, float):
+                args[name] = annotation(1)
+            elif annotation is bool:
+                args[name] = True
+            else:
+                args[name] = "stub"
+        # Drop anything the signature does not accept (e.g. **kwargs-only tools)
+        accepted = inspect.signature(tool).parameters
+        return {key: value for key, value in args.items() if key in accepted}
+
+
+PROVIDERS = {
+    GeminiProvider.name: lambda: GeminiProvider(
+        api_key=settings.GOOGLE_API_KEY,
+        default_model=settings.GOOGLE_LLM_MODEL,
+    ),
+    StubProvider.name: lambda: StubProvider(
+        default_model=settings.STUB_LLM_MODEL,
+        ttft_ms=settings.STUB_TTFT_MS,
+        tokens_per_sec=settings.STUB_TOKENS_PER_SEC,
+        response_tokens=settings.STUB_RESPONSE_TOKENS,
+        chunk_tokens=settings.STUB_CHUNK_TOKENS,
+        function_call_rate=settings.STUB_FUNCTION_CALL_RATE,
+        error_rate=settings.STUB_ERROR_RATE,
+        throttle_rate=settings.STUB_THROTTLE_RATE,
+        prefill_ms_per_1k_tokens=settings.STUB_PREFILL_MS_PER_1K_TOKENS,
+        seed=settings.STUB_SEED,
+    ),
+}
+
+
+@lru_cache(maxsize=None)
+def get_llm_provider(name: Optional[str] = None) -> LLMProvider:
+    """Returns the (process-wide) provider instance configured by LLM_PROVIDER."""
+    name = (name or settings.LLM_PROVIDER).lower()
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown LLM_PROVIDER '{name}'. Available: {', '.join(PROVIDERS)}")
+    return PROVIDERS[name]()
@@ -0,0 +1,351 @@
+# app/services/llm_router.py
+
+"""
+Latency-SLO routing around the streaming LLM call.
+
+- Hedging: if the primary request has not produced its first chunk within
+  LLM_HEDGE_DELAY_MS, a second request is issued (to LLM_FALLBACK_MODEL, or the
+  same model) and whichever stream starts first wins. The loser is cancelled.
+- Fallback: if the primary request fails before its first chunk, the hedge
+  request is issued immediately.
+- Circuit breaking: each model keeps a rolling window of outcomes. When its error
+  rate or median time-to-first-token crosses the threshold the circuit opens and
+  traffic goes to the fallback model until the cooldown expires.
+- Upstream capacity: every attempt holds a slot of the cluster-wide adaptive
+  limiter (llm_limiter.py). Hedges only go out if a slot is free right away.
+
+Provider streams are blocking iterators, so every attempt is pumped from its own
+thread into a shared queue. A cancelled attempt stops at its next chunk and
+closes the upstream stream.
+
+Callers can cancel a whole generation from another thread: bind a CancelToken
+with `cancel_scope(token)` around the consuming code. `token.cancel()` wakes the
+router immediately, cancels every attempt and raises GenerationCancelled in the
+consumer.
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from statistics import median
+from typing import Callable, Dict, Iterator, List, Optional
+
+from app.core.config import settings
+from app.services.llm_limiter import LLMCapacityError, Slot, current_priority, get_llm_limiter, limiter_waits_total
+from app.services.llm_provider import CachedContent, LLMProvider, StreamChunk, get_llm_provider
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationCancelled(Exception):
+    """The generation was cancelled by its caller (CancelToken.cancel)."""
+
+
+class CancelToken:
+    """Thread-safe cancellation signal for the router streams of one generation."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Runs `callback` on cancel (now, if already cancelled). Returns a function that unregisters it."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+_cancel_token: ContextVar[Optional[CancelToken]] = ContextVar("llm_cancel_token", default=None)
+
+
+@contextmanager
+def cancel_scope(token: CancelToken):
+    """Router streams started inside this block (same context, or threads it is copied to) obey `token`."""
+    reset = _cancel_token.set(token)
+    try:
+        yield token
+    finally:
+        _cancel_token.reset(reset)
+
+
+class CircuitBreaker:
+    """Rolling-window breaker for one model."""
+
+    def __init__(self, window: int, min_samples: int, error_rate: float, ttft_ms: float, cooldown_s: float):
+        self.samples = deque(maxlen=window)  # (ok, ttft_seconds)
+        self.min_samples = min_samples
+        self.error_rate = error_rate
+        self.ttft_s = ttft_ms / 1000
+        self.cooldown_s = cooldown_s
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.open_until and time.monotonic() >= self.open_until:
+                # Half-open: start over with a fresh window
+                self.open_until = 0.0
+                self.samples.clear()
+            return not self.open_until
+
+    def record(self, ok: bool, ttft_s: Optional[float] = None) -> bool:
+        """Records an outcome. Returns True if this sample tripped the breaker."""
+        with self.lock:
+            self.samples.append((ok, ttft_s))
+            if self.open_until or len(self.samples) < self.min_samples:
+                return False
+            failures = sum(1 for sample_ok, _ in self.samples if not sample_ok)
+            latencies = [ttft for _, ttft in self.samples if ttft is not None]
+            too_slow = bool(latencies) and median(latencies) > self.ttft_s
+            if failures / len(self.samples) >= self.error_rate or too_slow:
+                self.open_until = time.monotonic() + self.cooldown_s
+                return True
+            return False
+
+
+class _Attempt:
+    def __init__(self, model: str, stream: Iterator[StreamChunk], priority: str, slot: Optional[Slot] = None):
+        self.model = model
+        self.stream = stream
+        self.priority = priority
+        self.slot = slot  # Pre-acquired (hedges); otherwise the pump thread waits for one
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+
+
+class LLMRouter:
+    """Hedged, circuit-broken `stream_generate` on top of an `LLMProvider`."""
+
+    def __init__(
+        self,
+        provider: LLMProvider,
+        hedge_delay_ms: float,
+        fallback_model: Optional[str] = None,
+        breaker_options: Optional[Dict] = None,
+        limiter=None,
+    ):
+        self.provider = provider
+        self.limiter = limiter or get_llm_limiter()
+        self.primary_model = provider.default_model
+        self.fallback_model = fallback_model or provider.default_model
+        self.hedge_delay_s = hedge_delay_ms / 1000
+        self.breaker_options = breaker_options or {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.counters = {
+            "requests": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "fallbacks": 0,
+            "failures": 0,
+            "circuit_opened": 0,
+        }
+        self.lock = threading.Lock()
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        with self.lock:
+            if model not in self.breakers:
+                self.breakers[model] = CircuitBreaker(**self.breaker_options)
+            return self.breakers[model]
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _record(self, model: str, ok: bool, ttft_s: Optional[float] = None):
+        if self._breaker(model).record(ok, ttft_s):
+            self._count("circuit_opened")
+            logger.warning("Circuit opened for model %s", model)
+
+    def _plan(self) -> List[str]:
+        """Returns [first model, optional hedge model] honouring open circuits."""
+        primary_ok = self._breaker(self.primary_model).allow()
+        if self.fallback_model == self.primary_model:
+            # Nowhere else to go: an open circuit only disables hedging
+            return [self.primary_model] + ([self.primary_model] if primary_ok else [])
+        fallback_ok = self._breaker(self.fallback_model).allow()
+        if not primary_ok:
+            return [self.fallback_model]
+        return [self.primary_model] + ([self.fallback_model] if fallback_ok else [])
+
+    def stats(self) -> Dict:
+        with self.lock:
+            counters = dict(self.counters)
+        requests = counters["requests"] or 1
+        return {
+            **counters,
+            "hedge_rate": counters["hedged"] / requests,
+            "open_circuits": [model for model, breaker in self.breakers.items() if breaker.open_until],
+        }
+
+    def stream_generate(self, contents, system_instruction=None, tools=None,
+                        cached_content: Optional[CachedContent] = None) -> Iterator[StreamChunk]:
+        self._count("requests")
+        plan = self._plan()
+        if plan[0] != self.primary_model:
+            self._count("fallbacks")
+        # The second model is used as a hedge after the delay, or right away as a fallback on error
+        hedge_model = plan[1] if len(plan) > 1 else None
+
+        events = queue.Queue()
+        attempts: List[_Attempt] = []
+        priority = current_priority()
+        token = _cancel_token.get()
+        if token is not None and token.cancelled:
+            raise GenerationCancelled()
+        # Wakes the loops below right away, whatever the attempts are doing
+        unregister = token.on_cancel(lambda: events.put((None, "cancelled", None))) if token else (lambda: None)
+
+        def launch(model: str, slot: Optional[Slot] = None):
+            attempt = _Attempt(
+                model,
+                self.provider.stream_generate(
+                    contents=contents,
+                    system_instruction=system_instruction,
+                    tools=tools,
+                    model=model,
+                    # A cached prefix belongs to one model; other models get the full prompt
+                    cached_content=cached_content if cached_content and cached_content.model == model else None,
+                ),
+                priority,
+                slot,
+            )
+            attempts.append(attempt)
+            threading.Thread(target=self._pump, args=(attempt, events), daemon=True).start()
+
+        winner = None
+        hedged = False
+        try:
+            launch(plan[0])
+            deadline = attempts[0].started + self.hedge_delay_s
+
+            # Phase 1: race for the first chunk
+            while winner is None:
+                timeout = None
+                if hedge_model and self.hedge_delay_s > 0:
+                    timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    attempt, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    slot = self.limiter.try_acquire(priority)
+                    if slot is None:
+                        # No spare upstream capacity: a hedge would only add load
+                        limiter_waits_total.inc(priority=priority, result="skipped")
+                    else:
+                        self._count("hedged")
+                        launch(hedge_model, slot)
+                        hedged = True
+                    hedge_model = None
+                    continue
+
+                if kind == "cancelled":
+                    raise GenerationCancelled()
+                if kind == "error":
+                    if not isinstance(payload, LLMCapacityError):
+                        # Waiting for our own limiter says nothing about the model's health
+                        self._record(attempt.model, ok=False)
+                    attempt.cancelled.set()  # Finished; nothing more will come from it
+                    if hedge_model:
+                        # Failed before the first chunk: fall back right away
+                        self._count("fallbacks")
+                        launch(hedge_model)
+                        hedge_model = None
+                        continue
+                    if any(not other.cancelled.is_set() for other in attempts):
+                        continue
+                    self._count("failures")
+                    raise payload
+
+                winner = attempt
+                ttft = time.monotonic() - winner.started
+                self._record(winner.model, ok=True, ttft_s=ttft)
+                if hedged and winner is not attempts[0]:
+                    self._count("hedge_wins")
+                for loser in attempts:
+                    if loser is not winner and not loser.cancelled.is_set():
+                        loser.cancelled.set()
+                        # Its time-to-first-token is at least as long as it waited
+                        self._record(loser.model, ok=True, ttft_s=time.monotonic() - loser.started)
+
+                if kind == "done":
+                    return
+                yield payload
+
+            # Phase 2: relay the committed stream
+            while True:
+                attempt, kind, payload = events.get()
+                if kind == "cancelled":
+                    raise GenerationCancelled()
+                if attempt is not winner:
+                    continue
+                if kind == "done":
+                    return
+                if kind == "error":
+                    self._record(winner.model, ok=False)
+                    self._count("failures")
+                    raise payload
+                yield payload
+        finally:
+            # Also runs when the client disconnects and the generator is closed
+            unregister()
+            for attempt in attempts:
+                attempt.cancelled.set()
+
+    def _pump(self, attempt: _Attempt, events: queue.Queue):
+        try:
+            slot = attempt.slot or self.limiter.acquire(attempt.priority)
+            if attempt.cancelled.is_set():
+                # Another attempt won while this one waited for capacity
+                slot.discard()
+                return
+            with slot:
+                for chunk in attempt.stream:
+                    slot.mark_first_token()
+                    if attempt.cancelled.is_set():
+                        break
+                    events.put((attempt, "chunk", chunk))
+        except Exception as e:
+            events.put((attempt, "error", e))
+        else:
+            events.put((attempt, "done", None))
+        finally:
+            attempt.stream.close()
+
+
+@lru_cache(maxsize=None)
+def get_llm_router() -> LLMRouter:
+    """Returns the process-wide router around the configured LLM provider."""
+    return LLMRouter(
+        provider=get_llm_provider(),
+        hedge_delay_ms=settings.LLM_HEDGE_DELAY_MS,
+        fallback_model=settings.LLM_FALLBACK_MODEL,
+        breaker_options={
+            "window": settings.LLM_CIRCUIT_WINDOW,
+            "min_samples": settings.LLM_CIRCUIT_MIN_SAMPLES,
+            "error_rate": settings.LLM_CIRCUIT_ERROR_RATE,
+            "ttft_ms": settings.LLM_CIRCUIT_TTFT_MS,
+            "cooldown_s": settings.LLM_CIRCUIT_COOLDOWN_S,
+        },
+    )
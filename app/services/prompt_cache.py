@@ -0,0 +1,290 @@
+# app/services/prompt_cache.py
+
+"""
+Prompt-prefix caching for the chat path.
+
+A chat prompt is laid out so that it starts with a long prefix that stays
+byte-identical from one turn to the next:
+
+    system instruction, tools, history window
+    | this turn: user profile, RAG context, user message, then any tool calls
+
+Two rules keep the prefix stable:
+
+- Whatever changes every turn is sent with the user message, not in the
+  system instruction. That covers the RAG context, and also the user profile,
+  which is rewritten after every turn.
+- The history window does not slide by one exchange every turn. It starts at an
+  anchor message and grows until it holds HISTORY_CONTEXT_MESSAGES +
+  PROMPT_CACHE_WINDOW_SLACK messages. It then jumps forward to the newest
+  HISTORY_CONTEXT_MESSAGES.
+
+After each turn, off the request path, the next turn's prefix is cached
+upstream as a cached-content handle with PROMPT_CACHE_TTL_S, once it reaches
+PROMPT_CACHE_MIN_TOKENS. These updates run on PROMPT_CACHE_UPDATE_THREADS
+threads, and their upstream calls take background slots from the shared LLM
+limiter, so a burst of turns cannot burst cache calls. The next turn then sends only what follows the prefix.
+A handle is reused while it is still a prefix of the prompt, and its lifetime
+is extended. It is replaced, and the old handle deleted, once:
+
+- more than PROMPT_CACHE_REFRESH_TOKENS follow it,
+- the window moves, or
+- the model or tools change.
+
+Per session, Redis holds the anchor and the current handle, with a hash of the
+prefix it covers (`prompt_cache:{user_id}:{session_id}`). A handle is only used
+when the hash still matches. If a handle expired or was evicted upstream, that
+turn is a miss: the provider sends the full prompt, and the handle is replaced
+after the turn.
+"""
+
+import contextvars
+import hashlib
+import inspect
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+import orjson
+
+from app.core.config import settings
+from app.core.metrics import Counter, REGISTRY, record_cache
+from app.db.redis_client import get_redis
+from app.services.llm_limiter import background_priority, get_llm_limiter
+from app.services.llm_provider import CachedContent, LLMProvider, get_llm_provider
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = "prompt_cache:{user_id}:{session_id}"
+# A handle closer than this to its expiry is not used (it could expire mid-request)
+EXPIRY_MARGIN_S = 30
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.PROMPT_CACHE_UPDATE_THREADS,
+    thread_name_prefix="prompt-cache",
+)
+
+prompt_cache_handles_total = Counter(
+    "prompt_cache_handles_total",
+    "Upstream cached-content handles, by event (created/extended/deleted/failed).",
+    ("event",),
+)
+REGISTRY.append(prompt_cache_handles_total)
+
+
+def format_for_gemini(message: Dict[str, str]) -> Dict:
+    """Transforms a simple {'role': 'user', 'content': 'text'} dict
+    into the Gemini API required format."""
+
+    # Ensure role is correctly mapped for history (model for assistant)
+    role = message['role']
+    if role == 'assistant':
+        role = 'model'
+
+    return {
+        "role": role,
+        "parts": [
+            {"text": message['content']}
+        ]
+    }
+
+
+def _tool_signature(tool: Callable) -> str:
+    return f"{tool.__module__}.{tool.__qualname__}{inspect.signature(tool)}\n{inspect.getdoc(tool) or ''}"
+
+
+def prefix_hash(model: str, system_instruction: Optional[str], tools: Optional[List[Callable]],
+                contents: List[Dict]) -> str:
+    """Stable hash of a prompt prefix. Equal hashes mean the provider receives identical bytes."""
+    payload = orjson.dumps([model, system_instruction, [_tool_signature(tool) for tool in tools or ()], contents])
+    return hashlib.sha256(payload).hexdigest()
+
+
+def estimate_tokens(system_instruction: Optional[str], tools: Optional[List[Callable]], contents: List[Dict]) -> int:
+    """Rough token count (4 bytes per token), only used to decide what is worth caching."""
+    size = len(system_instruction or "") + len(orjson.dumps(contents))
+    size += sum(len(_tool_signature(tool)) for tool in tools or ())
+    return size // 4
+
+
+@dataclass
+class SessionPrefix:
+    """The cacheable start of one turn's prompt."""
+    user_id: str
+    session_id: str
+    system_instruction: str
+    tools: Optional[List[Callable]]
+    history: List[Dict]   # History window: raw messages, with their seq
+    contents: List[Dict]  # The same, in the provider's format
+    cached_content: Optional[CachedContent] = None
+    record: Dict[str, str] = field(default_factory=dict)
+
+
+class PromptCache:
+    """Chooses each turn's history window and manages the session's upstream handle."""
+
+    def __init__(
+        self,
+        provider: LLMProvider,
+        model: str,
+        ttl_s: float,
+        min_tokens: int,
+        refresh_tokens: int,
+        context_messages: int,
+        window_slack: int,
+        enabled: bool = True,
+    ):
+        self.provider = provider
+        self.model = model
+        self.ttl_s = ttl_s
+        self.min_tokens = min_tokens
+        self.refresh_tokens = refresh_tokens
+        self.context_messages = context_messages
+        self.window_slack = window_slack if enabled else 0
+        self.enabled = enabled
+
+    @property
+    def history_limit(self) -> int:
+        """How many of the newest messages prepare() may need."""
+        return self.context_messages + self.window_slack
+
+    def prepare(self, user_id, session_id: str, history: List[Dict], system_instruction: str,
+                tools: Optional[List[Callable]] = None) -> SessionPrefix:
+        """Request path: picks the history window and a usable handle. One Redis read, no upstream call."""
+        redis_client = get_redis() if self.enabled else None
+        record = redis_client.hgetall(SESSION_KEY.format(user_id=user_id, session_id=session_id)) if redis_client else {}
+        window = self._window(history, record.get("anchor"))
+        prefix = SessionPrefix(
+            user_id=user_id,
+            session_id=session_id,
+            system_instruction=system_instruction,
+            tools=tools,
+            history=window,
+            contents=[format_for_gemini(message) for message in window],
+            record=record,
+        )
+        if record.get("name"):
+            prefix.cached_content = self._usable_handle(record, prefix)
+        if redis_client and estimate_tokens(system_instruction, tools, prefix.contents) >= self.min_tokens:
+            # Only prefixes long enough to be cached count as hits or misses
+            record_cache("prompt_prefix", prefix.cached_content is not None)
+        return prefix
+
+    def after_turn(self, prefix: SessionPrefix, new_messages: List[Dict]):
+        """Once the turn's messages are saved: prepares the next turn's prefix on the update threads."""
+        if not self.enabled or not get_redis():
+            return
+        context = contextvars.copy_context()
+        _executor.submit(context.run, self._safe_update, prefix, new_messages)
+
+    def _safe_update(self, prefix: SessionPrefix, new_messages: List[Dict]):
+        try:
+            self.update(prefix, new_messages)
+        except Exception:
+            prompt_cache_handles_total.inc(event="failed")
+            logger.exception("Prompt cache update failed; the next turn sends the full prompt")
+
+    def update(self, prefix: SessionPrefix, new_messages: List[Dict]):
+        """Moves the session's record to the next turn's prefix, creating or replacing the handle as needed."""
+        history = prefix.history + new_messages
+        window = self._window(history, str(history[0]["seq"]) if history else None)
+        if not window:
+            return
+        contents = [format_for_gemini(message) for message in window]
+        system_instruction, tools = prefix.system_instruction, prefix.tools
+
+        handle = None
+        current = prefix.cached_content
+        if current is not None and not current.missed and self._covers(current, prefix, contents):
+            tail_tokens = estimate_tokens(None, None, contents[current.prefix_len:])
+            if tail_tokens < self.refresh_tokens:
+                handle = current
+                if handle.expires_at - time.time() < self.ttl_s / 2:
+                    with background_priority(), get_llm_limiter().acquire():
+                        handle.expires_at = self.provider.extend_cached_content(handle, self.ttl_s)
+                    prompt_cache_handles_total.inc(event="extended")
+
+        if handle is None and estimate_tokens(system_instruction, tools, contents) >= self.min_tokens:
+            with background_priority(), get_llm_limiter().acquire():
+                handle = self.provider.create_cached_content(
+                    self.model, contents, system_instruction=system_instruction, tools=tools, ttl_s=self.ttl_s,
+                )
+            prompt_cache_handles_total.inc(event="created")
+
+        record = {"anchor": str(window[0]["seq"])}
+        if handle is not None:
+            record.update({
+                "name": handle.name,
+                "model": handle.model,
+                "prefix_len": str(handle.prefix_len),
+                "expires_at": str(handle.expires_at),
+                "tokens": str(handle.tokens),
+                "hash": prefix_hash(handle.model, system_instruction, tools, contents[:handle.prefix_len]),
+            })
+        key = SESSION_KEY.format(user_id=prefix.user_id, session_id=prefix.session_id)
+        pipe = get_redis().pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping=record)
+        # The anchor is worth keeping for as long as the session's history is hot
+        pipe.expire(key, settings.HISTORY_HOT_TTL_S)
+        pipe.execute()
+
+        replaced = prefix.record.get("name")
+        if replaced and (handle is None or handle.name != replaced):
+            self._delete(replaced)
+
+    def _covers(self, handle: CachedContent, prefix: SessionPrefix, contents: List[Dict]) -> bool:
+        """True if the handle is still a prefix of `contents`."""
+        if handle.prefix_len > len(contents) or handle.expires_at < time.time() + EXPIRY_MARGIN_S:
+            return False
+        current_hash = prefix_hash(handle.model, prefix.system_instruction, prefix.tools, contents[:handle.prefix_len])
+        return current_hash == prefix.record.get("hash")
+
+    def _usable_handle(self, record: Dict[str, str], prefix: SessionPrefix) -> Optional[CachedContent]:
+        handle = CachedContent(
+            name=record["name"],
+            model=record["model"],
+            prefix_len=int(record["prefix_len"]),
+            expires_at=float(record["expires_at"]),
+            tokens=int(record.get("tokens") or 0),
+        )
+        # A changed system instruction, tool set or window gives a different hash
+        return handle if self._covers(handle, prefix, prefix.contents) else None
+
+    def _window(self, history: List[Dict], anchor: Optional[str]) -> List[Dict]:
+        """The messages from `anchor` on while there are few enough of them, else the newest context window."""
+        if anchor is not None:
+            for index, message in enumerate(history):
+                if str(message["seq"]) == anchor:
+                    if len(history) - index <= self.context_messages + self.window_slack:
+                        return history[index:]
+                    break
+        return history[-self.context_messages:]
+
+    def _delete(self, name: str):
+        try:
+            with background_priority(), get_llm_limiter().acquire():
+                self.provider.delete_cached_content(name)
+            prompt_cache_handles_total.inc(event="deleted")
+        except Exception as e:
+            # It expires on its own
+            logger.warning("Could not delete cached content %s: %s", name, e)
+
+
+@lru_cache(maxsize=None)
+def get_prompt_cache() -> PromptCache:
+    """Returns the process-wide prompt cache for the configured LLM provider."""
+    provider = get_llm_provider()
+    return PromptCache(
+        provider=provider,
+        model=provider.default_model,
+        ttl_s=settings.PROMPT_CACHE_TTL_S,
+        min_tokens=settings.PROMPT_CACHE_MIN_TOKENS,
+        refresh_tokens=settings.PROMPT_CACHE_REFRESH_TOKENS,
+        context_messages=settings.HISTORY_CONTEXT_MESSAGES,
+        window_slack=settings.PROMPT_CACHE_WINDOW_SLACK,
+        enabled=settings.PROMPT_CACHE_ENABLED,
+    )
@@ -0,0 +1,164 @@
+# app/services/response_stream.py
+
+"""
+Resumable chat responses backed by Redis Streams.
+
+Generation is decoupled from delivery:
+
+1. `start_chat_generation` creates a response id and runs the chat generator on a
+   background thread. Every event is appended (XADD) to `chat_response:{id}`, so
+   the answer is completed and saved to history even if the client disconnects.
+2. Clients read the stream with `read_response_events`, starting after any
+   entry id. It is an async generator on the asyncio Redis client, so a waiting
+   reader holds no thread. The Redis entry ids double as SSE event ids, so a client that drops
+   can reconnect with `Last-Event-ID` (to any gunicorn worker) and resume.
+
+Streams expire RESPONSE_STREAM_TTL_S seconds after their last write.
+"""
+
+import contextvars
+import logging
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Iterable, Optional, Tuple
+
+import orjson
+
+from app.core.config import settings
+from app.db.redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_STREAM_KEY = "chat_response:{response_id}"
+RESPONSE_META_KEY = "chat_response_meta:{response_id}"
+
+EVENT_ID_PATTERN = re.compile(r"\d+-\d+")
+
+# Reads block for at most this long, so abandoned readers notice quickly
+READ_BLOCK_MS = 1000
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.RESPONSE_GENERATION_THREADS,
+    thread_name_prefix="chat-generation",
+)
+
+
+def is_available() -> bool:
+    """Resumable streams need Redis; without it chat falls back to direct streaming."""
+    return get_redis() is not None
+
+
+def create_response_stream(user_id, session_id, response_id: Optional[str] = None) -> str:
+    response_id = response_id or uuid.uuid4().hex
+    meta_key = RESPONSE_META_KEY.format(response_id=response_id)
+    pipe = get_redis().pipeline()
+    pipe.hset(meta_key, mapping={
+        "user_id": str(user_id),
+        "session_id": str(session_id),
+        "status": "running",
+        "created_at": str(time.time()),
+    })
+    pipe.expire(meta_key, settings.RESPONSE_STREAM_TTL_S)
+    pipe.execute()
+    return response_id
+
+
+def is_valid_event_id(event_id: str) -> bool:
+    """Redis Stream entry ids look like "<milliseconds>-<sequence>"."""
+    return bool(EVENT_ID_PATTERN.fullmatch(event_id))
+
+
+def get_response_meta(response_id: str) -> Optional[Dict[str, str]]:
+    meta = get_redis().hgetall(RESPONSE_META_KEY.format(response_id=response_id))
+    return meta or None
+
+
+def append_event(response_id: str, event: Dict) -> str:
+    key = RESPONSE_STREAM_KEY.format(response_id=response_id)
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.xadd(key, {"e": orjson.dumps(event)}, maxlen=settings.RESPONSE_STREAM_MAXLEN, approximate=True)
+    pipe.expire(key, settings.RESPONSE_STREAM_TTL_S)
+    entry_id, _ = pipe.execute()
+    return entry_id
+
+
+def finish_response_stream(response_id: str, status: str = "completed"):
+    key = RESPONSE_STREAM_KEY.format(response_id=response_id)
+    meta_key = RESPONSE_META_KEY.format(response_id=response_id)
+    pipe = get_redis().pipeline(transaction=False)
+    # The end marker tells readers to stop
+    pipe.xadd(key, {"end": status}, maxlen=settings.RESPONSE_STREAM_MAXLEN, approximate=True)
+    pipe.expire(key, settings.RESPONSE_STREAM_TTL_S)
+    pipe.hset(meta_key, "status", status)
+    pipe.expire(meta_key, settings.RESPONSE_STREAM_TTL_S)
+    pipe.execute()
+
+
+async def read_response_events(response_id: str, last_event_id: Optional[str] = None) -> AsyncIterator[Tuple[str, Dict]]:
+    """Yields (entry_id, event) after `last_event_id` until the end marker. Waits on the event loop."""
+    key = RESPONSE_STREAM_KEY.format(response_id=response_id)
+    cursor = last_event_id or "0-0"
+    idle_since = time.monotonic()
+    client = get_async_redis()
+    while True:
+        result = await client.xread({key: cursor}, count=100, block=READ_BLOCK_MS)
+        if not result:
+            if time.monotonic() - idle_since > settings.RESPONSE_STREAM_IDLE_TIMEOUT_S:
+                # The generating worker died without writing the end marker
+                logger.warning("Response stream %s went idle; giving up", response_id)
+                yield cursor, {"type": "text", "content": "\n[Error: response generation was interrupted]"}
+                return
+            continue
+        idle_since = time.monotonic()
+        for entry_id, fields in result[0][1]:
+            cursor = entry_id
+            if "end" in fields:
+                return
+            yield entry_id, orjson.loads(fields["e"])
+
+
+def _run_generation(response_id: str, events: Iterable[Dict], on_finish: Optional[Callable[[str], None]] = None):
+    status = "completed"
+    try:
+        for event in events:
+            append_event(response_id, event)
+    except Exception:
+        logger.exception("Chat generation %s failed", response_id)
+        status = "failed"
+        try:
+            append_event(response_id, {"type": "text", "content": "\n[Error: response generation failed]"})
+        except Exception:
+            pass
+    finally:
+        try:
+            finish_response_stream(response_id, status)
+        except Exception:
+            logger.exception("Could not finish response stream %s", response_id)
+        if on_finish is not None:
+            try:
+                on_finish(status)
+            except Exception:
+                logger.exception("Finish callback for response stream %s failed", response_id)
+
+
+def start_chat_generation(
+    user_id,
+    session_id,
+    make_events: Callable[[], Iterable[Dict]],
+    response_id: Optional[str] = None,
+    on_finish: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Starts producing `make_events()` into a response stream on a background
+    thread and returns the response id. The caller's log context is carried over.
+
+    Pass `response_id` if the stream was already created (see single_flight);
+    `on_finish(status)` runs once the end marker is written.
+    """
+    if response_id is None:
+        response_id = create_response_stream(user_id, session_id)
+    context = contextvars.copy_context()
+    _executor.submit(context.run, _run_generation, response_id, make_events(), on_finish)
+    return response_id
@@ -0,0 +1,168 @@
+# app/services/retrieval.py
+
+"""
+RAG retrieval for the chat path, with a per-session working set.
+
+A search fetches RAG_FETCH_K candidates from the vector store and keeps
+RAG_WORKING_SET_SIZE of them by maximal marginal relevance (MMR). Without MMR,
+the overlapping chunks of one passage would crowd out everything else:
+index_document_task splits with a 200-character overlap. A local scorer
+(RAG_RERANK) then reranks the working set for the query, and the best
+RAG_TOP_K chunks go into the prompt.
+
+Redis keeps the working set per session, together with the embedding of the
+query that produced it. Follow-up questions reuse it instead of searching again:
+
+- A query with no searchable terms ("tell me more", "why?") reuses it without
+  calling the embedding API.
+- Any other query is embedded. If it is within RAG_FOLLOWUP_SIMILARITY (cosine)
+  of the query that produced the set, the set is reranked for it and the
+  vector store is not searched.
+
+Indexing documents bumps a corpus version, which invalidates every working set.
+"""
+
+import logging
+import math
+import re
+from collections import Counter as TermCounter
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+import orjson
+
+from app.core.config import settings
+from app.core.metrics import Counter, REGISTRY, timed
+from app.db.redis_client import get_redis
+from app.services.vector_db_service import CORPUS_VERSION_KEY, get_embeddings, get_vector_store
+
+logger = logging.getLogger(__name__)
+
+WORKING_SET_KEY = "rag_working_set:{user_id}:{session_id}"
+
+# Words that carry no topic on their own: a query made only of these is a follow-up
+STOPWORDS = frozenset("""
+a an and are as at be but by can could did do does for from had has have he her him his how i if in into is it
+its just me more my no not of on or our please she so some than that the their them then there these they this
+those to too us was we were what when where which who why will with would you your yes ok okay thanks thank
+tell explain elaborate continue go again say give show detail details further else also about another other
+""".split())
+
+_TERM = re.compile(r"\w+")
+
+retrievals_total = Counter(
+    "rag_retrievals_total",
+    "RAG retrievals by path (search, reuse, reuse_without_embedding).",
+    ("path",),
+)
+REGISTRY.append(retrievals_total)
+
+
+def query_terms(text: str) -> List[str]:
+    """Lower-cased searchable terms of `text`."""
+    return [term for term in _TERM.findall(text.lower()) if len(term) > 1 and term not in STOPWORDS]
+
+
+def _cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def _bm25_scores(terms: List[str], documents: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """BM25 of each document for `terms`, with document frequencies taken from `documents` themselves."""
+    counts = [TermCounter(query_terms(document)) for document in documents]
+    lengths = [sum(count.values()) for count in counts]
+    average_length = (sum(lengths) / len(lengths)) or 1
+    scores = [0.0] * len(documents)
+    for term in set(terms):
+        frequency = sum(1 for count in counts if term in count)
+        if not frequency:
+            continue
+        idf = math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+        for index, count in enumerate(counts):
+            tf = count[term]
+            if tf:
+                scores[index] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[index] / average_length))
+    return scores
+
+
+@lru_cache(maxsize=1)
+def _cross_encoder():
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError:
+        logger.warning("RAG_RERANK=cross_encoder needs sentence-transformers; using the lexical reranker")
+        return None
+    return CrossEncoder(settings.RAG_RERANK_MODEL)
+
+
+def rerank(query: str, chunks: List[Dict]) -> List[Dict]:
+    """Orders `chunks` for `query` with the RAG_RERANK scorer. Ties keep their MMR order."""
+    if len(chunks) < 2 or settings.RAG_RERANK == "none":
+        return chunks
+    scores = None
+    if settings.RAG_RERANK == "cross_encoder" and _cross_encoder() is not None:
+        scores = [float(score) for score in _cross_encoder().predict([(query, chunk["content"]) for chunk in chunks])]
+    if scores is None:
+        scores = _bm25_scores(query_terms(query), [chunk["content"] for chunk in chunks])
+    order = sorted(range(len(chunks)), key=lambda index: -scores[index])
+    return [chunks[index] for index in order]
+
+
+def _load_working_set(redis_client, key: str) -> Optional[Dict]:
+    payload, version = redis_client.mget(key, CORPUS_VERSION_KEY)
+    if not payload:
+        return None
+    working_set = orjson.loads(payload)
+    # Documents were indexed since: the set may miss better chunks
+    return working_set if working_set["version"] == (version or "0") else None
+
+
+def _save_working_set(redis_client, key: str, working_set: Dict):
+    redis_client.set(key, orjson.dumps(working_set, default=str), ex=settings.RAG_WORKING_SET_TTL_S)
+
+
+def _search(query_embedding: List[float]) -> List[Dict]:
+    with timed("vector_search"):
+        documents = get_vector_store().max_marginal_relevance_search_by_vector(
+            query_embedding,
+            k=settings.RAG_WORKING_SET_SIZE,
+            fetch_k=max(settings.RAG_FETCH_K, settings.RAG_WORKING_SET_SIZE),
+            lambda_mult=settings.RAG_MMR_LAMBDA,
+        )
+    return [{"content": document.page_content, "metadata": document.metadata} for document in documents]
+
+
+def retrieve_context(user_id, session_id: Optional[str], query: str) -> List[str]:
+    """The RAG_TOP_K chunks for `query`, reusing the session's working set for follow-ups."""
+    redis_client = get_redis() if session_id else None
+    key = WORKING_SET_KEY.format(user_id=user_id, session_id=session_id)
+    working_set = _load_working_set(redis_client, key) if redis_client else None
+
+    terms = query_terms(query)
+    if working_set and not terms:
+        # Nothing to search for: stay with the chunks the last turn used
+        retrievals_total.inc(path="reuse_without_embedding")
+        return [chunk["content"] for chunk in working_set["chunks"][:settings.RAG_TOP_K]]
+
+    with timed("embedding"):
+        query_embedding = [float(value) for value in get_embeddings().embed_query(query)]
+
+    if working_set and _cosine(query_embedding, working_set["query_embedding"]) >= settings.RAG_FOLLOWUP_SIMILARITY:
+        path = "reuse"
+        chunks = working_set["chunks"]
+    else:
+        path = "search"
+        # Read first: documents indexed during the search invalidate the result
+        version = redis_client.get(CORPUS_VERSION_KEY) if redis_client else None
+        chunks = _search(query_embedding)
+        # The embedding of the query that produced the set stays the reference for later follow-ups
+        working_set = {"version": version or "0", "query_embedding": query_embedding}
+    retrievals_total.inc(path=path)
+
+    with timed("rerank"):
+        chunks = rerank(query, chunks)
+    if redis_client:
+        _save_working_set(redis_client, key, {**working_set, "chunks": chunks})
+    return [chunk["content"] for chunk in chunks[:settings.RAG_TOP_K]]
@@ -0,0 +1,84 @@
+# app/services/single_flight.py
+
+"""
+Single-flight deduplication of identical in-flight /chat requests.
+
+Double-clicks, client retries after a timeout and load balancer replays all
+send the same message twice. Without coordination each copy runs the whole
+pipeline: two LLM calls, and the user message appended to history twice.
+
+Every chat request is keyed on a hash of (user, session, message, options,
+Idempotency-Key header). The first request claims the key in Redis, pointing it
+at its response stream, and generates. Any duplicate that arrives while the key
+is held just reads that same response stream (see response_stream.py), so it
+sees the identical answer and nothing is generated or stored twice.
+
+- Without an Idempotency-Key the claim is released when generation finishes,
+  so deliberately sending the same message again later works as usual.
+- With an Idempotency-Key the claim is kept for SINGLE_FLIGHT_IDEMPOTENCY_TTL_S
+  after success, so retries of a finished request replay its answer.
+"""
+
+import hashlib
+import uuid
+from typing import Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import record_cache
+from app.db.redis_client import get_redis, get_script
+from app.services import response_stream
+
+INFLIGHT_KEY = "chat_inflight:{digest}"
+
+# Claims KEYS[1] for response ARGV[1] unless it points at a response that still
+# exists, in which case that response id is returned instead. A claim left by a
+# response that has expired (or was never created) is taken over.
+_CLAIM_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and redis.call('EXISTS', ARGV[3] .. current) == 1 then
+    return current
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return false
+"""
+
+# Deletes KEYS[1] only if it still belongs to response ARGV[1]
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def request_key(user_id, session_id, message: str, enable_tools: bool, use_rag: bool,
+                idempotency_key: Optional[str] = None) -> str:
+    payload = "\x00".join([
+        str(user_id), str(session_id), message, str(bool(enable_tools)), str(bool(use_rag)), idempotency_key or "",
+    ])
+    return INFLIGHT_KEY.format(digest=hashlib.sha256(payload.encode("utf-8")).hexdigest())
+
+
+def claim_response(key: str, user_id, session_id) -> Tuple[str, bool]:
+    """
+    Returns (response_id, is_leader). The leader must start generation into
+    `response_id`; a follower just reads it.
+    """
+    # Created before claiming, so a follower never sees a claim without its stream
+    response_id = response_stream.create_response_stream(user_id, session_id, uuid.uuid4().hex)
+    meta_prefix = response_stream.RESPONSE_META_KEY.format(response_id="")
+    ttl = max(settings.RESPONSE_STREAM_TTL_S, settings.SINGLE_FLIGHT_IDEMPOTENCY_TTL_S)
+    existing = get_script(_CLAIM_SCRIPT)(keys=[key], args=[response_id, ttl, meta_prefix])
+    record_cache("chat_single_flight", hit=existing is not None)
+    if existing is None:
+        return response_id, True
+    get_redis().delete(response_stream.RESPONSE_META_KEY.format(response_id=response_id))
+    return existing, False
+
+
+def release_response(key: str, response_id: str, status: str, keep: bool = False):
+    """Drops the claim once generation ends. `keep` leaves a successful claim in place for idempotent replays."""
+    if keep and status == "completed":
+        get_redis().expire(key, settings.SINGLE_FLIGHT_IDEMPOTENCY_TTL_S)
+        return
+    get_script(_RELEASE_SCRIPT)(keys=[key], args=[response_id])
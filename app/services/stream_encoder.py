@@ -0,0 +1,213 @@
+# app/services/stream_encoder.py
+
+"""
+Encodes chat stream events ({"type": "text" | "thought", "content": ...}) for
+`StreamingResponse`.
+
+- Serialization uses orjson.
+- Text deltas are coalesced: the first one is sent immediately (time-to-first-
+  token matters most), later ones are buffered until STREAM_COALESCE_MAX_BYTES
+  or STREAM_COALESCE_MAX_MS is reached. Any other event flushes the buffer and
+  is sent right away.
+- The wire format is picked from the Accept header:
+    text/event-stream    -> SSE with event ids, heartbeats and a final "done" event
+    anything else        -> NDJSON (one JSON object per line; the frontend's format)
+
+When the events come from a resumable response stream they carry their own ids
+(`with_ids=True`, items are (event_id, event) pairs). Those ids become the SSE
+`id:` field, or an "id" key in NDJSON, so clients can resume after a drop.
+"""
+
+import asyncio
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Union
+
+import orjson
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from app.core.config import settings
+
+SSE = "sse"
+NDJSON = "ndjson"
+
+MEDIA_TYPES = {
+    SSE: "text/event-stream",
+    NDJSON: "application/x-ndjson",
+}
+
+_END = object()
+
+
+def negotiate_stream_format(accept: Optional[str]) -> str:
+    """Returns SSE if the client asked for text/event-stream, NDJSON otherwise."""
+    if accept and "text/event-stream" in accept.lower():
+        return SSE
+    return NDJSON
+
+
+class StreamEncoder:
+    """Turns events into wire frames for one stream."""
+
+    def __init__(self, stream_format: str, first_event_id: int = 0):
+        self.stream_format = stream_format
+        self.last_event_id = first_event_id
+
+    def encode(self, event: Dict, event_id: Optional[Union[int, str]] = None) -> bytes:
+        if self.stream_format == NDJSON:
+            if event_id is not None:
+                event = {**event, "id": event_id}
+            return orjson.dumps(event) + b"\n"
+        data = orjson.dumps(event)
+        if event_id is None:
+            event_id = self.last_event_id + 1 if isinstance(self.last_event_id, int) else self.last_event_id
+        self.last_event_id = event_id
+        return b"id: %s\nevent: %s\ndata: %s\n\n" % (
+            str(event_id).encode(),
+            str(event.get("type", "message")).encode(),
+            data,
+        )
+
+    def heartbeat(self) -> bytes:
+        # SSE comments are ignored by EventSource; NDJSON readers skip blank lines
+        return b": heartbeat\n\n" if self.stream_format == SSE else b"\n"
+
+    def end(self) -> bytes:
+        if self.stream_format == SSE:
+            # Reuses the last id: a client that reconnects after "done" gets nothing more
+            return self.encode({"type": "done"}, self.last_event_id)
+        return b""
+
+
+class TextCoalescer:
+    """Merges consecutive text events until a size or age limit is reached."""
+
+    def __init__(self, max_bytes: int, max_delay_s: float):
+        self.max_bytes = max_bytes
+        self.max_delay_s = max_delay_s
+        self.parts: List[str] = []
+        self.size = 0
+        self.started = 0.0
+        self.sent_first_text = False
+        self.last_id = None
+
+    def add(self, text: str, event_id=None) -> bool:
+        """Buffers `text`; returns True if the buffer should be flushed now."""
+        if not self.parts:
+            self.started = time.monotonic()
+        self.parts.append(text)
+        self.last_id = event_id
+        self.size += len(text)
+        if not self.sent_first_text:
+            self.sent_first_text = True
+            return True
+        return self.size >= self.max_bytes or self.age() >= self.max_delay_s
+
+    def age(self) -> float:
+        return time.monotonic() - self.started if self.parts else 0.0
+
+    def time_left(self) -> Optional[float]:
+        if not self.parts:
+            return None
+        return max(0.0, self.max_delay_s - self.age())
+
+    def flush(self, encoder: StreamEncoder) -> bytes:
+        """Encodes the buffered text as one event (tagged with the id of its last part)."""
+        if not self.parts:
+            return b""
+        event = {"type": "text", "content": "".join(self.parts)}
+        self.parts, self.size = [], 0
+        return encoder.encode(event, self.last_id)
+
+
+async def encode_event_stream(
+    events: Union[Iterable[Dict], AsyncIterator[Dict]],
+    stream_format: str,
+    max_bytes: Optional[int] = None,
+    max_delay_ms: Optional[float] = None,
+    heartbeat_s: Optional[float] = None,
+    with_ids: bool = False,
+) -> AsyncIterator[bytes]:
+    """Encodes `events` (sync or async iterator of event dicts) into coalesced wire frames."""
+    encoder = StreamEncoder(stream_format)
+    coalescer = TextCoalescer(
+        max_bytes if max_bytes is not None else settings.STREAM_COALESCE_MAX_BYTES,
+        (max_delay_ms if max_delay_ms is not None else settings.STREAM_COALESCE_MAX_MS) / 1000,
+    )
+    heartbeat_s = heartbeat_s if heartbeat_s is not None else settings.STREAM_HEARTBEAT_S
+
+    # Pull events on a separate task so the coalescing window and heartbeats are
+    # enforced by timers, not by the arrival of the next upstream chunk.
+    pending: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            source = events if hasattr(events, "__aiter__") else iterate_in_threadpool(iter(events))
+            async for event in source:
+                await pending.put(event)
+        except Exception as e:
+            await pending.put(e)
+        finally:
+            await pending.put(_END)
+
+    producer = asyncio.create_task(produce())
+    last_write = time.monotonic()
+    try:
+        while True:
+            timeout = coalescer.time_left()
+            if timeout is None and heartbeat_s:
+                timeout = max(0.0, heartbeat_s - (time.monotonic() - last_write))
+            try:
+                item = await asyncio.wait_for(pending.get(), timeout) if timeout is not None else await pending.get()
+            except asyncio.TimeoutError:
+                yield coalescer.flush(encoder) or encoder.heartbeat()
+                last_write = time.monotonic()
+                continue
+
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            event_id, event = item if with_ids else (None, item)
+            if event.get("type") == "text":
+                if not coalescer.add(event.get("content", ""), event_id):
+                    continue
+                frame = coalescer.flush(encoder)
+            else:
+                frame = coalescer.flush(encoder) + encoder.encode(event, event_id)
+            yield frame
+            last_write = time.monotonic()
+
+        tail = coalescer.flush(encoder) + encoder.end()
+        if tail:
+            yield tail
+    finally:
+        producer.cancel()
+        close = getattr(events, "close", None)
+        if close is not None and not hasattr(events, "__aiter__"):
+            try:
+                # Runs the generator's cleanup (e.g. closes the upstream LLM stream)
+                await run_in_threadpool(close)
+            except ValueError:
+                # Still executing in the producer's thread; it is closed when garbage collected
+                pass
+
+
+def event_stream_response(
+    events,
+    accept: Optional[str],
+    headers: Optional[Dict[str, str]] = None,
+    with_ids: bool = False,
+) -> StreamingResponse:
+    """Builds the StreamingResponse for a chat event stream, negotiating SSE vs NDJSON."""
+    stream_format = negotiate_stream_format(accept)
+    return StreamingResponse(
+        encode_event_stream(events, stream_format, with_ids=with_ids),
+        media_type=MEDIA_TYPES[stream_format],
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # Stop nginx from buffering the stream
+            **(headers or {}),
+        },
+    )
@@ -0,0 +1,362 @@
+# app/services/usage.py
+
+"""
+LLM usage accounting and per-user token quotas.
+
+Callers report usage with `record_usage()`, or, for embeddings, inside a
+`usage_scope()`. Usage is tracked per user, feature and day:
+
+- requests
+- input, output and cached input tokens
+- tool rounds
+- embedding tokens
+
+Embedding APIs do not report tokens, so those are estimated at 4 characters per
+token.
+
+The request path never writes to the database. One Lua script adds the usage to
+a Redis hash per (day, user, feature) and marks that bucket dirty. The same
+script adds the tokens to the user's daily and monthly quota counters. Every
+USAGE_FLUSH_INTERVAL_S, a background thread in one API process (a Redis lock
+picks which) moves up to USAGE_FLUSH_BATCH dirty buckets into a pending batch.
+It adds them to the `llm_usage` table in one upsert. The batch id is recorded in
+the same transaction, so a batch retried after a crash is not counted twice.
+The usage endpoints therefore lag by up to one flush interval.
+
+Quotas (USAGE_DAILY_TOKEN_QUOTA, USAGE_MONTHLY_TOKEN_QUOTA; 0 disables) are
+checked at admission (admission.py), against the Redis counters. A user over
+quota gets 429 until the period ends. Like the rate limits, a request that is
+already running is not stopped.
+"""
+
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from sqlalchemy import delete, func, select
+
+from app.core.config import settings
+from app.core.metrics import Counter, REGISTRY, timed
+from app.db.database import IS_SQLITE, AsyncSessionLocal, engine
+from app.db.redis_client import get_redis, get_script
+from app.models.usage import UsageFlush, UsageRecord
+
+if IS_SQLITE:
+    from sqlalchemy.dialects.sqlite import insert
+else:
+    from sqlalchemy.dialects.postgresql import insert
+
+logger = logging.getLogger(__name__)
+
+FEATURE_CHAT = "chat"
+FEATURE_RAG = "rag"
+FEATURE_PROFILE_UPDATE = "profile_update"
+FEATURE_DOCUMENT_EMBEDDING = "document_embedding"
+FEATURE_BATCH = "batch"
+
+FIELDS = ("requests", "input_tokens", "output_tokens", "cached_tokens", "tool_rounds", "embedding_tokens")
+
+LIVE_KEY_PREFIX = "usage:live:"
+DIRTY_KEY = "usage:dirty"
+PENDING_KEY = "usage:pending"
+PENDING_BATCH_KEY = "usage:pending_batch"
+FLUSH_LOCK_KEY = "usage:flush_lock"
+QUOTA_KEY = "usage:quota:{user_id}:{period}"
+
+# Flush batch ids older than this are forgotten (a batch is retried within seconds)
+FLUSH_LEDGER_RETENTION = timedelta(days=1)
+
+# KEYS: live bucket, dirty set, daily quota counter, monthly quota counter
+# ARGV: bucket id, quota tokens, daily ttl, monthly ttl, field, amount, field, amount, ...
+_RECORD_SCRIPT = """
+for i = 5, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+local tokens = tonumber(ARGV[2])
+if tokens > 0 then
+    redis.call('INCRBY', KEYS[3], tokens)
+    redis.call('EXPIRE', KEYS[3], ARGV[3])
+    redis.call('INCRBY', KEYS[4], tokens)
+    redis.call('EXPIRE', KEYS[4], ARGV[4])
+end
+return 1
+"""
+
+# Moves up to ARGV[1] dirty buckets into the pending batch, unless an earlier batch is still pending.
+# KEYS: dirty set, pending hash, pending batch id
+# ARGV: max buckets, new batch id, live key prefix
+# Returns {batch id, {bucket, counts json, ...}}
+_DRAIN_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return {redis.call('GET', KEYS[3]) or ARGV[2], redis.call('HGETALL', KEYS[2])}
+end
+local buckets = redis.call('SPOP', KEYS[1], ARGV[1])
+for _, bucket in ipairs(buckets) do
+    local live = ARGV[3] .. bucket
+    local counts = redis.call('HGETALL', live)
+    if #counts > 0 then
+        redis.call('HSET', KEYS[2], bucket, cjson.encode(counts))
+        redis.call('DEL', live)
+    end
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return {ARGV[2], {}}
+end
+redis.call('SET', KEYS[3], ARGV[2])
+return {ARGV[2], redis.call('HGETALL', KEYS[2])}
+"""
+
+# Drops the pending batch once it is in the database (only if it is still the same batch)
+_CLEAR_SCRIPT = """
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2])
+end
+return 1
+"""
+
+usage_flushed_buckets_total = Counter(
+    "usage_flushed_buckets_total",
+    "Usage buckets (user, feature, day) flushed to the llm_usage table, by result (written/duplicate/failed).",
+    ("result",),
+)
+REGISTRY.append(usage_flushed_buckets_total)
+
+_scope: ContextVar[Optional[Tuple[str, str]]] = ContextVar("usage_scope", default=None)
+
+
+@contextmanager
+def usage_scope(user_id, feature: str):
+    """Usage reported without an explicit user (embeddings) inside this block is charged to `user_id`/`feature`."""
+    token = _scope.set((str(user_id), feature))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def estimate_tokens(texts: Iterable[str]) -> int:
+    return sum(len(text) for text in texts) // 4
+
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _seconds_until(moment: datetime) -> float:
+    return max(1.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+
+def _period_ends(today: date) -> Tuple[datetime, datetime]:
+    """Ends (UTC) of the current day and month."""
+    day_end = datetime.combine(today + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+    first_of_next = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+    return day_end, datetime.combine(first_of_next, datetime.min.time(), tzinfo=timezone.utc)
+
+
+def record_usage(user_id, feature: str, **counts: int):
+    """Adds usage (any of FIELDS) for `user_id` and `feature`. One Redis round trip; never raises."""
+    counts = {field: int(value) for field, value in counts.items() if value}
+    if not settings.USAGE_ENABLED or not counts or user_id is None:
+        return
+    unknown = set(counts) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown usage fields: {', '.join(sorted(unknown))}")
+    redis_client = get_redis()
+    if not redis_client:
+        return
+
+    today = _today()
+    bucket = f"{today.isoformat()}|{user_id}|{feature}"
+    tokens = counts.get("input_tokens", 0) + counts.get("output_tokens", 0) + counts.get("embedding_tokens", 0)
+    day_end, month_end = _period_ends(today)
+    args = [bucket, tokens, int(_seconds_until(day_end)) + 3600, int(_seconds_until(month_end)) + 3600]
+    for field, value in counts.items():
+        args += [field, value]
+    try:
+        get_script(_RECORD_SCRIPT)(
+            keys=[
+                LIVE_KEY_PREFIX + bucket,
+                DIRTY_KEY,
+                QUOTA_KEY.format(user_id=user_id, period=today.isoformat()),
+                QUOTA_KEY.format(user_id=user_id, period=today.strftime("%Y-%m")),
+            ],
+            args=args,
+        )
+    except Exception:
+        # Accounting must not fail the request it accounts for
+        logger.exception("Could not record usage for user %s (%s)", user_id, feature)
+
+
+def record_embedding_usage(texts: Iterable[str]):
+    """Charges the estimated tokens of embedded `texts` to the current usage_scope(), if any."""
+    scope = _scope.get()
+    if scope is not None:
+        user_id, feature = scope
+        record_usage(user_id, feature, requests=1, embedding_tokens=estimate_tokens(texts))
+
+
+def quota_status(user_id) -> Dict[str, Dict]:
+    """Tokens used in the current day and month against the configured quotas (0: unlimited)."""
+    today = _today()
+    used_day, used_month = 0, 0
+    redis_client = get_redis()
+    if redis_client:
+        used_day, used_month = (int(value or 0) for value in redis_client.mget(
+            QUOTA_KEY.format(user_id=user_id, period=today.isoformat()),
+            QUOTA_KEY.format(user_id=user_id, period=today.strftime("%Y-%m")),
+        ))
+    day_end, month_end = _period_ends(today)
+    return {
+        "daily": {"used": used_day, "limit": settings.USAGE_DAILY_TOKEN_QUOTA, "resets_at": day_end},
+        "monthly": {"used": used_month, "limit": settings.USAGE_MONTHLY_TOKEN_QUOTA, "resets_at": month_end},
+    }
+
+
+def quota_exceeded(user_id) -> Optional[Tuple[str, float]]:
+    """(period, seconds until it resets) if the user is over a quota, else None."""
+    if not settings.USAGE_ENABLED or not (settings.USAGE_DAILY_TOKEN_QUOTA or settings.USAGE_MONTHLY_TOKEN_QUOTA):
+        return None
+    for period, status in quota_status(user_id).items():
+        if status["limit"] and status["used"] >= status["limit"]:
+            return period, _seconds_until(status["resets_at"])
+    return None
+
+
+class UsageFlusher:
+    """Moves usage from Redis into the llm_usage table on a daemon thread."""
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_prune = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="usage-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stops the thread after a last flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(settings.USAGE_FLUSH_INTERVAL_S):
+            self._safe_flush()
+        self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush_once()
+        except Exception:
+            logger.exception("Usage flush failed; the batch will be retried")
+
+    def flush_once(self) -> int:
+        """Writes one batch of buckets, if this process gets the flush lock. Returns the number written."""
+        redis_client = get_redis()
+        if not redis_client:
+            return 0
+        lock = uuid.uuid4().hex
+        if not redis_client.set(FLUSH_LOCK_KEY, lock, nx=True, px=int(max(30, settings.USAGE_FLUSH_INTERVAL_S * 5) * 1000)):
+            return 0  # Another process is flushing
+        try:
+            batch_id, flat = get_script(_DRAIN_SCRIPT)(
+                keys=[DIRTY_KEY, PENDING_KEY, PENDING_BATCH_KEY],
+                args=[settings.USAGE_FLUSH_BATCH, uuid.uuid4().hex, LIVE_KEY_PREFIX],
+            )
+            if not flat:
+                return 0
+            rows = self._to_rows(dict(zip(flat[::2], flat[1::2])))
+            try:
+                with timed("usage_flush"), engine.begin() as conn:
+                    applied = conn.execute(select(UsageFlush.batch_id).where(UsageFlush.batch_id == batch_id)).first()
+                    if applied is None:
+                        statement = insert(UsageRecord).values(rows)
+                        conn.execute(statement.on_conflict_do_update(
+                            index_elements=["user_id", "feature", "day"],
+                            set_={field: getattr(UsageRecord, field) + statement.excluded[field] for field in FIELDS},
+                        ))
+                        conn.execute(insert(UsageFlush).values(batch_id=batch_id, flushed_at=datetime.utcnow()))
+                    self._prune_ledger(conn)
+            except Exception:
+                usage_flushed_buckets_total.inc(len(rows), result="failed")
+                raise
+            # A batch retried after its commit went through is not added twice
+            usage_flushed_buckets_total.inc(len(rows), result="written" if applied is None else "duplicate")
+            get_script(_CLEAR_SCRIPT)(keys=[PENDING_KEY, PENDING_BATCH_KEY], args=[batch_id])
+            return len(rows)
+        finally:
+            if redis_client.get(FLUSH_LOCK_KEY) == lock:
+                redis_client.delete(FLUSH_LOCK_KEY)
+
+    @staticmethod
+    def _to_rows(pending: Dict[str, str]) -> List[Dict]:
+        rows = []
+        for bucket, counts_json in pending.items():
+            day, user_id, feature = bucket.split("|", 2)
+            flat = orjson.loads(counts_json)
+            counts = {field: int(value) for field, value in zip(flat[::2], flat[1::2]) if field in FIELDS}
+            rows.append({
+                "user_id": int(user_id),
+                "feature": feature,
+                "day": date.fromisoformat(day),
+                **{field: counts.get(field, 0) for field in FIELDS},
+            })
+        return rows
+
+    def _prune_ledger(self, conn):
+        if time.monotonic() - self._last_prune < 3600:
+            return
+        self._last_prune = time.monotonic()
+        conn.execute(delete(UsageFlush).where(UsageFlush.flushed_at < datetime.utcnow() - FLUSH_LEDGER_RETENTION))
+
+
+_flusher: Optional[UsageFlusher] = None
+
+
+def start_usage_flusher():
+    global _flusher
+    _flusher = UsageFlusher()
+    _flusher.start()
+
+
+def stop_usage_flusher():
+    global _flusher
+    if _flusher is not None:
+        _flusher.stop()
+        _flusher = None
+
+
+async def usage_report(days: int, user_id: Optional[int] = None) -> Dict:
+    """
+    Usage of the last `days` days (today included), per day and feature and in
+    total per feature. Everyone's usage, or only `user_id`'s.
+    """
+    since = _today() - timedelta(days=days - 1)
+    sums = [func.sum(getattr(UsageRecord, field)).label(field) for field in FIELDS]
+    query = select(UsageRecord.day, UsageRecord.feature, func.count(func.distinct(UsageRecord.user_id)).label("users"),
+                   *sums).where(UsageRecord.day >= since)
+    if user_id is not None:
+        query = query.where(UsageRecord.user_id == user_id)
+    query = query.group_by(UsageRecord.day, UsageRecord.feature).order_by(UsageRecord.day, UsageRecord.feature)
+
+    async with AsyncSessionLocal() as db:
+        result = (await db.execute(query)).all()
+
+    daily = []
+    by_feature: Dict[str, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(FIELDS, 0))
+    for row in result:
+        counts = {field: int(getattr(row, field) or 0) for field in FIELDS}
+        daily.append({"day": row.day, "feature": row.feature, **counts,
+                      **({} if user_id is not None else {"users": row.users})})
+        for field, value in counts.items():
+            by_feature[row.feature][field] += value
+    return {"since": since, "daily": daily, "by_feature": dict(by_feature)}
@@ -1,28 +1,66 @@
 from typing import Optional
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
+from starlette.concurrency import run_in_threadpool
 from app.models.user import User
 from app.schemas.user import UserCreate
-from app.core.security import hash_password, verify_password
+from app.core.security import AUTH_COLUMNS, hash_password, verify_password
 
+# Column projections: each query loads only what its caller reads
+LOGIN_COLUMNS = (User.id, User.email, User.hashed_password, User.user_profile)
+REFRESH_COLUMNS = (User.id, User.email, User.refresh_token)
 
-def create_user(db: Session, user_data: UserCreate) -> User:
+
+async def get_user_by_email(db: AsyncSession, email: str, columns=AUTH_COLUMNS) -> Optional[User]:
+    """Return the user with `email`, loading only `columns`"""
+    result = await db.execute(select(User).options(load_only(*columns)).where(User.email == email))
+    return result.scalars().first()
+
+
+async def email_exists(db: AsyncSession, email: str) -> bool:
+    result = await db.execute(select(User.id).where(User.email == email).limit(1))
+    return result.first() is not None
+
+
+async def create_user(db: AsyncSession, user_data: UserCreate) -> User:
     """Create a new user"""
-    hashed_pw = hash_password(user_data.password)
+    # bcrypt is deliberately slow; keep it off the event loop
+    hashed_pw = await run_in_threadpool(hash_password, user_data.password)
     db_user = User(
         email=user_data.email,
         hashed_password=hashed_pw,
         full_name=user_data.full_name,
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
-def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
+async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[User]:
     "Return a user if the email and password are correct"
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_by_email(db, email, LOGIN_COLUMNS)
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    if not await run_in_threadpool(verify_password, password, user.hashed_password):
         return None
-    return user
\ No newline at end of file
+    return user
+
+
+async def set_refresh_token(db: AsyncSession, user_id: int, new_token: str, expected_token: Optional[str] = None) -> bool:
+    """
+    Store `new_token` without loading the row. With `expected_token` the update only
+    applies if that token is still current, so a refresh token can be used once.
+    """
+    statement = update(User).where(User.id == user_id)
+    if expected_token is not None:
+        statement = statement.where(User.refresh_token == expected_token)
+    result = await db.execute(statement.values(refresh_token=new_token))
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def get_user_profile(db: AsyncSession, user_id: int) -> Optional[str]:
+    """Return only the user_profile column"""
+    result = await db.execute(select(User.user_profile).where(User.id == user_id))
+    return result.scalar_one_or_none()
@@ -1,30 +1,83 @@
-from google import genai
-from langchain_community.vectorstores import PGVector
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+import logging
+from functools import lru_cache
+from typing import List, Optional
+from langchain_core.embeddings import Embeddings
 from app.core.config import settings
+from app.db.redis_client import get_redis
+from app.services.llm_limiter import get_llm_limiter
+from app.services.llm_provider import get_llm_provider
+from app.services.usage import record_embedding_usage
+
+logger = logging.getLogger(__name__)
 
 # Configure the database URL to include PGVector connection details
 # This will use the DATABASE_URL from settings which should point to PostgreSQL
 CONNECTION_STRING = settings.DATABASE_URL.replace("sqlite:///", "postgresql://").replace("postgresql://", "postgresql+psycopg2://")
 
-# Initialize the embedding model
-embeddings = GoogleGenerativeAIEmbeddings(
-    model="models/embedding-001",
-    google_api_key=settings.GOOGLE_API_KEY
-)
+class LimitedEmbeddings(Embeddings):
+    """
+    Holds an upstream LLM limiter slot for every embedding call (they share the model quota)
+    and charges the estimated tokens to the caller's usage_scope().
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts):
+        with get_llm_limiter().acquire():
+            vectors = self.embeddings.embed_documents(texts)
+        record_embedding_usage(texts)
+        return vectors
+
+    def embed_query(self, text):
+        with get_llm_limiter().acquire():
+            vector = self.embeddings.embed_query(text)
+        record_embedding_usage([text])
+        return vector
+
+
+@lru_cache(maxsize=1)
+def get_embeddings():
+    """Returns the embedding model of the configured LLM provider (created on first use)."""
+    return LimitedEmbeddings(get_llm_provider().get_embeddings())
 
 COLLECTION_NAME = "rag_documents"
+# Bumped whenever documents are added, so cached retrieval results are dropped (see retrieval.py)
+CORPUS_VERSION_KEY = "rag:corpus_version"
+
+# pgvector needs PostgreSQL; with a SQLite DATABASE_URL (local dev, benchmarks) vectors stay in process memory
+USE_PGVECTOR = settings.DATABASE_URL.startswith("postgresql")
+
+@lru_cache(maxsize=1)
+def get_in_memory_vector_store():
+    """Process-local vector store used when no PostgreSQL database is configured."""
+    from langchain_core.vectorstores import InMemoryVectorStore
+    return InMemoryVectorStore(embedding=get_embeddings())
 
 def get_vector_store():
     """Initializes and returns the PGVector store instance."""
+    if not USE_PGVECTOR:
+        return get_in_memory_vector_store()
+    from langchain_community.vectorstores import PGVector
     return PGVector(
         collection_name=COLLECTION_NAME,
         connection_string=CONNECTION_STRING,
-        embedding_function=embeddings
+        embedding_function=get_embeddings()
     )
 
-def save_chunk_to_vector_db(chunks: list):
-    """Saves the document chunks to the PGVector database."""
+def save_chunk_to_vector_db(chunks: list, ids: Optional[List[str]] = None):
+    """
+    Saves the document chunks to the PGVector database. With `ids`, chunks saved
+    before under the same ids are replaced rather than duplicated.
+    """
     vector_store = get_vector_store()
-    vector_store.add_documents(chunks)
-    print(f"[INFO] Saved {len(chunks)} document chunks to PGVector.")
\ No newline at end of file
+    if ids:
+        # PGVector inserts without checking ids, so an earlier copy is removed first
+        vector_store.delete(ids=ids)
+        vector_store.add_documents(chunks, ids=ids)
+    else:
+        vector_store.add_documents(chunks)
+    logger.info("Saved %d document chunks to the vector store.", len(chunks))
+    redis_client = get_redis()
+    if redis_client:
+        redis_client.incr(CORPUS_VERSION_KEY)
\ No newline at end of file
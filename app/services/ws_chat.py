@@ -0,0 +1,343 @@
+# app/services/ws_chat.py
+
+"""
+Chat over one long-lived WebSocket (`/api/v1/llm/ws`).
+
+A POST to /chat pays for a connection (and TLS), JWT verification and a user
+lookup on every turn. The WebSocket pays for them once: the first frame
+authenticates, then any number of turns, across any number of sessions, run over
+the same connection. Several turns can be in flight at once; their events are
+tagged with the client's `turn_id`.
+
+Client -> server (JSON text frames):
+    {"type": "auth", "token": "<access token>"}     first frame; send again to extend an expiring token
+    {"type": "chat", "turn_id": "t1", "session_id": "s1", "message": "...", "use_rag": true, "enable_tools": true}
+    {"type": "cancel", "turn_id": "t1"}
+    {"type": "ping"}
+
+Server -> client:
+    {"type": "ready", "user_id": 1}
+    {"type": "thought" | "text", "turn_id": "t1", "content": "..."}   pushed as generated
+    {"type": "done", "turn_id": "t1", "status": "completed" | "cancelled" | "failed" | "rejected"}
+    {"type": "error", "turn_id": "t1" | null, "status_code": 429, "detail": "...", "retry_after": 3}
+    {"type": "pong"}
+
+Turns go through admission control like /chat. They stream straight from the
+generator, without the Redis response stream: the connection is the delivery
+channel, and a dropped connection cancels its turns.
+
+Cancellation stops the turn at once and cancels the upstream LLM streams through
+the router (llm_router.CancelToken). The partial answer is not saved.
+
+Backpressure: turn frames go through one bounded send queue per connection.
+When the client does not keep up and the queue is full, text deltas are merged
+into a single larger frame instead of queueing many small ones. Once a turn has
+WS_MAX_BUFFERED_BYTES merged, it waits for the socket. Its read-ahead buffer
+then fills up, and the generator pauses.
+
+Control replies (pong, errors) go through a small separate queue that the
+writer drains first. They are dropped rather than waited for when it is full,
+so the receive loop never blocks and `cancel` frames are still handled while
+the client is behind.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect, status
+from jose import jwt
+from pydantic import ValidationError
+from starlette.concurrency import iterate_in_threadpool
+
+from app.core.config import settings
+from app.core.logging_config import bind_log_context
+from app.core.metrics import Counter, REGISTRY, timed
+from app.core.security import authenticate_token
+from app.db.database import AsyncSessionLocal
+from app.models.user import User
+from app.schemas.chat import ChatTurn
+from app.services import admission
+from app.services.llm_router import CancelToken, cancel_scope
+from app.services.llm_service import stream_chat_response_with_history
+from app.services.stream_encoder import TextCoalescer
+from app.services.user_service import get_user_profile
+
+logger = logging.getLogger(__name__)
+
+ws_chat_turns_total = Counter(
+    "ws_chat_turns_total",
+    "WebSocket chat turns by final status.",
+    ("status",),
+)
+REGISTRY.append(ws_chat_turns_total)
+
+_END = object()
+# Pending control replies per connection; more than this are dropped
+CONTROL_QUEUE_SIZE = 16
+
+
+class _TurnEncoder:
+    """Encodes a turn's events as JSON text frames tagged with its turn_id (TextCoalescer calls encode)."""
+
+    def __init__(self, turn_id: str):
+        self.turn_id = turn_id
+
+    def encode(self, event: Dict, event_id=None) -> str:
+        return orjson.dumps({**event, "turn_id": self.turn_id}).decode()
+
+
+class _Turn:
+    def __init__(self, turn_id: str, session_id: str):
+        self.turn_id = turn_id
+        self.session_id = session_id
+        self.token = CancelToken()
+        self.task: Optional[asyncio.Task] = None
+        self.producer: Optional[asyncio.Task] = None
+
+    def cancel(self):
+        self.token.cancel()
+        for task in (self.task, self.producer):
+            if task is not None:
+                task.cancel()
+
+
+async def _authenticate(token: str):
+    """Returns (user, expires_at) for a valid access token, else (None, None)."""
+    if not isinstance(token, str) or not token:
+        return None, None
+    async with AsyncSessionLocal() as db:
+        user = await authenticate_token(db, token)
+    if user is None:
+        return None, None
+    return user, jwt.get_unverified_claims(token).get("exp")
+
+
+class ChatConnection:
+    """One authenticated WebSocket and the turns multiplexed over it."""
+
+    def __init__(self, websocket: WebSocket, user: User, expires_at: Optional[float]):
+        self.websocket = websocket
+        self.user = user
+        self.expires_at = expires_at
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.control: asyncio.Queue = asyncio.Queue(maxsize=CONTROL_QUEUE_SIZE)
+        self._ready = asyncio.Event()
+        self.turns: Dict[str, _Turn] = {}
+        self.closed = False
+
+    async def send(self, frame):
+        if self.closed:
+            return
+        if not isinstance(frame, str):
+            frame = orjson.dumps(frame).decode()
+        await self.outbox.put(frame)
+        self._ready.set()
+
+    def send_control(self, frame: Dict):
+        """Queues a control reply without waiting. Dropped if the client is that far behind."""
+        if self.closed:
+            return
+        try:
+            self.control.put_nowait(orjson.dumps(frame).decode())
+        except asyncio.QueueFull:
+            logger.debug("Dropped a %s frame for a slow WebSocket client", frame.get("type"))
+            return
+        self._ready.set()
+
+    def send_error(self, turn_id: Optional[str], status_code: int, detail: str, retry_after=None):
+        self.send_control({
+            "type": "error", "turn_id": turn_id, "status_code": status_code, "detail": detail,
+            "retry_after": retry_after,
+        })
+
+    async def _write(self):
+        # The only task that writes to the socket; send_text waits while the client's TCP window is full
+        try:
+            while True:
+                if self.control.empty() and self.outbox.empty():
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                queue = self.control if not self.control.empty() else self.outbox
+                await self.websocket.send_text(queue.get_nowait())
+        except Exception:
+            # Disconnected; the receive loop sees it and cleans up
+            self.closed = True
+
+    async def run(self):
+        writer = asyncio.create_task(self._write())
+        try:
+            await self.send({"type": "ready", "user_id": self.user.id})
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                try:
+                    frame = orjson.loads(message.get("text") or message.get("bytes") or b"")
+                except orjson.JSONDecodeError:
+                    self.send_error(None, status.HTTP_400_BAD_REQUEST, "Frames must be JSON objects.")
+                    continue
+                if not await self.dispatch(frame if isinstance(frame, dict) else {}):
+                    break
+        finally:
+            self.closed = True
+            # Nobody is listening any more: stop generating
+            for turn in list(self.turns.values()):
+                turn.cancel()
+            writer.cancel()
+
+    async def dispatch(self, frame: Dict) -> bool:
+        """Handles one client frame. Returns False if the connection should close."""
+        kind = frame.get("type")
+        if kind == "chat":
+            await self.start_turn(frame)
+        elif kind == "cancel":
+            turn = self.turns.get(frame.get("turn_id"))
+            if turn is not None:
+                # The turn reports {"type": "done", "status": "cancelled"} itself
+                turn.cancel()
+        elif kind == "auth":
+            user, expires_at = await _authenticate(frame.get("token"))
+            if user is None or user.id != self.user.id:
+                await self.websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
+                return False
+            self.expires_at = expires_at
+        elif kind == "ping":
+            self.send_control({"type": "pong"})
+        else:
+            self.send_error(None, status.HTTP_400_BAD_REQUEST, f"Unknown frame type: {kind!r}")
+        return True
+
+    async def start_turn(self, frame: Dict):
+        try:
+            request = ChatTurn.model_validate(frame)
+        except ValidationError as e:
+            self.send_error(frame.get("turn_id"), status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
+            return
+        if self.expires_at is not None and time.time() >= self.expires_at:
+            self.send_error(request.turn_id, status.HTTP_401_UNAUTHORIZED,
+                            "Token expired; send a new auth frame.")
+            return
+        if request.turn_id in self.turns:
+            self.send_error(request.turn_id, status.HTTP_409_CONFLICT, "turn_id is already in use.")
+            return
+        if any(turn.session_id == request.session_id for turn in self.turns.values()):
+            self.send_error(request.turn_id, status.HTTP_409_CONFLICT,
+                            "A turn is already running in this session.")
+            return
+        if len(self.turns) >= settings.WS_MAX_CONCURRENT_TURNS:
+            self.send_error(request.turn_id, status.HTTP_429_TOO_MANY_REQUESTS,
+                            "Too many turns in flight on this connection.")
+            return
+        turn = _Turn(request.turn_id, request.session_id)
+        self.turns[turn.turn_id] = turn
+        turn.task = asyncio.create_task(self.run_turn(turn, request))
+
+    async def run_turn(self, turn: _Turn, request: ChatTurn):
+        bind_log_context(session_id=request.session_id, user_id=self.user.id)
+        outcome = "completed"
+        lease = None
+        try:
+            lease = await admission.admit(self.user.id, "chat")
+            with timed("profile_query"):
+                async with AsyncSessionLocal() as db:
+                    user_profile = await get_user_profile(db, self.user.id)
+
+            events = stream_chat_response_with_history(
+                user_id=self.user.id,
+                session_id=request.session_id,
+                user_message=request.message,
+                enable_tools=request.enable_tools,
+                use_rag=request.use_rag,
+                user_profile=user_profile,
+            )
+            pending: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_TURN_READ_AHEAD)
+            # The producer owns the lease from here: it is released when generation actually stops
+            turn.producer = asyncio.create_task(self._produce(turn, events, pending, lease))
+            lease = None
+            await self._relay(turn, pending)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+        except admission.AdmissionRejected as e:
+            outcome = "rejected"
+            self.send_error(turn.turn_id, e.status_code, e.detail, int(e.headers["Retry-After"]))
+        except Exception:
+            logger.exception("WebSocket chat turn %s failed", turn.turn_id)
+            outcome = "failed"
+        finally:
+            if lease:
+                lease.release()
+            self.turns.pop(turn.turn_id, None)
+            ws_chat_turns_total.inc(status=outcome)
+            await self.send({"type": "done", "turn_id": turn.turn_id, "status": outcome})
+
+    async def _produce(self, turn: _Turn, events, pending: asyncio.Queue, lease):
+        try:
+            # The cancel token reaches the router inside the generator's thread (contexts are copied)
+            with cancel_scope(turn.token):
+                async for event in iterate_in_threadpool(events):
+                    await pending.put(event)
+        except Exception as e:
+            await pending.put(e)
+        finally:
+            if lease:
+                lease.release()
+        await pending.put(_END)
+
+    async def _relay(self, turn: _Turn, pending: asyncio.Queue):
+        encoder = _TurnEncoder(turn.turn_id)
+        coalescer = TextCoalescer(settings.STREAM_COALESCE_MAX_BYTES, settings.STREAM_COALESCE_MAX_MS / 1000)
+        deferred = False
+        while True:
+            timeout = coalescer.time_left()
+            if deferred:
+                # The client is behind: give the send queue a window to drain before trying again
+                timeout = coalescer.max_delay_s
+            try:
+                item = await asyncio.wait_for(pending.get(), timeout) if timeout is not None else await pending.get()
+            except asyncio.TimeoutError:
+                deferred = not await self._flush_text(coalescer, encoder)
+                continue
+
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item.get("type") == "text":
+                if coalescer.add(item.get("content", "")):
+                    deferred = not await self._flush_text(coalescer, encoder)
+            else:
+                await self._flush_text(coalescer, encoder, force=True)
+                deferred = False
+                await self.send(encoder.encode(item))
+        await self._flush_text(coalescer, encoder, force=True)
+
+    async def _flush_text(self, coalescer: TextCoalescer, encoder: _TurnEncoder, force: bool = False) -> bool:
+        """Sends the buffered text, unless the client is behind and the buffer is still small. Returns True if sent."""
+        if not force and self.outbox.full() and coalescer.size < settings.WS_MAX_BUFFERED_BYTES:
+            return False
+        frame = coalescer.flush(encoder)
+        if frame:
+            await self.send(frame)
+        return True
+
+
+async def serve(websocket: WebSocket):
+    """Accepts the socket, waits for the auth frame, then runs the connection until it closes."""
+    await websocket.accept()
+    try:
+        first = orjson.loads(await asyncio.wait_for(websocket.receive_text(), settings.WS_AUTH_TIMEOUT_S))
+        token = first.get("token") if isinstance(first, dict) and first.get("type") == "auth" else None
+    except WebSocketDisconnect:
+        return
+    except (asyncio.TimeoutError, orjson.JSONDecodeError, KeyError):
+        token = None
+    user, expires_at = await _authenticate(token)
+    if user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
+        return
+    bind_log_context(user_id=user.id)
+    await ChatConnection(websocket, user, expires_at).run()
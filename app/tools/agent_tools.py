@@ -1,5 +1,8 @@
+import logging
 from typing import Literal
 
+logger = logging.getLogger(__name__)
+
 def get_real_time_stock_price(ticker_symbol: str) -> str:
     """
     REQUIRED: Call this function whenever the user asks for the price, 
@@ -7,7 +10,7 @@ def get_real_time_stock_price(ticker_symbol: str) -> str:
     """
     # For now, we return a mock value.
 
-    print(f"DEBUG: stock price tool triggered!")
+    logger.debug("Stock price tool triggered for %s", ticker_symbol)
     if ticker_symbol.upper() == "GOOG":
         return "The current price for GOOG is $142.50. (Source: Mock API)"
     elif ticker_symbol.upper() == "MSFT":
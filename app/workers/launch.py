@@ -0,0 +1,43 @@
+# app/workers/launch.py
+
+"""
+Starts a Celery worker for one of the profiles in app/workers/queues.py:
+
+    python -m app.workers.launch io      # profile updates + embeddings (threads)
+    python -m app.workers.launch cpu     # PDF parsing and chunking (prefork)
+    python -m app.workers.launch long    # long-running jobs
+    python -m app.workers.launch all     # everything, for local development
+
+Extra arguments are passed to `celery worker`, e.g. `--loglevel=debug` or
+`--autoscale=32,4`. They override the profile's own options.
+"""
+
+import sys
+
+from app.workers.queues import WORKER_PROFILES
+
+
+def worker_argv(profile: str, extra=()):
+    options = WORKER_PROFILES[profile]
+    argv = [
+        "worker",
+        "--hostname", f"{profile}@%h",
+        "--queues", ",".join(options["queues"]),
+        "--pool", options["pool"],
+        "--prefetch-multiplier", str(options["prefetch_multiplier"]),
+        "--loglevel", "info",
+    ]
+    if options["concurrency"]:
+        argv += ["--concurrency", str(options["concurrency"])]
+    return argv + list(extra)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in WORKER_PROFILES:
+        sys.exit(f"usage: python -m app.workers.launch {{{','.join(WORKER_PROFILES)}}} [celery worker options]")
+    from app.workers.worker import celery_app
+    celery_app.worker_main(worker_argv(sys.argv[1], sys.argv[2:]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# app/workers/queues.py
+
+"""
+Celery queues, task routing and worker profiles.
+
+Each kind of work has its own queue, so a large ingestion batch no longer delays
+every user's profile update, and a sleeping `run_long_task` no longer holds the
+slot a profile update needs:
+
+| Queue       | Tasks                          | Bound by                    |
+|-------------|--------------------------------|-----------------------------|
+| `profile`   | update_user_profile            | I/O (LLM call)              |
+| `embedding` | embed_chunks_task              | I/O (embedding calls)       |
+| `ingestion` | index_document_task            | CPU (PDF parsing, chunking) |
+| `long`      | job_service.run_long_task,     | wall clock                  |
+|             | batch_generate                 |                             |
+
+A worker is started with a profile (`python -m app.workers.launch <profile>`)
+that picks its queues, pool, concurrency and prefetch:
+
+- `io`: profile + embedding on a thread pool with high concurrency. These
+  tasks mostly wait on the network (and on the shared LLM limiter).
+- `cpu`: ingestion on a prefork pool, one process per core, prefetch 1, so a
+  worker never hoards long parsing jobs while its siblings are idle.
+- `long`: long-running jobs, prefetch 1.
+- `all`: every queue in one worker (local development).
+
+This module does not import Celery: the API reads the queue names from it to
+report queue depth on /metrics.
+"""
+
+from app.core.config import settings
+
+PROFILE_QUEUE = "profile"
+EMBEDDING_QUEUE = "embedding"
+INGESTION_QUEUE = "ingestion"
+LONG_QUEUE = "long"
+QUEUES = (PROFILE_QUEUE, EMBEDDING_QUEUE, INGESTION_QUEUE, LONG_QUEUE)
+
+TASK_ROUTES = {
+    "update_user_profile": {"queue": PROFILE_QUEUE},
+    "embed_chunks_task": {"queue": EMBEDDING_QUEUE},
+    "index_document_task": {"queue": INGESTION_QUEUE},
+    "job_service.run_long_task": {"queue": LONG_QUEUE},
+    "batch_generate": {"queue": LONG_QUEUE},
+}
+
+# Redis broker priorities: 0 is served first. Every priority level is a separate
+# Redis list named "<queue>" (priority 0) or "<queue>:<priority>".
+PRIORITY_STEPS = list(range(10))
+PRIORITY_SEPARATOR = ":"
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+
+WORKER_PROFILES = {
+    "io": {
+        "queues": (PROFILE_QUEUE, EMBEDDING_QUEUE),
+        "pool": "threads",
+        "concurrency": settings.CELERY_IO_CONCURRENCY,
+        "prefetch_multiplier": 4,
+    },
+    "cpu": {
+        "queues": (INGESTION_QUEUE,),
+        "pool": "prefork",
+        "concurrency": settings.CELERY_CPU_CONCURRENCY,  # None: one process per core
+        "prefetch_multiplier": 1,
+    },
+    "long": {
+        "queues": (LONG_QUEUE,),
+        "pool": "threads",
+        "concurrency": settings.CELERY_LONG_CONCURRENCY,
+        "prefetch_multiplier": 1,
+    },
+    "all": {
+        "queues": QUEUES,
+        "pool": "prefork",
+        "concurrency": None,
+        "prefetch_multiplier": 1,
+    },
+}
+
+
+def priority_lists(queue: str):
+    """Names of the Redis lists that hold `queue`'s messages, one per priority level."""
+    return [queue if step == PRIORITY_STEPS[0] else f"{queue}{PRIORITY_SEPARATOR}{step}" for step in PRIORITY_STEPS]
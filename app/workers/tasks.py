@@ -1,29 +1,45 @@
 # app/workers/tasks.py
 
+import logging
 import time
 import os
+import uuid
+import orjson
+from redis.exceptions import RedisError
 from app.workers.worker import celery_app
 from app.services.chat_history import get_session_history
 from app.core.config import settings
+from app.db.redis_client import get_redis
 from app.db.database import SessionLocal
 from app.models.user import User
-from google import genai
+from app.services.llm_provider import get_llm_provider
+from app.services.llm_limiter import background_priority, get_llm_limiter
+from app.services.usage import FEATURE_DOCUMENT_EMBEDDING, FEATURE_PROFILE_UPDATE, record_usage, usage_scope
+from app.core.logging_config import bind_log_context
+from app.workers.queues import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
 
-from celery import shared_task
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from app.services.vector_db_service import save_chunk_to_vector_db
+from app.services.batch_service import BatchRunner
 
+logger = logging.getLogger(__name__)
 
+# Chunk text of one embedding batch. Tasks carry only this key, so document text
+# stays out of broker messages, task logs and the result backend.
+INGESTION_CHUNKS_KEY = "ingestion_chunks:{batch_id}"
 
-def get_genai_client():
-    """Lazy initialization of genai client."""
-    return genai.Client(api_key=settings.GOOGLE_API_KEY)
 
 
-@celery_app.task(name="update_user_profile")
+def _time_limits(seconds: int):
+    """Celery task options for a hard limit of `seconds` and a soft limit at 90% of it (prefork pools only)."""
+    return {"time_limit": seconds, "soft_time_limit": int(seconds * 0.9)}
+
+
+# Idempotent (the profile is recomputed from history), so it is safe to redeliver if a worker dies
+@celery_app.task(name="update_user_profile", acks_late=True, priority=PRIORITY_NORMAL,
+                 **_time_limits(settings.CELERY_PROFILE_TIME_LIMIT_S))
 def update_user_profile_task(user_id: str, session_id: str):
     """Background task: Analyze user conversation and update profile."""
+    bind_log_context(session_id=session_id, user_id=user_id)
 
     raw_history = get_session_history(user_id, session_id)
 
@@ -41,18 +57,24 @@ def update_user_profile_task(user_id: str, session_id: str):
     """
 
     try:
-        client = get_genai_client()
-        response = client.models.generate_content(
-            model=settings.GOOGLE_LLM_MODEL,
-            contents=[{
-                "role": "user",
-                "parts": [{"text": prompt}]
-            }]
-        )
-        new_profile = response.text.strip()
+        # Background priority: waits for upstream capacity instead of competing with /chat
+        with background_priority(), get_llm_limiter().acquire():
+            new_profile, usage = get_llm_provider().generate_with_usage(
+                contents=[{
+                    "role": "user",
+                    "parts": [{"text": prompt}]
+                }]
+            )
     except Exception as e:
-        print(f"[ERROR] Gemini failed: {e}")
+        logger.error("LLM provider failed while updating profile for user %s: %s", user_id, e)
         return
+    record_usage(
+        user_id, FEATURE_PROFILE_UPDATE,
+        requests=1,
+        input_tokens=usage.get("input_tokens", 0),
+        output_tokens=usage.get("output_tokens", 0),
+        cached_tokens=usage.get("cached_tokens", 0),
+    )
 
     # Save to DB
     with SessionLocal() as db:
@@ -60,34 +82,68 @@ def update_user_profile_task(user_id: str, session_id: str):
         if user:
             user.user_profile = new_profile
             db.commit()
-            print(f"[INFO] Updated user profile for {user_id}")
+            logger.info("Updated user profile for %s", user_id)
 
 
 
 # Example Task
-@celery_app.task(name="job_service.run_long_task")
+@celery_app.task(name="job_service.run_long_task", acks_late=True, priority=PRIORITY_LOW,
+                 **_time_limits(settings.CELERY_LONG_TIME_LIMIT_S))
 def run_long_task(task_id: str, duration: int = 5):
     """Simulates a long-running process."""
-    print(f"Starting task {task_id}. Will run for {duration} seconds.")
+    logger.info("Starting task %s. Will run for %s seconds.", task_id, duration)
     time.sleep(duration)
     result = f"Task {task_id} completed successfully after {duration}s."
-    print(result)
+    logger.info(result)
     return result
 
 
 
+# acks_late: the results file is the checkpoint, so a redelivered task skips what was already answered
+@celery_app.task(name="batch_generate", bind=True, acks_late=True, priority=PRIORITY_LOW, max_retries=5,
+                 **_time_limits(settings.CELERY_LONG_TIME_LIMIT_S))
+def batch_generate_task(self, job_id: str):
+    """Answers a batch job's prompts (see app/services/batch_service.py), one BATCH_SLICE_S slice per task."""
+    runner = BatchRunner(job_id)
+    try:
+        requeue = runner.run()
+    except RedisError as e:
+        # The runner fails the job on any other error; Redis errors are worth retrying
+        if self.request.retries >= self.max_retries:
+            runner.fail(f"{type(e).__name__}: {e}")
+            raise
+        raise self.retry(exc=e, countdown=min(300, 10 * 2 ** self.request.retries))
+    if requeue:
+        # Continue in a new task, well under the time limit
+        batch_generate_task.apply_async(args=[job_id], priority=PRIORITY_LOW)
+
+
+
 """
 This part is for the RAG Document Indexing TASK
 """
 
-@shared_task(name="index_document_task")
+# Bound to celery_app explicitly: shared_task resolves the "current" app per thread, and
+# this module may first be imported by the warm-up thread (app/core/startup.py).
+# acks_late: the file is removed only after every batch is queued, so a task lost with its worker is parsed again.
+# Chunk ids are deterministic, so the batches queued again overwrite the vectors already saved.
+@celery_app.task(name="index_document_task", acks_late=True, priority=PRIORITY_NORMAL,
+             **_time_limits(settings.CELERY_INGESTION_TIME_LIMIT_S))
 def index_document_task(file_path: str, user_id: str):
+    """
+    CPU-bound half of indexing (ingestion queue): parses and chunks the PDF, then
+    hands the chunks to embed_chunks_task in batches on the I/O-bound embedding queue.
+    """
+    # Document loaders are heavy; only workers that actually index pay for the import
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     # --- 1. Load the Document ---
     try:
         loader = PyPDFLoader(file_path)
         documents = loader.load()
     except Exception as e:
-        print(f"[ERROR] Failed to load document: {e}")
+        logger.error("Failed to load document %s: %s", file_path, e)
         return
 
     # --- 2. Chunking Strategies ---
@@ -99,23 +155,68 @@ def index_document_task(file_path: str, user_id: str):
     
     chunks = text_splitter.split_documents(documents)
 
-    # --- 3. Embeddings and Vector Store
+    # --- 3. Metadata
     # Before saving, inject metadata (user_id) into each chunk
     # This is CRITICAL for user-specific RAG (ensuring one user only searches their own docs)
+    source = os.path.basename(file_path)
     for chunk in chunks:
         # LangChain stores metadata as a dictionary in the 'metadata' attribute
         chunk.metadata["user_id"] = user_id
-        chunk.metadata["source"] = os.path.basename(file_path)
-        
-    try:
-        # Call the service function to generate embeddings and save to vector DB
-        save_chunk_to_vector_db(chunks)
-        print("Successfully saved chunks to vector store.")
-        
-    except Exception as e:
-        print(f"FATAL ERROR during PGVector storage: {e}")
-        # Log the error but continue to clean up the file
-
-    # --- 4. Clean up
+        chunk.metadata["source"] = source
+
+    # --- 4. Embeddings and Vector Store, on the embedding queue
+    # Ahead of new parsing work, so documents that were started finish first
+    batch_size = settings.INGESTION_EMBED_BATCH_SIZE
+    for start in range(0, len(chunks), batch_size):
+        batch = [
+            {"id": _chunk_id(user_id, source, index), "page_content": chunk.page_content, "metadata": chunk.metadata}
+            for index, chunk in enumerate(chunks[start:start + batch_size], start)
+        ]
+        embed_chunks_task.apply_async(args=[_stash_chunks(batch)], priority=PRIORITY_HIGH)
+
+    # --- 5. Clean up (the chunks wait in Redis for the embedding tasks)
     os.remove(file_path)
-    print(f"Indexing complete. Removed file: {file_path}")
+    logger.info("Parsed %s into %d chunks. Removed file.", file_path, len(chunks))
+
+
+def _chunk_id(user_id: str, source: str, index: int) -> str:
+    """Vector store id of a document's `index`-th chunk; the same every time the document is parsed."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{user_id}/{source}/{index}"))
+
+
+def _stash_chunks(batch: list) -> str:
+    """Stores one embedding batch in Redis and returns its key."""
+    key = INGESTION_CHUNKS_KEY.format(batch_id=uuid.uuid4().hex)
+    get_redis().set(key, orjson.dumps(batch), ex=settings.INGESTION_CHUNKS_TTL_S)
+    return key
+
+
+# The PDF is gone by now, so a failed batch is retried rather than dropped. After the
+# last retry the task fails (and is logged as failed) instead of being acked as done.
+@celery_app.task(name="embed_chunks_task", acks_late=True, priority=PRIORITY_NORMAL,
+             autoretry_for=(Exception,), max_retries=settings.INGESTION_EMBED_MAX_RETRIES,
+             retry_backoff=True, retry_backoff_max=600, retry_jitter=True,
+             **_time_limits(settings.CELERY_EMBEDDING_TIME_LIMIT_S))
+def embed_chunks_task(chunks_key):
+    """I/O-bound half of indexing (embedding queue): embeds a batch of chunks and saves them."""
+    from langchain_core.documents import Document
+
+    if isinstance(chunks_key, list):
+        chunks = chunks_key  # Queued before chunks were passed by reference
+    else:
+        payload = get_redis().get(chunks_key)
+        if payload is None:
+            logger.error("Chunks %s expired before they were embedded", chunks_key)
+            return
+        chunks = orjson.loads(payload)
+
+    documents = [Document(page_content=chunk["page_content"], metadata=chunk["metadata"]) for chunk in chunks]
+    # Batches queued before chunks had ids get random ones, as before
+    ids = [chunk["id"] for chunk in chunks] if all("id" in chunk for chunk in chunks) else None
+    # Call the service function to generate embeddings and save to vector DB (one transaction)
+    # The embedding tokens are charged to the user who uploaded the document
+    with background_priority(), usage_scope(chunks[0]["metadata"].get("user_id"), FEATURE_DOCUMENT_EMBEDDING):
+        save_chunk_to_vector_db(documents, ids=ids)
+    if not isinstance(chunks_key, list):
+        get_redis().delete(chunks_key)
+    logger.info("Saved %d chunks to the vector store.", len(documents))
@@ -1,8 +1,14 @@
 
 # app/workers/worker.py
 
+import time
 from celery import Celery
+from kombu import Queue
+from celery.signals import task_prerun, task_postrun, setup_logging as celery_setup_logging
 from app.core.config import settings
+from app.core.metrics import record_celery_task_duration
+from app.core.logging_config import clear_log_context, setup_logging
+from app.workers.queues import LONG_QUEUE, PRIORITY_NORMAL, PRIORITY_SEPARATOR, PRIORITY_STEPS, QUEUES, TASK_ROUTES
 
 celery_app = Celery(
     'worker',
@@ -10,4 +16,45 @@ celery_app = Celery(
     backend=settings.CELERY_RESULT_BACKEND,
 )
 
-celery_app.autodiscover_tasks(['app.workers'])
\ No newline at end of file
+celery_app.conf.task_always_eager = settings.CELERY_TASK_ALWAYS_EAGER
+
+# Routing: one queue per workload (see app/workers/queues.py)
+celery_app.conf.task_queues = [Queue(name) for name in QUEUES]
+celery_app.conf.task_routes = TASK_ROUTES
+# Unrouted tasks go where they cannot delay interactive follow-up work
+celery_app.conf.task_default_queue = LONG_QUEUE
+celery_app.conf.task_default_priority = PRIORITY_NORMAL
+celery_app.conf.broker_transport_options = {
+    "priority_steps": PRIORITY_STEPS,
+    "sep": PRIORITY_SEPARATOR,
+    "queue_order_strategy": "priority",
+    # Tasks with acks_late that are not acknowledged within this are redelivered
+    "visibility_timeout": settings.CELERY_VISIBILITY_TIMEOUT_S,
+}
+# Prefetch is set per worker profile (app/workers/launch.py); this is the fallback
+celery_app.conf.worker_prefetch_multiplier = 1
+
+celery_app.autodiscover_tasks(['app.workers'])
+
+
+# Use the app's JSON queue-based logging instead of Celery's default handlers
+@celery_setup_logging.connect
+def _configure_logging(**kwargs):
+    setup_logging()
+
+
+# --- Task duration metrics (exposed by the API on /metrics) ---
+_task_started = {}
+
+@task_prerun.connect
+def _start_task_timer(task_id=None, **kwargs):
+    # Pool threads run many tasks: start each without the previous task's user and session
+    clear_log_context()
+    _task_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def _record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None and task is not None:
+        record_celery_task_duration(task.name, state or "UNKNOWN", time.perf_counter() - started)
+    clear_log_context()
@@ -0,0 +1,402 @@
+"""
+Load-testing and benchmark suite for the chat, RAG and auth endpoints.
+
+Starts the API against local stand-ins (see benchmarks/serve.py: stub LLM
+provider, fakeredis or a local Redis, SQLite or a local Postgres), drives each
+scenario at the requested concurrency and prints a machine-readable JSON report:
+
+    python benchmarks/run_benchmarks.py --concurrency 16 --requests 200 --output bench.json
+    python benchmarks/run_benchmarks.py --output new.json --compare bench.json
+
+Scenarios: auth_login, auth_refresh, upload_document, chat_plain, chat_tools, chat_rag.
+
+For every scenario the report contains latency, time-to-first-byte of the stream
+("ttft"), inter-chunk latency (p50/p95/p99), throughput and errors, plus the peak
+RSS of every server process sampled while the scenario ran.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALL_SCENARIOS = ["auth_login", "auth_refresh", "upload_document", "chat_plain", "chat_tools", "chat_rag"]
+PASSWORD = "benchmark-password"
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def distribution(values):
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def make_pdf(text: str) -> bytes:
+    """Builds a minimal one-page PDF containing `text` (enough for PyPDFLoader)."""
+    stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def read_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def process_tree(pid: int):
+    """The server process and all of its descendants (Linux /proc)."""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as children:
+                pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+class RSSSampler:
+    """Samples the peak RSS of every server process in the background."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peaks = {}
+        self._task = None
+
+    async def _run(self):
+        while True:
+            for pid in process_tree(self.pid):
+                rss = read_rss_mb(pid)
+                if rss is not None:
+                    self.peaks[pid] = max(self.peaks.get(pid, 0.0), rss)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.peaks = {}
+        if self.pid:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        return {str(pid): round(rss, 1) for pid, rss in sorted(self.peaks.items())}
+
+
+class Slot:
+    """One simulated client with its own user and tokens."""
+
+    def __init__(self, index):
+        self.index = index
+        self.email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+        self.access_token = None
+        self.refresh_token = None
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+
+async def timed_request(client, method, url, stream=False, **kwargs):
+    """Returns (ok, latency_s, ttft_s, inter_chunk_gaps, response_json)."""
+    started = time.perf_counter()
+    if not stream:
+        response = await client.request(method, url, **kwargs)
+        latency = time.perf_counter() - started
+        payload = response.json() if response.headers.get("content-type", "").startswith("application/json") else None
+        return response.is_success, latency, None, [], payload
+
+    ttft, gaps, last = None, [], None
+    async with client.stream(method, url, **kwargs) as response:
+        async for chunk in response.aiter_raw():
+            if not chunk:
+                continue
+            now = time.perf_counter()
+            if ttft is None:
+                ttft = now - started
+            else:
+                gaps.append(now - last)
+            last = now
+        ok = response.is_success
+    return ok, time.perf_counter() - started, ttft, gaps, None
+
+
+async def login(client, slot):
+    ok, latency, _, _, payload = await timed_request(
+        client, "POST", "/api/v1/auth/login", json={"email": slot.email, "password": PASSWORD}
+    )
+    if ok:
+        slot.access_token = payload["access_token"]
+        slot.refresh_token = payload["refresh_token"]
+    return ok, latency, None, []
+
+
+async def refresh(client, slot):
+    ok, latency, _, _, payload = await timed_request(
+        client, "POST", "/api/v1/auth/refresh", json=slot.refresh_token
+    )
+    if ok:
+        slot.access_token = payload["access_token"]
+        slot.refresh_token = payload["refresh_token"]
+    return ok, latency, None, []
+
+
+async def upload(client, slot, pdf_bytes):
+    files = {"file": (f"bench-{slot.index}-{uuid.uuid4().hex[:8]}.pdf", pdf_bytes, "application/pdf")}
+    ok, latency, _, _, _ = await timed_request(
+        client, "POST", "/api/v1/llm/upload-document", files=files, headers=slot.headers
+    )
+    return ok, latency, None, []
+
+
+def chat_scenario(enable_tools, use_rag):
+    async def run(client, slot, message):
+        ok, latency, ttft, gaps, _ = await timed_request(
+            client,
+            "POST",
+            "/api/v1/llm/chat",
+            stream=True,
+            params={"enable_tools": str(enable_tools).lower()},
+            json={"message": message, "session_id": f"bench-session-{slot.index}", "use_rag": use_rag},
+            headers=slot.headers,
+        )
+        return ok, latency, ttft, gaps
+    return run
+
+
+async def run_scenario(name, client, slots, total_requests, sampler, pdf_bytes):
+    chat_runners = {
+        "chat_plain": chat_scenario(enable_tools=False, use_rag=False),
+        "chat_tools": chat_scenario(enable_tools=True, use_rag=False),
+        "chat_rag": chat_scenario(enable_tools=False, use_rag=True),
+    }
+    counter = iter(range(total_requests))
+    results = []
+
+    async def call(slot, number):
+        if name == "auth_login":
+            return await login(client, slot)
+        if name == "auth_refresh":
+            return await refresh(client, slot)
+        if name == "upload_document":
+            return await upload(client, slot, pdf_bytes)
+        return await chat_runners[name](client, slot, f"Benchmark question number {number} about the documents")
+
+    async def worker(slot):
+        for number in counter:
+            try:
+                results.append(await call(slot, number))
+            except httpx.HTTPError:
+                results.append((False, None, None, []))
+
+    sampler.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(slot) for slot in slots))
+    wall = time.perf_counter() - started
+    rss = await sampler.stop()
+
+    ok_results = [result for result in results if result[0]]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok_results),
+        "concurrency": len(slots),
+        "wall_s": wall,
+        "throughput_rps": len(ok_results) / wall if wall else None,
+        "latency_s": distribution([result[1] for result in ok_results]),
+        "ttft_s": distribution([result[2] for result in ok_results if result[2] is not None]),
+        "inter_chunk_s": distribution([gap for result in ok_results for gap in result[3]]),
+        "peak_rss_mb": rss,
+    }
+
+
+async def wait_until_ready(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/")).is_success:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"Server at {base_url} did not become ready in {timeout}s")
+
+
+async def benchmark(args, server_pid):
+    await wait_until_ready(args.base_url)
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        slots = [Slot(index) for index in range(args.concurrency)]
+        for slot in slots:
+            response = await client.post("/api/v1/auth/register", json={"email": slot.email, "password": PASSWORD})
+            response.raise_for_status()
+            ok, *_ = await login(client, slot)
+            if not ok:
+                raise RuntimeError("Benchmark user could not log in")
+
+        pdf_bytes = make_pdf("Benchmark knowledge base document. " * 20)
+        sampler = RSSSampler(server_pid)
+        report = {}
+        for name in args.scenarios:
+            report[name] = await run_scenario(name, client, slots, args.requests, sampler, pdf_bytes)
+            print(f"{name}: {report[name]['requests']} requests, {report[name]['errors']} errors, "
+                  f"{report[name]['throughput_rps']:.1f} req/s", file=sys.stderr)
+        return report
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args):
+    env = dict(os.environ)
+    env.update({
+        "STUB_TTFT_MS": str(args.ttft_ms),
+        "STUB_TOKENS_PER_SEC": str(args.tokens_per_sec),
+        "STUB_RESPONSE_TOKENS": str(args.response_tokens),
+        "STUB_FUNCTION_CALL_RATE": str(args.function_call_rate),
+    })
+    command = [sys.executable, os.path.join(ROOT, "benchmarks", "serve.py"),
+               "--port", str(args.port), "--workers", str(args.workers)]
+    if args.redis_url:
+        command += ["--redis-url", args.redis_url]
+    return subprocess.Popen(command, env=env)
+
+
+def compare(report, baseline, threshold):
+    """Prints per-scenario deltas against `baseline`; returns True if any p95/p99 regressed beyond `threshold` %."""
+    regressed = False
+    for name, current in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for metric in ("latency_s", "ttft_s", "inter_chunk_s"):
+            for pct in ("p50", "p95", "p99"):
+                old = (previous.get(metric) or {}).get(pct)
+                new = (current.get(metric) or {}).get(pct)
+                if not old or new is None:
+                    continue
+                delta = (new - old) / old * 100
+                flag = ""
+                if pct != "p50" and delta > threshold:
+                    regressed, flag = True, "  REGRESSION"
+                print(f"{name:16} {metric:14} {pct}: {old * 1000:9.1f}ms -> {new * 1000:9.1f}ms ({delta:+6.1f}%){flag}",
+                      file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default=None, help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--redis-url", default=None, help="Local Redis to use instead of fakeredis")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=50, help="Requests per scenario")
+    parser.add_argument("--scenarios", default=",".join(ALL_SCENARIOS))
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="Stub LLM time-to-first-token")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="Stub LLM streaming speed")
+    parser.add_argument("--response-tokens", type=int, default=64, help="Stub LLM answer length")
+    parser.add_argument("--function-call-rate", type=float, default=0.5, help="Stub LLM tool-call probability")
+    parser.add_argument("--output", default=None, help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", default=None, help="Baseline JSON report to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=10.0,
+                        help="Exit non-zero if a p95/p99 grows by more than this many percent")
+    args = parser.parse_args()
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(ALL_SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    server = None
+    if args.base_url is None:
+        args.base_url = f"http://127.0.0.1:{args.port}"
+        server = start_server(args)
+    try:
+        scenarios = asyncio.run(benchmark(args, server.pid if server else None))
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "scenarios": scenarios,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            if compare(report, json.load(handle), args.regression_threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
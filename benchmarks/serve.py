@@ -0,0 +1,108 @@
+"""
+Starts the API against local stand-ins, for benchmarks and offline development.
+
+    python benchmarks/serve.py --port 8001 [--workers 4] [--redis-url redis://localhost:6379]
+
+The app is configured through the usual Settings environment variables. Defaults
+applied here (unless already set in the environment):
+
+- LLM_PROVIDER=stub           deterministic local model, no network
+- DATABASE_URL=sqlite:///...  a throwaway SQLite file
+- CELERY_TASK_ALWAYS_EAGER    tasks run inline, no broker needed
+- RATE_LIMIT_*_PER_MIN=0      per-user rate limits off
+
+Without --redis-url an in-process fakeredis server is used. Its state is not
+shared between processes, so it is only supported with a single worker.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def install_fakeredis():
+    """Routes every redis.Redis and redis.asyncio.Redis client of this process to one in-memory server."""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("fakeredis is not installed: pip install -r benchmarks/requirements.txt, or pass --redis-url")
+    import fakeredis.aioredis
+    import redis
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+
+    class SharedFakeRedis(fakeredis.FakeRedis):
+        def __init__(self, *args, **kwargs):
+            kwargs["server"] = server
+            super().__init__(*args, **kwargs)
+
+    redis.Redis = SharedFakeRedis
+    redis.StrictRedis = SharedFakeRedis
+
+    class SharedAsyncFakeRedis(fakeredis.aioredis.FakeRedis):
+        def __init__(self, *args, **kwargs):
+            kwargs["server"] = server
+            super().__init__(*args, **kwargs)
+
+    redis.asyncio.Redis = SharedAsyncFakeRedis
+
+
+def configure_environment(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="llm-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    # The upload endpoint stores documents relative to the working directory
+    os.chdir(workdir)
+
+    defaults = {
+        "LLM_PROVIDER": "stub",
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "SECRET_KEY": "benchmark-secret",
+        "REFRESH_SECRET_KEY": "benchmark-refresh-secret",
+        "CELERY_TASK_ALWAYS_EAGER": "true",
+        # Benchmarks send far more than a user's per-minute budget; concurrency limits stay on
+        "RATE_LIMIT_REQUESTS_PER_MIN": "0",
+        "RATE_LIMIT_LLM_TOKENS_PER_MIN": "0",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    # Worker processes are spawned and need to find the app package too
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))
+
+    if args.redis_url:
+        from urllib.parse import urlparse
+        url = urlparse(args.redis_url)
+        os.environ["REDIS_HOST"] = url.hostname or "localhost"
+        os.environ["REDIS_PORT"] = str(url.port or 6379)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--redis-url", default=None, help="Use a real Redis instead of fakeredis")
+    parser.add_argument("--workdir", default=None, help="Directory for the SQLite file and uploads")
+    args = parser.parse_args()
+
+    if args.workers > 1 and not args.redis_url:
+        sys.exit("--workers > 1 needs a shared Redis: pass --redis-url")
+
+    configure_environment(args)
+
+    import uvicorn
+
+    if args.redis_url:
+        uvicorn.run("app.main:app", host=args.host, port=args.port, workers=args.workers, log_level="warning")
+    else:
+        install_fakeredis()
+        from app.main import app
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
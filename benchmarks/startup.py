@@ -0,0 +1,114 @@
+"""
+Startup benchmark: how long a fresh interpreter takes to import the API.
+
+Every run imports the module in a new subprocess (nothing is cached in memory),
+so the numbers match what a worker pays on a cold start:
+
+    python benchmarks/startup.py                       # median of 5 imports of app.main
+    python benchmarks/startup.py --runs 10 --top 15    # plus the slowest modules (-X importtime)
+    python benchmarks/startup.py --budget-ms 1500      # exit non-zero above the budget
+
+The JSON report contains the import time of every run (min/median/max) and
+which of HEAVY_MODULES the import loaded. Those should only be imported lazily
+(see app/core/startup.py). verify_imports.py uses `measure_import` to enforce
+IMPORT_TIME_BUDGET_MS.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Must not be loaded by importing app.main; they are imported where they are used
+HEAVY_MODULES = (
+    "celery",
+    "app.workers.tasks",
+    "langchain_core",
+    "langchain_community",
+    "langchain_postgres",
+    "langchain_text_splitters",
+    "google.genai",
+    "pypdf",
+)
+
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+__import__({module!r})
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({{"ms": elapsed, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def _environment():
+    env = dict(os.environ)
+    env.setdefault("SECRET_KEY", "startup-benchmark")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    return env
+
+
+def measure_import(module="app.main", runs=5):
+    """Imports `module` in `runs` fresh interpreters. Returns the timings (ms) and the heavy modules loaded."""
+    timings, heavy = [], set()
+    code = _PROBE.format(module=module, heavy=HEAVY_MODULES)
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], env=_environment(), cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["ms"])
+        heavy.update(result["heavy"])
+    return {
+        "module": module,
+        "runs": runs,
+        "min_ms": round(min(timings), 1),
+        "median_ms": round(statistics.median(timings), 1),
+        "max_ms": round(max(timings), 1),
+        "heavy_modules_loaded": sorted(heavy),
+    }
+
+
+def slowest_modules(module="app.main", top=10):
+    """
+    Parses `python -X importtime` and returns the `top` packages by cumulative
+    import time (ms). A package is charged for everything it imported first, so
+    e.g. fastapi includes pydantic and starlette.
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=_environment(),
+                            cwd=ROOT, capture_output=True, text=True, check=True).stderr
+    own_package = module.split(".")[0]
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        if "." in name or name == own_package:
+            continue
+        packages[name] = max(packages.get(name, 0), int(cumulative) / 1000)
+    rows = sorted(packages.items(), key=lambda row: row[1], reverse=True)
+    return [{"module": name, "cumulative_ms": round(ms, 1)} for name, ms in rows[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="Also list the N slowest top-level imports")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Exit non-zero if the median is above this")
+    args = parser.parse_args()
+
+    report = measure_import(args.module, args.runs)
+    if args.top:
+        report["slowest"] = slowest_modules(args.module, args.top)
+    print(json.dumps(report, indent=2))
+
+    if args.budget_ms is not None and report["median_ms"] > args.budget_ms:
+        print(f"Import of {args.module} took {report['median_ms']}ms, budget is {args.budget_ms}ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
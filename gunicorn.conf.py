@@ -0,0 +1,42 @@
+# gunicorn.conf.py
+
+"""
+Gunicorn settings for the API.
+
+    gunicorn app.main:app -c gunicorn.conf.py
+
+With GUNICORN_PRELOAD=true (the default) the master imports the app once,
+imports the modules it would otherwise load lazily (app/core/startup.py), then
+freezes the GC and forks. Workers start almost instantly and share those
+read-only pages copy-on-write. Nothing network-bound happens before the fork:
+Redis, database connections and the logging thread are created per worker in the
+FastAPI lifespan.
+
+Note that with --preload, code changes need a full restart; a HUP only re-forks
+workers from the already-loaded master.
+"""
+
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before any worker is forked
+    if not preload_app:
+        return
+    from app.core.startup import freeze_for_fork, import_deferred_modules
+    import_deferred_modules()
+    freeze_for_fork()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    # Never share pooled connections with the master (it should have none, but be sure)
+    from app.db.database import async_engine, engine
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
@@ -0,0 +1,19 @@
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+from app.db import redis_client
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Routes get_redis() and get_async_redis() to one in-memory server (Lua scripts included)."""
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    monkeypatch.setattr(redis_client, "_client", client)
+    monkeypatch.setattr(redis_client, "_checked_pid", redis_client.os.getpid())
+    monkeypatch.setattr(redis_client, "_scripts", {})
+    monkeypatch.setattr(redis_client, "_async_client", fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    monkeypatch.setattr(redis_client, "_async_pid", redis_client.os.getpid())
+    monkeypatch.setattr(redis_client, "_async_scripts", {})
+    return client
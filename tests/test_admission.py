@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from app.services import admission
+
+
+@pytest.fixture
+def limits(fake_redis, monkeypatch):
+    """Admission on the fake Redis with rate limits and quotas off; tests set the concurrency they need."""
+    monkeypatch.setattr(admission.settings, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(admission.settings, "RATE_LIMIT_REQUESTS_PER_MIN", 0)
+    monkeypatch.setattr(admission.settings, "RATE_LIMIT_LLM_TOKENS_PER_MIN", 0)
+    monkeypatch.setattr(admission.settings, "USAGE_DAILY_TOKEN_QUOTA", 0)
+    monkeypatch.setattr(admission.settings, "USAGE_MONTHLY_TOKEN_QUOTA", 0)
+    monkeypatch.setattr(admission.settings, "ADMISSION_USER_CONCURRENCY", 10)
+    monkeypatch.setattr(admission.settings, "ADMISSION_GLOBAL_CONCURRENCY", 10)
+    monkeypatch.setattr(admission.settings, "ADMISSION_QUEUE_TIMEOUT_S", 5)
+    return admission.settings
+
+
+def test_token_bucket_takes_until_empty(fake_redis):
+    key = admission.REQUEST_BUCKET_KEY.format(user_id=1)
+
+    assert admission._take_from_bucket(key, capacity=2, per_min=60, cost=1) == 0
+    assert admission._take_from_bucket(key, capacity=2, per_min=60, cost=1) == 0
+    # Refills at one per second
+    assert 0.9 < admission._take_from_bucket(key, capacity=2, per_min=60, cost=1) <= 1.0
+
+
+def test_token_bucket_check_and_debit(fake_redis):
+    key = admission.TOKEN_BUCKET_KEY.format(user_id=1)
+
+    assert admission._take_from_bucket(key, capacity=100, per_min=60, cost=1, mode="check") == 0
+    # Usage is charged after the fact, and may exceed the balance
+    admission._take_from_bucket(key, capacity=100, per_min=60, cost=160, mode="debit")
+    wait = admission._take_from_bucket(key, capacity=100, per_min=60, cost=1, mode="check")
+    assert 60 < wait <= 61
+
+
+def test_request_rate_limit_rejects_with_retry_after(limits, monkeypatch):
+    monkeypatch.setattr(limits, "RATE_LIMIT_REQUESTS_PER_MIN", 60)
+    monkeypatch.setattr(limits, "RATE_LIMIT_REQUESTS_BURST", 1)
+
+    asyncio.run(admission.admit(1, "job")).release()
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        asyncio.run(admission.admit(1, "job"))
+
+    assert rejected.value.status_code == 429
+    assert rejected.value.headers["Retry-After"] == "1"
+
+
+def test_user_concurrency_limit(limits, monkeypatch):
+    monkeypatch.setattr(limits, "ADMISSION_USER_CONCURRENCY", 1)
+
+    async def scenario():
+        lease = await admission.admit(1, "chat")
+        with pytest.raises(admission.AdmissionRejected) as rejected:
+            await admission.admit(1, "chat")
+        assert rejected.value.reason == "user concurrency"
+        # Other users are not affected, and the slot is free again once released
+        (await admission.admit(2, "chat")).release()
+        lease.release()
+        (await admission.admit(1, "chat")).release()
+
+    asyncio.run(scenario())
+
+
+def test_queue_admits_interactive_before_background(limits, monkeypatch):
+    monkeypatch.setattr(limits, "ADMISSION_GLOBAL_CONCURRENCY", 1)
+
+    async def scenario():
+        holder = await admission.admit(1, "chat")
+        admitted = []
+
+        async def wait_for(user_id, kind):
+            lease = await admission.admit(user_id, kind)
+            admitted.append(kind)
+            return lease
+
+        background = asyncio.create_task(wait_for(2, "upload"))
+        await asyncio.sleep(0.2)
+        interactive = asyncio.create_task(wait_for(3, "chat"))
+        await asyncio.sleep(0.2)
+        assert admitted == []
+
+        # The chat arrived later but is first in line
+        holder.release()
+        (await interactive).release()
+        (await background).release()
+        return admitted
+
+    assert asyncio.run(scenario()) == ["chat", "upload"]
+
+
+def test_queue_timeout_leaves_the_queue(limits, fake_redis, monkeypatch):
+    monkeypatch.setattr(limits, "ADMISSION_GLOBAL_CONCURRENCY", 1)
+    monkeypatch.setattr(limits, "ADMISSION_QUEUE_TIMEOUT_S", 0.2)
+
+    async def scenario():
+        holder = await admission.admit(1, "chat")
+        with pytest.raises(admission.AdmissionRejected) as rejected:
+            await admission.admit(2, "chat")
+        holder.release()
+        return rejected.value
+
+    assert asyncio.run(scenario()).reason == "queue timeout"
+    assert fake_redis.zcard(admission.QUEUE_KEY) == 0
+    assert fake_redis.zcard(admission.GLOBAL_INFLIGHT_KEY) == 0
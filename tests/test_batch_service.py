@@ -0,0 +1,102 @@
+import os
+
+import orjson
+import pytest
+
+from app.services import batch_service
+from app.services.llm_limiter import _NoopLimiter
+from app.services.llm_provider import StubProvider
+
+USER_ID = "1"
+
+
+class CountingProvider(StubProvider):
+    def __init__(self):
+        super().__init__(default_model="stub-model", ttft_ms=0, tokens_per_sec=0, response_tokens=4)
+        self.prompts = []
+
+    def stream_generate(self, contents, system_instruction=None, tools=None, model=None, cached_content=None):
+        self.prompts.append(contents[-1]["parts"][0]["text"])
+        return super().stream_generate(contents, system_instruction, tools, model, cached_content)
+
+
+@pytest.fixture
+def provider(fake_redis, monkeypatch, tmp_path):
+    provider = CountingProvider()
+    monkeypatch.setattr(batch_service.settings, "BATCH_DIR", str(tmp_path / "batches"))
+    monkeypatch.setattr(batch_service.settings, "BATCH_MAX_ACTIVE_JOBS_PER_USER", 2)
+    monkeypatch.setattr(batch_service.settings, "USAGE_DAILY_TOKEN_QUOTA", 0)
+    monkeypatch.setattr(batch_service.settings, "USAGE_MONTHLY_TOKEN_QUOTA", 0)
+    monkeypatch.setattr(batch_service, "get_llm_provider", lambda: provider)
+    monkeypatch.setattr(batch_service, "get_llm_limiter", lambda: _NoopLimiter())
+    return provider
+
+
+def queue_job(monkeypatch, count):
+    """Creates a job through the API side; returns its id. The task is not run."""
+    queued = []
+    from app.workers import tasks
+    monkeypatch.setattr(tasks.batch_generate_task, "delay", queued.append)
+    batch_service.create_job(USER_ID, [{"prompt": f"prompt {index}", "custom_id": f"c{index}"} for index in range(count)])
+    return queued[0]
+
+
+def read_results(job_id):
+    with open(batch_service.results_path(job_id), "rb") as f:
+        return [orjson.loads(line) for line in f.read().splitlines()]
+
+
+def test_runs_a_job_to_completion(provider, fake_redis, monkeypatch):
+    job_id = queue_job(monkeypatch, 5)
+
+    assert batch_service.BatchRunner(job_id).run() is False
+
+    job = batch_service.get_job(USER_ID, job_id)
+    assert (job["status"], job["succeeded"], job["failed"], job["pending"]) == ("completed", 5, 0, 0)
+    assert sorted(result["custom_id"] for result in read_results(job_id)) == [f"c{index}" for index in range(5)]
+    assert fake_redis.scard(batch_service.ACTIVE_JOBS_KEY.format(user_id=USER_ID)) == 0
+
+
+def test_resumes_from_a_torn_results_file(provider, fake_redis, monkeypatch):
+    job_id = queue_job(monkeypatch, 5)
+    done = [
+        {"index": index, "custom_id": f"c{index}", "status": "succeeded", "response": "earlier",
+         "usage": {"input_tokens": 3, "output_tokens": 4}}
+        for index in (0, 3)
+    ]
+    # The previous delivery died halfway through writing a third line
+    with open(batch_service.results_path(job_id), "wb") as f:
+        f.write(b"".join(orjson.dumps(result) + b"\n" for result in done) + b'{"index": 1, "stat')
+    # Counters it had reported before it died are recounted from the file
+    fake_redis.hset(batch_service.JOB_KEY.format(job_id=job_id), mapping={"succeeded": 3, "input_tokens": 99})
+
+    assert batch_service.BatchRunner(job_id).run() is False
+
+    assert sorted(provider.prompts) == ["prompt 1", "prompt 2", "prompt 4"]
+    results = read_results(job_id)
+    assert sorted(result["index"] for result in results) == [0, 1, 2, 3, 4]
+    assert [result["response"] for result in results[:2]] == ["earlier", "earlier"]
+    job = batch_service.get_job(USER_ID, job_id)
+    assert (job["status"], job["succeeded"], job["failed"]) == ("completed", 5, 0)
+    assert job["input_tokens"] == 6 + sum(result["usage"]["input_tokens"] for result in results[2:])
+
+
+def test_missing_input_fails_the_job_and_frees_its_slot(provider, fake_redis, monkeypatch):
+    job_id = queue_job(monkeypatch, 2)
+    os.remove(os.path.join(batch_service._job_dir(job_id), batch_service.INPUT_FILE))
+
+    assert batch_service.BatchRunner(job_id).run() is False
+
+    job = batch_service.get_job(USER_ID, job_id)
+    assert job["status"] == "failed"
+    assert job["error"].startswith("FileNotFoundError")
+    assert fake_redis.scard(batch_service.ACTIVE_JOBS_KEY.format(user_id=USER_ID)) == 0
+
+
+def test_active_job_limit(provider, monkeypatch):
+    for _ in range(2):
+        queue_job(monkeypatch, 1)
+
+    with pytest.raises(batch_service.HTTPException) as rejected:
+        queue_job(monkeypatch, 1)
+    assert rejected.value.status_code == 429
@@ -0,0 +1,35 @@
+import asyncio
+import json
+
+from app.services import chat_history
+
+
+def seed_legacy(client, user_id, session_id, count):
+    """History entries as written before messages had ids."""
+    key = chat_history.HISTORY_KEY.format(user_id=user_id, session_id=session_id)
+    for index in range(count):
+        role = "user" if index % 2 == 0 else "assistant"
+        client.rpush(key, json.dumps({"role": role, "content": f"old {index}"}))
+
+
+def test_legacy_entries_get_position_seq(fake_redis):
+    seed_legacy(fake_redis, 1, "s1", 6)
+
+    history = chat_history.get_session_history(1, "s1", limit=4)
+
+    assert [message["content"] for message in history] == ["old 2", "old 3", "old 4", "old 5"]
+    assert [message["seq"] for message in history] == [2, 3, 4, 5]
+
+
+def test_legacy_entries_sort_before_new_messages(fake_redis, monkeypatch):
+    monkeypatch.setattr(chat_history.settings, "CHAT_ARCHIVE_ENABLED", False)
+    seed_legacy(fake_redis, 1, "s1", 2)
+    chat_history.add_message_to_history(1, "s1", {"role": "user", "content": "new"})
+
+    history = chat_history.get_session_history(1, "s1", limit=10)
+
+    assert [message["content"] for message in history] == ["old 0", "old 1", "new"]
+    assert history[0]["seq"] < history[1]["seq"] < history[2]["seq"]
+
+    page = asyncio.run(chat_history.get_history_page(1, "s1", before=history[2]["seq"], limit=10))
+    assert [message["content"] for message in page["messages"]] == ["old 0", "old 1"]
@@ -0,0 +1,75 @@
+import pytest
+
+from app.services.llm_limiter import BACKGROUND, INTERACTIVE, AdaptiveLimiter
+from app.services.llm_provider import LLMProviderError, LLMThrottledError
+
+
+@pytest.fixture
+def limiter(fake_redis):
+    return AdaptiveLimiter(
+        initial=4,
+        minimum=1,
+        maximum=5,
+        decrease_factor=0.5,
+        decrease_cooldown_ms=60000,
+        latency_target_ms=1000,
+        interactive_reserve=0.25,
+        wait_timeout_s=0.1,
+        background_wait_timeout_s=0.1,
+        lease_ttl_s=60,
+    )
+
+
+def test_healthy_calls_grow_the_limit_while_it_is_used(limiter):
+    first, second = limiter.try_acquire(), limiter.try_acquire()
+    with first:
+        pass
+    # Two in flight is half the limit: +1/limit
+    assert limiter.stats()["limit"] == pytest.approx(4.25)
+
+    with second:
+        pass
+    # One in flight: the limit is not being used, so it holds
+    assert limiter.stats()["limit"] == pytest.approx(4.25)
+
+
+def test_limit_stops_at_maximum(limiter):
+    for _ in range(50):
+        slots = [limiter.try_acquire() for _ in range(3)]
+        for slot in slots:
+            slot.release()
+    assert limiter.stats()["limit"] == pytest.approx(5)
+
+
+def test_throttling_shrinks_the_limit_once_per_cooldown(limiter):
+    limiter.try_acquire().release(LLMThrottledError("429"))
+    assert limiter.stats()["limit"] == pytest.approx(2)
+
+    # Same burst of 429s: counted once
+    limiter.try_acquire().release(LLMThrottledError("429"))
+    assert limiter.stats()["limit"] == pytest.approx(2)
+
+
+def test_errors_and_slow_calls_hold_the_limit(limiter):
+    slots = [limiter.try_acquire() for _ in range(3)]
+    slots[0].release(LLMProviderError("boom"))
+    slots[1].started -= 2  # Slower than the latency target
+    slots[1].release()
+    slots[2].discard()
+
+    assert limiter.stats()["limit"] == pytest.approx(4)
+    assert limiter.stats()["inflight"] == 0
+
+
+def test_limit_caps_slots_and_keeps_a_reserve_for_interactive(limiter):
+    background = [limiter.try_acquire(BACKGROUND) for _ in range(3)]
+    assert all(background)
+    # floor(4 * 0.75) background slots at most
+    assert limiter.try_acquire(BACKGROUND) is None
+
+    interactive = limiter.try_acquire(INTERACTIVE)
+    assert interactive is not None
+    assert limiter.try_acquire(INTERACTIVE) is None
+
+    background[0].discard()
+    assert limiter.try_acquire(BACKGROUND) is not None
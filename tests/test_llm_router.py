@@ -0,0 +1,83 @@
+import time
+
+from app.services.llm_limiter import _NoopLimiter
+from app.services.llm_provider import LLMProviderError, StubProvider
+from app.services.llm_router import LLMRouter
+
+PRIMARY = "primary"
+FALLBACK = "fallback"
+CONTENTS = [{"role": "user", "parts": [{"text": "hello"}]}]
+
+
+class ScriptedProvider(StubProvider):
+    """StubProvider with a per-model delay before the first chunk, or a failure."""
+
+    def __init__(self, delays=None, failing=()):
+        super().__init__(default_model=PRIMARY, ttft_ms=0, tokens_per_sec=0, response_tokens=8)
+        self.delays = delays or {}
+        self.failing = set(failing)
+        self.calls = []
+
+    def stream_generate(self, contents, system_instruction=None, tools=None, model=None, cached_content=None):
+        self.calls.append(model)
+        time.sleep(self.delays.get(model, 0))
+        if model in self.failing:
+            raise LLMProviderError(f"{model} is down")
+        yield from super().stream_generate(contents, system_instruction, tools, model, cached_content)
+
+
+def make_router(provider, hedge_delay_ms=50):
+    return LLMRouter(
+        provider,
+        hedge_delay_ms=hedge_delay_ms,
+        fallback_model=FALLBACK,
+        breaker_options={"window": 4, "min_samples": 2, "error_rate": 0.5, "ttft_ms": 10000, "cooldown_s": 60},
+        limiter=_NoopLimiter(),
+    )
+
+
+def answer(provider, model):
+    return "".join(chunk.text for chunk in StubProvider.stream_generate(provider, CONTENTS, model=model))
+
+
+def test_hedge_wins_over_slow_primary():
+    provider = ScriptedProvider(delays={PRIMARY: 1.0})
+    router = make_router(provider)
+
+    started = time.monotonic()
+    text = "".join(chunk.text for chunk in router.stream_generate(CONTENTS))
+
+    assert time.monotonic() - started < 0.5
+    assert text == answer(provider, FALLBACK)
+    assert provider.calls == [PRIMARY, FALLBACK]
+    assert router.counters["hedged"] == 1
+    assert router.counters["hedge_wins"] == 1
+
+
+def test_no_hedge_when_primary_is_fast():
+    provider = ScriptedProvider()
+    router = make_router(provider, hedge_delay_ms=500)
+
+    text = "".join(chunk.text for chunk in router.stream_generate(CONTENTS))
+
+    assert text == answer(provider, PRIMARY)
+    assert provider.calls == [PRIMARY]
+    assert router.counters["hedged"] == 0
+
+
+def test_failing_primary_opens_circuit():
+    provider = ScriptedProvider(failing={PRIMARY})
+    router = make_router(provider, hedge_delay_ms=10000)
+
+    # Each failure falls back to the other model right away
+    for _ in range(2):
+        assert "".join(chunk.text for chunk in router.stream_generate(CONTENTS)) == answer(provider, FALLBACK)
+    assert router.counters["circuit_opened"] == 1
+    assert router.stats()["open_circuits"] == [PRIMARY]
+
+    provider.calls.clear()
+    text = "".join(chunk.text for chunk in router.stream_generate(CONTENTS))
+
+    # Open circuit: the primary is skipped altogether
+    assert text == answer(provider, FALLBACK)
+    assert provider.calls == [FALLBACK]
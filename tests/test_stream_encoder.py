@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+from app.services.stream_encoder import (
+    NDJSON,
+    SSE,
+    StreamEncoder,
+    TextCoalescer,
+    encode_event_stream,
+    negotiate_stream_format,
+)
+
+
+def collect(events, stream_format, **options):
+    async def run():
+        return [frame async for frame in encode_event_stream(events, stream_format, heartbeat_s=0, **options)]
+    return asyncio.run(run())
+
+
+def test_negotiates_format_from_accept():
+    assert negotiate_stream_format("text/event-stream") == SSE
+    assert negotiate_stream_format("application/json, TEXT/EVENT-STREAM") == SSE
+    assert negotiate_stream_format("application/json") == NDJSON
+    assert negotiate_stream_format(None) == NDJSON
+
+
+def test_ndjson_frames():
+    encoder = StreamEncoder(NDJSON)
+
+    assert encoder.encode({"type": "text", "content": "hi"}) == b'{"type":"text","content":"hi"}\n'
+    assert encoder.encode({"type": "text", "content": "hi"}, "5-0") == b'{"type":"text","content":"hi","id":"5-0"}\n'
+    assert encoder.heartbeat() == b"\n"
+    assert encoder.end() == b""
+
+
+def test_sse_frames_number_events_and_end_with_last_id():
+    encoder = StreamEncoder(SSE)
+
+    assert encoder.encode({"type": "text", "content": "a"}) == b'id: 1\nevent: text\ndata: {"type":"text","content":"a"}\n\n'
+    assert encoder.encode({"type": "thought", "content": "b"}).startswith(b"id: 2\nevent: thought\n")
+    assert encoder.end() == b'id: 2\nevent: done\ndata: {"type":"done"}\n\n'
+    assert encoder.heartbeat() == b": heartbeat\n\n"
+
+
+def test_coalescer_sends_first_text_then_buffers_up_to_max_bytes():
+    coalescer = TextCoalescer(max_bytes=5, max_delay_s=60)
+    encoder = StreamEncoder(NDJSON)
+
+    assert coalescer.add("a", "1-0") is True
+    assert json.loads(coalescer.flush(encoder)) == {"type": "text", "content": "a", "id": "1-0"}
+    assert coalescer.time_left() is None
+
+    assert coalescer.add("bc", "2-0") is False
+    assert coalescer.time_left() > 0
+    assert coalescer.add("def", "3-0") is True
+    # One event, tagged with the id of its last part
+    assert json.loads(coalescer.flush(encoder)) == {"type": "text", "content": "bcdef", "id": "3-0"}
+    assert coalescer.flush(encoder) == b""
+
+
+def test_coalescer_flushes_after_max_delay():
+    coalescer = TextCoalescer(max_bytes=1000, max_delay_s=0)
+    coalescer.add("a")
+
+    assert coalescer.add("b") is True
+
+
+def test_event_stream_coalesces_text_between_other_events():
+    events = [
+        {"type": "text", "content": "a"},
+        {"type": "text", "content": "b"},
+        {"type": "text", "content": "c"},
+        {"type": "thought", "content": "calling a tool"},
+        {"type": "text", "content": "d"},
+    ]
+
+    frames = collect(events, NDJSON, max_bytes=1000, max_delay_ms=60000)
+
+    lines = [json.loads(line) for frame in frames for line in frame.splitlines()]
+    assert lines == [
+        {"type": "text", "content": "a"},
+        {"type": "text", "content": "bc"},
+        {"type": "thought", "content": "calling a tool"},
+        {"type": "text", "content": "d"},
+    ]
+
+
+def test_event_stream_sse_keeps_stream_ids_and_ends_with_done():
+    events = [("1-0", {"type": "text", "content": "a"}), ("2-0", {"type": "text", "content": "b"})]
+
+    body = b"".join(collect(events, SSE, max_bytes=1000, max_delay_ms=60000, with_ids=True))
+
+    assert body == (
+        b'id: 1-0\nevent: text\ndata: {"type":"text","content":"a"}\n\n'
+        b'id: 2-0\nevent: text\ndata: {"type":"text","content":"b"}\n\n'
+        b'id: 2-0\nevent: done\ndata: {"type":"done"}\n\n'
+    )
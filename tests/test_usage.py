@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import create_engine, select
+
+from app.models.usage import UsageFlush, UsageRecord
+from app.services import usage
+
+
+@pytest.fixture
+def usage_db(fake_redis, monkeypatch, tmp_path):
+    """The flusher's engine, on a throwaway SQLite file."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'usage.db'}")
+    UsageRecord.metadata.create_all(engine, tables=[UsageRecord.__table__, UsageFlush.__table__])
+    monkeypatch.setattr(usage, "engine", engine)
+    monkeypatch.setattr(usage.settings, "USAGE_ENABLED", True)
+    return engine
+
+
+def usage_rows(engine):
+    with engine.connect() as conn:
+        return {
+            (row.user_id, row.feature): (row.requests, row.input_tokens, row.output_tokens)
+            for row in conn.execute(select(UsageRecord))
+        }
+
+
+def test_flush_moves_usage_into_the_table(usage_db, fake_redis):
+    usage.record_usage(1, usage.FEATURE_CHAT, requests=1, input_tokens=10, output_tokens=5)
+    usage.record_usage(1, usage.FEATURE_CHAT, requests=1, input_tokens=20, output_tokens=5)
+    usage.record_usage(2, usage.FEATURE_RAG, requests=1, embedding_tokens=7)
+
+    assert usage.UsageFlusher().flush_once() == 2
+
+    assert usage_rows(usage_db) == {(1, usage.FEATURE_CHAT): (2, 30, 10), (2, usage.FEATURE_RAG): (1, 0, 0)}
+    assert not fake_redis.exists(usage.PENDING_KEY, usage.DIRTY_KEY)
+    assert usage.quota_status(1)["daily"]["used"] == 40
+
+    # Later usage is added to the same rows
+    usage.record_usage(1, usage.FEATURE_CHAT, requests=1, input_tokens=1)
+    usage.UsageFlusher().flush_once()
+    assert usage_rows(usage_db)[(1, usage.FEATURE_CHAT)] == (3, 31, 10)
+
+
+def test_batch_retried_after_commit_is_not_counted_twice(usage_db, fake_redis, monkeypatch):
+    usage.record_usage(1, usage.FEATURE_CHAT, requests=1, input_tokens=10, output_tokens=5)
+    get_script = usage.get_script
+
+    def crash_before_clear(source):
+        if source == usage._CLEAR_SCRIPT:
+            raise ConnectionError("lost Redis after the commit")
+        return get_script(source)
+
+    # The batch is written, but stays pending in Redis
+    monkeypatch.setattr(usage, "get_script", crash_before_clear)
+    with pytest.raises(ConnectionError):
+        usage.UsageFlusher().flush_once()
+    assert fake_redis.exists(usage.PENDING_KEY)
+    monkeypatch.setattr(usage, "get_script", get_script)
+
+    # Usage recorded meanwhile waits for the next batch
+    usage.record_usage(1, usage.FEATURE_CHAT, requests=1, input_tokens=1)
+    usage.UsageFlusher().flush_once()
+    assert usage_rows(usage_db) == {(1, usage.FEATURE_CHAT): (1, 10, 5)}
+    assert not fake_redis.exists(usage.PENDING_KEY)
+
+    usage.UsageFlusher().flush_once()
+    assert usage_rows(usage_db) == {(1, usage.FEATURE_CHAT): (2, 11, 5)}
+    with usage_db.connect() as conn:
+        assert len(conn.execute(select(UsageFlush)).all()) == 2
+
+
+def test_flush_skipped_while_another_process_holds_the_lock(usage_db, fake_redis):
+    usage.record_usage(1, usage.FEATURE_CHAT, requests=1)
+    fake_redis.set(usage.FLUSH_LOCK_KEY, "other")
+
+    assert usage.UsageFlusher().flush_once() == 0
+    assert usage_rows(usage_db) == {}
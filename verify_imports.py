@@ -2,7 +2,10 @@ import sys
 import os
 
 # Add the project root to sys.path
-sys.path.append('/Users/ilkaygirgin/Documents/repos/fastapi-llm-microservice')
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+os.environ.setdefault("SECRET_KEY", "verify-imports")
 
 print("Attempting to import app.services.llm_service...")
 try:
@@ -21,3 +24,20 @@ except ImportError as e:
     sys.exit(1)
 
 print("All imports successful. Circular dependency resolved.")
+
+# Startup budget: app.main must import quickly and leave the heavy modules for later
+from app.core.config import settings
+from startup import measure_import
+
+print(f"Measuring import time of app.main (budget {settings.IMPORT_TIME_BUDGET_MS:.0f}ms)...")
+report = measure_import("app.main", runs=5)
+print(f"app.main imported in {report['median_ms']}ms (median of {report['runs']} runs).")
+
+if report["heavy_modules_loaded"]:
+    print(f"Error: app.main imports {', '.join(report['heavy_modules_loaded'])} eagerly; import them where they are used.")
+    sys.exit(1)
+if report["median_ms"] > settings.IMPORT_TIME_BUDGET_MS:
+    print(f"Error: import time is over the budget of {settings.IMPORT_TIME_BUDGET_MS:.0f}ms.")
+    sys.exit(1)
+
+print("Import-time budget respected.")